@@ -1,19 +1,25 @@
 import enum
 import logging
-from typing import Optional, List
+from typing import Optional, List, Dict, Any
 
 from pydantic import BaseModel, Field
 from pykka import ActorRef
 
+from assemble.app.core.agents.async_base import AsyncAgentBase
 from assemble.app.core.agents.base import AgentBase
+from assemble.app.core.agents.checkpoint import CheckpointStore
 from assemble.app.core.llm.adapter import LLMAdapter
+from assemble.app.core.llm.cache import ResponseCache
 from assemble.app.core.llm.generator import Generator
 from assemble.app.core.memory.memory import Memory
+from assemble.app.core.metrics import MetricsSink
 from assemble.app.core.persona import Persona
 from assemble.app.core.states.base import StateBase, Transition
+from assemble.app.core.states.prompt import Segment
 from assemble.app.states.defaults import text_handler, tools_handler
 from assemble.app.states.final_answer.state import FinalAnswerState
 from assemble.app.core.tools.adapter import ToolAdapter
+from assemble.app.core.tools.helper import tools_choice_schema
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +37,12 @@ class ReActAgent(AgentBase):
     pass
 
 
+class AsyncReActAgent(AsyncAgentBase):
+    name = ReActAgent.name
+    description = ReActAgent.description
+    pass
+
+
 class ObserveState(StateBase):
     name: str = States.OBSERVE
 
@@ -59,9 +71,24 @@ Provide a summary of what you observe with important details from the actions ou
 
 class ActionState(StateBase):
     name: str = States.ACTION
+    stop_at_json: bool = True
+
+    def prompt_segments(self, memory: Memory) -> List[Segment]:
+        return [Segment(name="notes", items=memory.scratch_pad.get())]
+
+    def response_json_schema(self) -> Optional[Dict[str, Any]]:
+        return tools_choice_schema(self.tools) if self.tools else None
 
     def build_prompt(self, persona: Persona, memory: Memory, tools: Optional[List[ToolAdapter]]) -> str:
+        return self.render_prompt(persona, memory, tools, {"notes": memory.scratch_pad.get()})
+
+    def render_prompt(self,
+                      persona: Persona,
+                      memory: Memory,
+                      tools: Optional[List[ToolAdapter]],
+                      segments: Dict[str, List[str]]) -> str:
         tool_schemas = [tool.schema() for tool in tools]
+        # Stable text comes first so backends that cache evaluated prompt prefixes can reuse it across steps.
         prompt = f'''{persona.prompt()}
 
 Action:
@@ -70,19 +97,19 @@ Action:
 - Do not ask for help.
 - Don't repeat yourself from previous notes.
 
-Notes:
+Here are the schemas for the tools you have access to, pick only one:
 """
-{memory.scratch_pad.prompt()}
+{tool_schemas}
 """
 
-Task:
+Notes:
 """
-{memory.data.get("last_thought")}
+{memory.scratch_pad.prompt(segments["notes"])}
 """
 
-Here are the schemas for the tools you have access to, pick only one:
+Task:
 """
-{tool_schemas}
+{memory.data.get("last_thought")}
 """
 
 Respond with the JSON input for the tool of your choice to best solve the problem.'''
@@ -113,6 +140,8 @@ class ThoughtStateChoice(BaseModel):
 
 class ThoughtState(StateBase):
     name: str = States.THOUGHT
+    stop_at_json: bool = True
+    response_schema = ThoughtStateChoice
 
     @staticmethod
     def _get_thought_component_prompt(last_thought_exist: bool) -> str:
@@ -140,10 +169,26 @@ class ThoughtState(StateBase):
     def _get_tools_component_formatted(tools: List[ToolAdapter]) -> str:
         return "\n".join([f"name: {tool.name}\ndescription: {tool.description}\n\n" for tool in tools])
 
+    def prompt_segments(self, memory: Memory) -> List[Segment]:
+        return [
+            Segment(name="notes", items=memory.prompt_notes(), priority=1),
+            Segment(name="messages", items=self.prompt_messages(memory))
+        ]
+
     def build_prompt(self, persona: Persona, memory: Memory, tools: List[ToolAdapter]) -> str:
+        return self.render_prompt(persona, memory, tools, {
+            "notes": memory.prompt_notes(),
+            "messages": self.prompt_messages(memory)
+        })
+
+    def render_prompt(self,
+                      persona: Persona,
+                      memory: Memory,
+                      tools: List[ToolAdapter],
+                      segments: Dict[str, List[str]]) -> str:
         last_thought_exist = memory.data.exists("last_thought")
-        notes = memory.scratch_pad.get()
-        messages = [f"{message.name}: {message.content}\n" for message in memory.data.get_all_messages()]
+        notes = segments["notes"]
+        messages = segments["messages"]
         current_message_content = memory.data.get_current_message().content
 
         thought_component_prompt = self._get_thought_component_prompt(last_thought_exist)
@@ -151,10 +196,9 @@ class ThoughtState(StateBase):
         messages_component_formatted = self._get_messages_component_formatted(messages)
         tools_component_formatted = self._get_tools_component_formatted(tools)
 
+        # Stable text comes first so backends that cache evaluated prompt prefixes can reuse it across steps.
         prompt = f'''{persona.prompt()}
 
-{thought_component_prompt}
-
 Thought instructions:
 - Provides exact details on the task to best answer the message, do not forget important details.
 - You have access to tools that can help you answer the message. Always try to use a tool.
@@ -165,15 +209,6 @@ Thought instructions:
 - If the message doesn't require any tool, just give your answer.
 - Don't repeat yourself from previous thoughts.
 
-{messages_component_formatted}
-
-Current message:
-"""
-{current_message_content}
-"""
-
-{notes_component_prompt}
-
 Here are the tools you have access to, you DO NOT have access to other tools, use the name of the tool you think can help:
 """
 {tools_component_formatted}
@@ -184,6 +219,17 @@ Provide a choice based on the following JSON schema:
 {ThoughtStateChoice.schema()}
 """
 
+{messages_component_formatted}
+
+Current message:
+"""
+{current_message_content}
+"""
+
+{notes_component_prompt}
+
+{thought_component_prompt}
+
 Your response should be in JSON matching the schema. It should include your reasoning for the choice. 
 - If you don't know the answer, provide a short summary with unique details for the action to take.
 - If you know the answer, use your observations to help. The answer should include any important details on how you know.
@@ -193,16 +239,12 @@ Choice JSON:'''
         return prompt
 
     def after_generation(self, response: str, memory: Memory, tools: List[ToolAdapter]) -> Transition:
-        try:
-            choice = ThoughtStateChoice.model_validate_json(response)
-            if choice.type == ThoughtStateType.ACTION:
-                memory.data.set("last_thought", choice.reason)
-                return Transition(next_state=States.ACTION, updated_response=choice.reason)
-            elif choice.type == ThoughtStateType.ANSWER:
-                return Transition(next_state=States.FINAL_ANSWER, updated_response=choice.reason)
-        except Exception as e:
-            return Transition(updated_response=f"Failed to parse response as Choice: {e}",
-                              next_state=States.THOUGHT)
+        # A response that doesn't parse raises, so the state is retried with a repair prompt.
+        choice = ThoughtStateChoice.model_validate_json(response)
+        if choice.type == ThoughtStateType.ACTION:
+            memory.data.set("last_thought", choice.reason)
+            return Transition(next_state=States.ACTION, updated_response=choice.reason)
+        return Transition(next_state=States.FINAL_ANSWER, updated_response=choice.reason)
 
 
 class ReActAgentFactory:
@@ -214,37 +256,109 @@ class ReActAgentFactory:
               memory: Memory = None,
               clear_scratch_pad_after_answer: bool = False,
               clear_data_after_answer: bool = False,
-              step_limit: int = 10) -> ActorRef[ReActAgent]:
-        if persona is None:
-            persona = Persona(
-                description=f"You're a helpful assistant called {ReActAgent.name}. You solve problems by breaking "
-                            f"them down into multiple steps, thinking on those steps, acting on them, and observing. "
-                            f"Given the problem, you will use your tools to solve it in as few steps as possible.")
-        if memory is None:
-            memory = Memory()
+              step_limit: int = 10,
+              max_concurrency: int = 1,
+              max_pending: int = 64,
+              max_sessions: int = 1024,
+              session_idle_ttl: Optional[float] = None,
+              session_spill_dir: Optional[str] = None,
+              metrics_sink: Optional[MetricsSink] = None,
+              checkpoint_store: Optional[CheckpointStore] = None,
+              max_fan_out: int = 8,
+              response_cache: Optional[ResponseCache] = None,
+              small_llm: Optional[LLMAdapter] = None) -> ActorRef[ReActAgent]:
+        return ReActAgent.start(
+            persona=ReActAgentFactory._default_persona() if persona is None else persona,
+            memory=Memory() if memory is None else memory,
+            states=ReActAgentFactory._build_states(llm, tools, response_cache, small_llm),
+            default_initial_state=States.THOUGHT.value,
+            clear_scratch_pad_after_answer=clear_scratch_pad_after_answer,
+            clear_data_after_answer=clear_data_after_answer,
+            step_limit=step_limit,
+            step_limit_state_name=States.FINAL_ANSWER.value,
+            max_concurrency=max_concurrency,
+            max_pending=max_pending,
+            max_sessions=max_sessions,
+            session_idle_ttl=session_idle_ttl,
+            session_spill_dir=session_spill_dir,
+            metrics_sink=metrics_sink,
+            checkpoint_store=checkpoint_store,
+            max_fan_out=max_fan_out
+        )
+
+    @staticmethod
+    def create_async(llm: LLMAdapter,
+                     tools: List[ToolAdapter],
+                     persona: Persona = None,
+                     memory: Memory = None,
+                     clear_scratch_pad_after_answer: bool = False,
+                     clear_data_after_answer: bool = False,
+                     step_limit: int = 10,
+                     max_concurrency: int = 256,
+                     max_pending: int = 4096,
+                     max_sessions: int = 1024,
+                     session_idle_ttl: Optional[float] = None,
+                     session_spill_dir: Optional[str] = None,
+                     metrics_sink: Optional[MetricsSink] = None,
+                     checkpoint_store: Optional[CheckpointStore] = None,
+                     max_fan_out: int = 8,
+                     response_cache: Optional[ResponseCache] = None,
+                     small_llm: Optional[LLMAdapter] = None) -> AsyncReActAgent:
+        return AsyncReActAgent(
+            persona=ReActAgentFactory._default_persona() if persona is None else persona,
+            memory=Memory() if memory is None else memory,
+            states=ReActAgentFactory._build_states(llm, tools, response_cache, small_llm),
+            default_initial_state=States.THOUGHT.value,
+            clear_scratch_pad_after_answer=clear_scratch_pad_after_answer,
+            clear_data_after_answer=clear_data_after_answer,
+            step_limit=step_limit,
+            step_limit_state_name=States.FINAL_ANSWER.value,
+            max_concurrency=max_concurrency,
+            max_pending=max_pending,
+            max_sessions=max_sessions,
+            session_idle_ttl=session_idle_ttl,
+            session_spill_dir=session_spill_dir,
+            metrics_sink=metrics_sink,
+            checkpoint_store=checkpoint_store,
+            max_fan_out=max_fan_out
+        )
+
+    @staticmethod
+    def _default_persona() -> Persona:
+        return Persona(
+            description=f"You're a helpful assistant called {ReActAgent.name}. You solve problems by breaking "
+                        f"them down into multiple steps, thinking on those steps, acting on them, and observing. "
+                        f"Given the problem, you will use your tools to solve it in as few steps as possible.")
 
+    @staticmethod
+    def _build_states(llm: LLMAdapter,
+                      tools: List[ToolAdapter],
+                      response_cache: Optional[ResponseCache] = None,
+                      small_llm: Optional[LLMAdapter] = None) -> List[StateBase]:
+        def cascade(**backend_kwargs) -> Generator:
+            """ The small model when there is one, escalating to llm if its response fails validation. """
+            large = Generator(service=llm, cache=response_cache, route="large", **backend_kwargs)
+            if small_llm is None:
+                return large
+            return Generator(service=small_llm, cache=response_cache, route="small", escalate_to=large,
+                             **backend_kwargs)
+
+        # Choosing the next step and answering need the strong model; tool input is validated and observations are
+        # simple enough for a small one.
         thought_state = ThoughtState(
-            generator=Generator(service=llm, use_json_model=True, temperature=0.1),
+            generator=Generator(service=llm, cache=response_cache, route="large", use_json_model=True,
+                                temperature=0.1),
             tools=tools
         )
         action_state = ActionState(
-            generator=Generator(service=llm, use_json_model=True, temperature=0.1),
+            generator=cascade(use_json_model=True, temperature=0.1),
             tools=tools
         )
         observe_state = ObserveState(
-            generator=Generator(service=llm, use_json_model=False, temperature=0.1),
+            generator=cascade(use_json_model=False, temperature=0.1),
             tools=tools
         )
-        final_answer_state = FinalAnswerState(Generator(service=llm, temperature=0.3))
+        final_answer_state = FinalAnswerState(Generator(service=llm, cache=response_cache, route="large",
+                                                        temperature=0.3))
 
-        states = [thought_state, action_state, observe_state, final_answer_state]
-        return ReActAgent.start(
-            persona=persona,
-            memory=memory,
-            states=states,
-            default_initial_state=States.THOUGHT.value,
-            clear_scratch_pad_after_answer=clear_scratch_pad_after_answer,
-            clear_data_after_answer=clear_data_after_answer,
-            step_limit=step_limit,
-            step_limit_state_name=States.FINAL_ANSWER.value
-        )
+        return [thought_state, action_state, observe_state, final_answer_state]
@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Callable, AsyncIterator, Tuple, Awaitable
+
+from assemble.app.core.agents.executor import AgentOverloadedException, ExecutorStats
+from assemble.app.core.agents.checkpoint import CheckpointStore
+from assemble.app.core.agents.machine import StateMachine, Response, Step
+from assemble.app.core.agents.stream import StreamEvent, StreamEventType, with_stream_callbacks
+from assemble.app.core import metrics
+from assemble.app.core.cancellation import (CancellationToken, DeadlineExceededException, RunCancelledException,
+                                             bind_token)
+from assemble.app.core.messages import Query, Resume
+from assemble.app.core.memory.memory import Memory
+from assemble.app.core.persona import Persona
+from assemble.app.core.states.base import StateBase
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAgentBase(StateMachine):
+    """ Runs an agent's state machine as coroutines, so many in-flight queries can share one event loop. """
+    name: str
+    description: str
+
+    def __init__(self,
+                 persona: Persona,
+                 memory: Memory,
+                 states: List[StateBase],
+                 default_initial_state: str,
+                 step_limit_state_name: str,
+                 clear_scratch_pad_after_answer: bool = False,
+                 clear_data_after_answer: bool = False,
+                 step_limit: int = 10,
+                 max_concurrency: int = 256,
+                 max_pending: int = 4096,
+                 memory_factory: Optional[Callable[[], Memory]] = None,
+                 max_sessions: int = 1024,
+                 session_idle_ttl: Optional[float] = None,
+                 session_spill_dir: Optional[str] = None,
+                 metrics_sink: Optional[metrics.MetricsSink] = None,
+                 checkpoint_store: Optional[CheckpointStore] = None,
+                 max_fan_out: int = 8):
+        super().__init__(
+            persona=persona,
+            memory=memory,
+            states=states,
+            default_initial_state=default_initial_state,
+            step_limit_state_name=step_limit_state_name,
+            clear_scratch_pad_after_answer=clear_scratch_pad_after_answer,
+            clear_data_after_answer=clear_data_after_answer,
+            step_limit=step_limit,
+            memory_factory=memory_factory,
+            max_sessions=max_sessions,
+            session_idle_ttl=session_idle_ttl,
+            session_spill_dir=session_spill_dir,
+            metrics_sink=metrics_sink,
+            checkpoint_store=checkpoint_store,
+            max_fan_out=max_fan_out
+        )
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1.")
+        if max_pending < 0:
+            raise ValueError("max_pending cannot be negative.")
+
+        self.actor_urn: str = uuid.uuid4().urn
+        self.max_concurrency: int = max_concurrency
+        self.max_pending: int = max_pending
+        self._memory_lock = asyncio.Lock()
+        self._runs: Dict[str, Tuple[CancellationToken, asyncio.Task]] = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._active = 0
+        self._waiting = 0
+        self._submitted = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._last_wait = 0.0
+
+    @asynccontextmanager
+    async def _session_memory(self, session_id: Optional[str]) -> AsyncIterator[Memory]:
+        if session_id is None:
+            async with self._memory_lock:
+                yield self.memory
+        else:
+            async with self.sessions.asession(session_id) as memory:
+                yield memory
+
+    def queue_stats(self) -> ExecutorStats:
+        """ Return the current depth, wait times and rejections of the agent's query queue. """
+        return ExecutorStats(
+            max_concurrency=self.max_concurrency,
+            max_pending=self.max_pending,
+            active=self._active,
+            queue_depth=self._waiting,
+            submitted=self._submitted,
+            completed=self._completed,
+            rejected=self._rejected,
+            avg_wait_seconds=self._total_wait / self._completed if self._completed else 0.0,
+            max_wait_seconds=self._max_wait,
+            last_wait_seconds=self._last_wait,
+        )
+
+    def cancel(self, query_id: str) -> bool:
+        """ Cancel a queued or in-flight query, interrupting whatever it is awaiting; returns whether it was found. """
+        run = self._runs.get(query_id)
+        if run is None:
+            return False
+        token, task = run
+        token.cancel(f"Query {query_id} was cancelled.")
+        task.cancel()
+        logger.info(f"Agent {self._label} cancelled query: {query_id}")
+        return True
+
+    async def ask(self, query: Query) -> Response:
+        logger.info(f"Agent {self._label} received message: {query}")
+        return await self._submit(
+            query_id=query.query_id,
+            session_id=query.session_id,
+            timeout=query.timeout,
+            run=lambda memory: self._arun(
+                goal=query.goal,
+                from_caller=query.from_caller,
+                memory=memory,
+                initial_state=query.initial_state,
+                on_step=query.on_step,
+                on_token=query.on_token,
+                on_retry=query.on_retry,
+                query_id=query.query_id,
+                session_id=query.session_id))
+
+    async def resume(self, message: Resume) -> Response:
+        """ Continue a checkpointed run from its last completed step. """
+        logger.info(f"Agent {self._label} received message: {message}")
+        checkpoint = await asyncio.to_thread(self.load_checkpoint, message.query_id)
+        return await self._submit(
+            query_id=message.query_id,
+            session_id=checkpoint.session_id,
+            timeout=message.timeout,
+            run=lambda memory: self._aresume(
+                checkpoint=checkpoint,
+                memory=memory,
+                on_step=message.on_step,
+                on_token=message.on_token,
+                on_retry=message.on_retry))
+
+    async def _submit(self,
+                      query_id: str,
+                      session_id: Optional[str],
+                      timeout: Optional[float],
+                      run: Callable[[Memory], Awaitable[List[Step]]]) -> Response:
+        if self._active >= self.max_concurrency and self._waiting >= self.max_pending:
+            self._rejected += 1
+            logger.warning(f"Agent {self._label} rejected message, pending queue is full.")
+            raise AgentOverloadedException(
+                f"Agent {self._label} is at capacity: {self.max_concurrency} running and {self.max_pending} pending.")
+
+        token = CancellationToken(timeout=timeout)
+        self._runs[query_id] = (token, asyncio.current_task())
+        deadline = asyncio.timeout(token.remaining())
+        try:
+            async with deadline:
+                with bind_token(token), self._bind_metrics():
+                    return await self._run_admitted(session_id, run)
+        except TimeoutError:
+            if deadline.expired():
+                raise DeadlineExceededException(f"Query {query_id} exceeded its deadline.") from None
+            raise
+        except asyncio.CancelledError:
+            if token.cancelled:
+                asyncio.current_task().uncancel()
+                raise RunCancelledException(token.reason) from None
+            raise
+        finally:
+            self._runs.pop(query_id, None)
+
+    async def _run_admitted(self,
+                            session_id: Optional[str],
+                            run: Callable[[Memory], Awaitable[List[Step]]]) -> Response:
+        enqueued_at = time.monotonic()
+        self._submitted += 1
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+
+        queue_wait = time.monotonic() - enqueued_at
+        metrics.observe("agent.queue_wait_seconds", queue_wait)
+        self._active += 1
+        self._last_wait = queue_wait
+        self._max_wait = max(self._max_wait, queue_wait)
+        try:
+            async with self._session_memory(session_id) as memory:
+                steps = await run(memory)
+        except (Exception, asyncio.CancelledError) as e:
+            logger.error(f"Error during message processing for {self._label}: {e!r}")
+            raise
+        finally:
+            self._active -= 1
+            self._completed += 1
+            self._total_wait += queue_wait
+            self._semaphore.release()
+
+        return Response(final_output=steps[-1].output, metadata={
+            "steps": steps,
+            "queue_wait_seconds": queue_wait,
+        })
+
+    async def astream(self, query: Query) -> AsyncIterator[StreamEvent]:
+        """ Run a query, yielding its tokens and steps as they're produced and ending with its Response. """
+        loop = asyncio.get_running_loop()
+        events: asyncio.Queue = asyncio.Queue()
+
+        def emit(event: StreamEvent):
+            # Token callbacks may fire on a worker thread when the backend streams synchronously.
+            loop.call_soon_threadsafe(events.put_nowait, event)
+
+        task = asyncio.create_task(self.ask(with_stream_callbacks(query, emit)))
+        task.add_done_callback(lambda _: loop.call_soon(events.put_nowait, None))
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                yield event
+            while not events.empty():
+                event = events.get_nowait()
+                if event is not None:
+                    yield event
+            yield StreamEvent(type=StreamEventType.RESPONSE, response=task.result())
+        finally:
+            if not task.done():
+                task.cancel()
@@ -1,35 +1,25 @@
 import logging
 import threading
-from typing import Dict, List, Any, Optional
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Callable, Iterator
 
 import pykka
-from pydantic import BaseModel
 from pykka import ThreadingFuture
 
-from assemble.app.core.messages import Query
-from assemble.app.core.memory.memory import Memory, Message
+from assemble.app.core.agents.checkpoint import CheckpointStore
+from assemble.app.core.agents.executor import BoundedExecutor, ExecutorStats
+from assemble.app.core.agents.machine import StateMachine, Step, Response
+from assemble.app.core import metrics
+from assemble.app.core.cancellation import CancellationToken, bind_token
+from assemble.app.core.messages import Query, Cancel, Resume
+from assemble.app.core.memory.memory import Memory
 from assemble.app.core.persona import Persona
 from assemble.app.core.states.base import StateBase
-from assemble.app.core.states.states import SystemStates
-from assemble.app.core.types import Usage
 
 logger = logging.getLogger(__name__)
 
-
-class Step(BaseModel):
-    state_name: str
-    next_state: str
-    prompt: Optional[str] = None
-    output: Optional[str] = None
-    token_usage: Optional[Usage] = None
-
-
-class Response(BaseModel):
-    final_output: str
-    metadata: Dict[str, Any]
-
-
-class AgentBase(pykka.ThreadingActor):
+class AgentBase(StateMachine, pykka.ThreadingActor):
     name: str
     description: str
 
@@ -41,110 +31,140 @@ class AgentBase(pykka.ThreadingActor):
                  step_limit_state_name: str,
                  clear_scratch_pad_after_answer: bool = False,
                  clear_data_after_answer: bool = False,
-                 step_limit: int = 10):
-        super().__init__()
-        if len(states) == 0:
-            raise ValueError("At least one state must be provided.")
+                 step_limit: int = 10,
+                 max_concurrency: int = 1,
+                 max_pending: int = 64,
+                 memory_factory: Optional[Callable[[], Memory]] = None,
+                 max_sessions: int = 1024,
+                 session_idle_ttl: Optional[float] = None,
+                 session_spill_dir: Optional[str] = None,
+                 metrics_sink: Optional[metrics.MetricsSink] = None,
+                 checkpoint_store: Optional[CheckpointStore] = None,
+                 max_fan_out: int = 8):
+        pykka.ThreadingActor.__init__(self)
+        StateMachine.__init__(
+            self,
+            persona=persona,
+            memory=memory,
+            states=states,
+            default_initial_state=default_initial_state,
+            step_limit_state_name=step_limit_state_name,
+            clear_scratch_pad_after_answer=clear_scratch_pad_after_answer,
+            clear_data_after_answer=clear_data_after_answer,
+            step_limit=step_limit,
+            memory_factory=memory_factory,
+            max_sessions=max_sessions,
+            session_idle_ttl=session_idle_ttl,
+            session_spill_dir=session_spill_dir,
+            metrics_sink=metrics_sink,
+            checkpoint_store=checkpoint_store,
+            max_fan_out=max_fan_out
+        )
+        self._memory_lock = threading.Lock()
+        self._runs: Dict[str, CancellationToken] = {}
+        self._runs_lock = threading.Lock()
+        self.executor: BoundedExecutor = BoundedExecutor(
+            max_concurrency=max_concurrency,
+            max_pending=max_pending,
+            name=self._label
+        )
+
+    def on_stop(self):
+        with self._runs_lock:
+            for token in self._runs.values():
+                token.cancel("Agent was stopped.")
+        self.executor.shutdown()
+        self.shutdown_fan_out()
+
+    def cancel(self, query_id: str) -> bool:
+        """ Cancel a queued or in-flight query, returning whether it was found. """
+        with self._runs_lock:
+            token = self._runs.get(query_id)
+        if token is None:
+            return False
+        token.cancel(f"Query {query_id} was cancelled.")
+        logger.info(f"Agent {self._label} cancelled query: {query_id}")
+        return True
+
+    @contextmanager
+    def _session_memory(self, session_id: Optional[str]) -> Iterator[Memory]:
+        """ Resolve the memory for a run; queries without a session id share the agent's own memory. """
+        if session_id is None:
+            with self._memory_lock:
+                yield self.memory
+        else:
+            with self.sessions.session(session_id) as memory:
+                yield memory
 
-        self.persona: Persona = persona
-        self.memory: Memory = memory
-        self.states: Dict[str, StateBase] = {
-            state.name: state
-            for state in states
-        }
-        self.current_state: str = SystemStates.IDLE.value
-        self.default_initial_state: str = default_initial_state
-        self.clear_scratch_pad_after_answer: bool = clear_scratch_pad_after_answer
-        self.clear_data_after_answer: bool = clear_data_after_answer
-        self.step_limit: int = step_limit
-        self.step_limit_state_name: str = step_limit_state_name
+    def queue_stats(self) -> ExecutorStats:
+        """ Return the current depth, wait times and rejections of the agent's query queue. """
+        return self.executor.stats()
 
     def on_receive(self, message):
-        logger.info(f"Agent {self.__class__.__name__}:{self.actor_urn} received message: {message}")
+        logger.info(f"Agent {self._label} received message: {message}")
         if isinstance(message, Query):
-            future = ThreadingFuture()
-
-            def thread_func():
-                try:
-                    steps = self._run(
-                        goal=message.goal,
-                        from_caller=message.from_caller,
-                        initial_state=message.initial_state)
-                    response = Response(final_output=steps[-1].output, metadata={
-                        "steps": steps,
-                    })
-                    future.set(response)
-                except Exception as e:
-                    future.set_exception(e)
-                    logger.error(f"Error during message processing for {self.__class__.__name__}:{self.actor_urn}: {e}")
-
-            threading.Thread(target=thread_func).start()
-            return future
+            return self._submit(
+                query_id=message.query_id,
+                session_id=message.session_id,
+                timeout=message.timeout,
+                run=lambda memory: self._run(
+                    goal=message.goal,
+                    from_caller=message.from_caller,
+                    memory=memory,
+                    initial_state=message.initial_state,
+                    on_step=message.on_step,
+                    on_token=message.on_token,
+                    on_retry=message.on_retry,
+                    query_id=message.query_id,
+                    session_id=message.session_id))
+        elif isinstance(message, Resume):
+            checkpoint = self.load_checkpoint(message.query_id)
+            return self._submit(
+                query_id=message.query_id,
+                session_id=checkpoint.session_id,
+                timeout=message.timeout,
+                run=lambda memory: self._resume(
+                    checkpoint=checkpoint,
+                    memory=memory,
+                    on_step=message.on_step,
+                    on_token=message.on_token,
+                    on_retry=message.on_retry))
+        elif isinstance(message, Cancel):
+            return self.cancel(message.query_id)
         else:
-            logger.error(f"Unexpected message for {self.__class__.__name__}:{self.actor_urn}: {message}")
-            raise ValueError(f"Unexpected message for {self.__class__.__name__}:{self.actor_urn}: {message}")
-
-    def _run(self,
-             goal: str,
-             from_caller: str,
-             initial_state: str = None) -> List[Step]:
-        if initial_state is None:
-            initial_state = self.default_initial_state
-
-        step_count = 0
-        steps = []
-        self.current_state = initial_state
-
-        self.memory.data.add_message(Message(name=from_caller, content=goal))
-
-        while self.current_state in self.states:
-            if self.current_state == SystemStates.EXIT.value:
-                break
-            elif step_count > self.step_limit:
-                self.current_state = self.step_limit_state_name
-
-            state = self.states[self.current_state]
-            logger.info(f"Agent {self.__class__.__name__}:{self.actor_urn} executing state: {self.current_state}")
-
-            response = state.execute(self.persona, self.memory)
-            if response is None:
-                raise ValueError(
-                    f"Invalid state transition from: {self.current_state}.")
-
-            self.memory.scratch_pad.set(f"{state.name.upper()}: {response.response}")
-
-            next_state = response.next_state
-            if self.current_state == self.step_limit_state_name:
-                next_state = SystemStates.EXIT.value
-
-            self.current_state = next_state
-            if self.current_state != SystemStates.EXIT.value and not self.states[self.current_state]:
-                raise ValueError(
-                    f"Invalid state transition: {self.current_state} -> {response.next_state}. Missing "
-                    f"state node for next state of {self.current_state}.")
-
-            steps.append(
-                Step(
-                    state_name=f"{state.name}",
-                    prompt=response.prompt,
-                    output=response.response,
-                    next_state=f"{self.current_state}",
-                    token_usage=response.token_usage
-                )
-            )
-            step_count += 1
-
-        if self.clear_scratch_pad_after_answer:
-            self.memory.reset_scratch_pad()
-            logger.info(f"Agent {self.__class__.__name__}:{self.actor_urn} cleared scratch pad.")
-        elif self.clear_data_after_answer:
-            self.memory.reset_data()
-            logger.info(f"Agent {self.__class__.__name__}:{self.actor_urn} cleared data.")
-
-        if len(steps) == 0:
-            raise ValueError(f"Agent {self.__class__.__name__}:{self.actor_urn} failed to execute, initial state "
-                             f"{initial_state} not found.")
-
-        self.memory.data.add_message(Message(name=self.__class__.__name__, content=steps[-1].output))
-        logger.info(f"Agent {self.__class__.__name__}:{self.actor_urn} finished execution.")
-        return steps
+            logger.error(f"Unexpected message for {self._label}: {message}")
+            raise ValueError(f"Unexpected message for {self._label}: {message}")
+
+    def _submit(self,
+                query_id: str,
+                session_id: Optional[str],
+                timeout: Optional[float],
+                run: Callable[[Memory], List[Step]]) -> ThreadingFuture:
+        enqueued_at = time.monotonic()
+        token = CancellationToken(timeout=timeout)
+        with self._runs_lock:
+            self._runs[query_id] = token
+
+        def drop_query():
+            with self._runs_lock:
+                self._runs.pop(query_id, None)
+
+        def run_query() -> Response:
+            queue_wait = time.monotonic() - enqueued_at
+            try:
+                with bind_token(token), self._bind_metrics(), self._session_memory(session_id) as memory:
+                    metrics.observe("agent.queue_wait_seconds", queue_wait)
+                    # A query cancelled or expired while queued is dropped before it touches memory.
+                    token.check()
+                    steps = run(memory)
+            except Exception as e:
+                logger.error(f"Error during message processing for {self._label}: {e}")
+                raise
+            finally:
+                drop_query()
+            return Response(final_output=steps[-1].output, metadata={
+                "steps": steps,
+                "queue_wait_seconds": queue_wait,
+            })
+
+        return self.executor.submit_future(run_query, on_reject=drop_query)
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field, asdict
+from typing import Any, Dict, List, Optional
+
+from assemble.app.core.memory.memory import Memory, Message
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Checkpoint:
+    """ Everything needed to continue a run after its last completed step. """
+    query_id: str
+    goal: str
+    from_caller: str
+    initial_state: str
+    # The state that runs next; the system exit state once the last step has completed.
+    current_state: str
+    session_id: Optional[str] = None
+    steps: List[Dict[str, Any]] = field(default_factory=list)
+    data: Dict[str, Any] = field(default_factory=dict)
+    messages: List[Dict[str, str]] = field(default_factory=list)
+    notes: List[str] = field(default_factory=list)
+    updated_at: float = field(default_factory=time.time)
+
+    def capture(self, memory: Memory):
+        """ Copy the memory's messages, JSON-serializable data and notes into the checkpoint. """
+        self.messages = [{"name": message.name, "content": message.content}
+                         for message in memory.data.get_all_messages()]
+        self.data = {}
+        for key, value in memory.data.items():
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                logger.debug(f"Skipping non-serializable data key in checkpoint: {key}")
+                continue
+            self.data[key] = value
+        self.notes = list(memory.scratch_pad.get())
+        self.updated_at = time.time()
+
+    def restore(self, memory: Memory):
+        """ Load the checkpoint into a memory, keeping any live data keys the checkpoint couldn't hold. """
+        memory.data.update(self.data)
+        memory.data.clear_messages()
+        for message in self.messages:
+            memory.data.add_message(Message(name=message["name"], content=message["content"]))
+        memory.scratch_pad.clear()
+        for note in self.notes:
+            memory.scratch_pad.set(note)
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, payload: str) -> "Checkpoint":
+        return cls(**json.loads(payload))
+
+
+class CheckpointStore(ABC):
+
+    @abstractmethod
+    def save(self, checkpoint: Checkpoint):
+        pass
+
+    @abstractmethod
+    def load(self, query_id: str) -> Optional[Checkpoint]:
+        pass
+
+    @abstractmethod
+    def delete(self, query_id: str):
+        pass
+
+    @abstractmethod
+    def list_runs(self) -> List[str]:
+        """ Return the query ids of runs that have a checkpoint and haven't finished. """
+        pass
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+    """ Keeps the latest checkpoint per run in a local SQLite database. """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                "query_id TEXT PRIMARY KEY, payload TEXT NOT NULL, updated_at REAL NOT NULL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared across threads, so each worker gets its own.
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def save(self, checkpoint: Checkpoint):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT INTO checkpoints (query_id, payload, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(query_id) DO UPDATE SET payload = excluded.payload, updated_at = excluded.updated_at",
+                (checkpoint.query_id, checkpoint.to_json(), checkpoint.updated_at))
+
+    def load(self, query_id: str) -> Optional[Checkpoint]:
+        row = self._connection().execute(
+            "SELECT payload FROM checkpoints WHERE query_id = ?", (query_id,)).fetchone()
+        return Checkpoint.from_json(row[0]) if row is not None else None
+
+    def delete(self, query_id: str):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM checkpoints WHERE query_id = ?", (query_id,))
+
+    def list_runs(self) -> List[str]:
+        rows = self._connection().execute("SELECT query_id FROM checkpoints ORDER BY updated_at").fetchall()
+        return [row[0] for row in rows]
+
+
+class FileCheckpointStore(CheckpointStore):
+    """ Appends each checkpoint as a JSON line to a per-run file; the last complete line wins on load. """
+
+    def __init__(self, directory: str, fsync: bool = False):
+        self.directory = directory
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, query_id: str) -> str:
+        # Query ids come from callers, so they're hashed rather than trusted as file names.
+        return os.path.join(self.directory, hashlib.sha1(query_id.encode("utf-8")).hexdigest() + ".jsonl")
+
+    def save(self, checkpoint: Checkpoint):
+        with open(self._path(checkpoint.query_id), "a", encoding="utf-8") as f:
+            f.write(checkpoint.to_json() + "\n")
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def load(self, query_id: str) -> Optional[Checkpoint]:
+        path = self._path(query_id)
+        if not os.path.exists(path):
+            return None
+        return self._read(path)
+
+    @staticmethod
+    def _read(path: str) -> Optional[Checkpoint]:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        for line in reversed(lines):
+            try:
+                return Checkpoint.from_json(line)
+            except (ValueError, TypeError):
+                # A crash mid-write leaves a torn last line, fall back to the one before it.
+                logger.warning(f"Skipping unreadable checkpoint line in {path}.")
+        return None
+
+    def delete(self, query_id: str):
+        path = self._path(query_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def list_runs(self) -> List[str]:
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".jsonl")]
+        paths.sort(key=os.path.getmtime)
+        # File names are hashes, so the query ids come from the checkpoints themselves.
+        checkpoints = [self._read(path) for path in paths]
+        return [checkpoint.query_id for checkpoint in checkpoints if checkpoint is not None]
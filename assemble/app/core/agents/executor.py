@@ -0,0 +1,162 @@
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from pykka import ThreadingFuture
+
+logger = logging.getLogger(__name__)
+
+
+class AgentOverloadedException(Exception):
+    """ Raised on a query's future when the agent's pending queue is full. """
+    pass
+
+
+@dataclass
+class ExecutorStats:
+    max_concurrency: int
+    max_pending: int
+    active: int
+    queue_depth: int
+    submitted: int
+    completed: int
+    rejected: int
+    avg_wait_seconds: float
+    max_wait_seconds: float
+    last_wait_seconds: float
+
+
+@dataclass
+class _Task:
+    func: Callable[[], None]
+    enqueued_at: float
+
+
+class BoundedExecutor:
+    """ Runs tasks on a fixed number of worker threads fed by a bounded pending queue. """
+
+    def __init__(self, max_concurrency: int = 1, max_pending: int = 64, name: str = "agent"):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1.")
+        if max_pending < 0:
+            raise ValueError("max_pending cannot be negative.")
+
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.name = name
+        self._queue: queue.Queue[Optional[_Task]] = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers: List[threading.Thread] = []
+        self._idle_workers = 0
+        self._pending = 0
+        self._active = 0
+        self._submitted = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._last_wait = 0.0
+        self._shutdown = False
+
+    def submit(self, func: Callable[[], None]) -> bool:
+        """ Queue a task, returning False if it was rejected because the pending queue is full. """
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError(f"Executor {self.name} has been shut down.")
+
+            if self._idle_workers <= self._pending and len(self._workers) < self.max_concurrency:
+                worker = threading.Thread(target=self._work, name=f"{self.name}-worker-{len(self._workers)}",
+                                          daemon=True)
+                self._workers.append(worker)
+                self._idle_workers += 1
+                worker.start()
+
+            # Tasks that an idle worker will pick up immediately don't count against the pending limit.
+            if self._pending >= self._idle_workers + self.max_pending:
+                self._rejected += 1
+                return False
+
+            self._pending += 1
+            self._submitted += 1
+            self._queue.put(_Task(func=func, enqueued_at=time.monotonic()))
+            return True
+
+    def submit_future(self,
+                      func: Callable[[], object],
+                      on_reject: Optional[Callable[[], None]] = None) -> ThreadingFuture:
+        """ Queue a task and return a future for its result, failing it with AgentOverloadedException if full. """
+        future = ThreadingFuture()
+
+        def task():
+            try:
+                future.set(func())
+            except Exception:
+                future.set_exception()
+
+        if not self.submit(task):
+            logger.warning(f"Executor {self.name} rejected task, pending queue is full.")
+            if on_reject is not None:
+                on_reject()
+            try:
+                raise AgentOverloadedException(
+                    f"Executor {self.name} is at capacity: {self.max_concurrency} running and {self.max_pending} "
+                    f"pending.")
+            except AgentOverloadedException:
+                future.set_exception()
+        return future
+
+    def stats(self) -> ExecutorStats:
+        with self._lock:
+            return ExecutorStats(
+                max_concurrency=self.max_concurrency,
+                max_pending=self.max_pending,
+                active=self._active,
+                queue_depth=max(self._pending - self._idle_workers, 0),
+                submitted=self._submitted,
+                completed=self._completed,
+                rejected=self._rejected,
+                avg_wait_seconds=self._total_wait / self._completed if self._completed else 0.0,
+                max_wait_seconds=self._max_wait,
+                last_wait_seconds=self._last_wait,
+            )
+
+    def shutdown(self, wait: bool = False):
+        """ Stop accepting tasks; queued tasks still run before the workers exit. """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            workers = list(self._workers)
+        for _ in workers:
+            self._queue.put(None)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+
+            wait = time.monotonic() - task.enqueued_at
+            with self._lock:
+                self._pending -= 1
+                self._idle_workers -= 1
+                self._active += 1
+                self._last_wait = wait
+                self._max_wait = max(self._max_wait, wait)
+
+            try:
+                task.func()
+            except Exception as e:
+                logger.error(f"Unhandled error in executor {self.name}: {e}")
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._idle_workers += 1
+                    self._completed += 1
+                    self._total_wait += wait
@@ -0,0 +1,451 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, List, Any, Optional, Callable, Iterator
+
+from pydantic import BaseModel
+
+from assemble.app.core import metrics
+from assemble.app.core.agents.checkpoint import Checkpoint, CheckpointStore
+from assemble.app.core.cancellation import CancellationToken, bind_token, check_cancelled, current_token
+from assemble.app.core.memory.memory import Memory, Message
+from assemble.app.core.memory.sessions import SessionStore
+from assemble.app.core.persona import Persona
+from assemble.app.core.states.base import StateBase, StateResponse, FAN_OUT_RESULTS_KEY
+from assemble.app.core.states.states import SystemStates
+from assemble.app.core.types import Usage
+
+logger = logging.getLogger(__name__)
+
+
+class Step(BaseModel):
+    state_name: str
+    next_state: str
+    prompt: Optional[str] = None
+    output: Optional[str] = None
+    token_usage: Optional[Usage] = None
+
+
+class Response(BaseModel):
+    final_output: str
+    metadata: Dict[str, Any]
+
+
+class StateMachine:
+    """ Drives an agent's states from an initial state to exit, shared by the actor and asyncio runtimes. """
+    name: str
+    description: str
+
+    def __init__(self,
+                 persona: Persona,
+                 memory: Memory,
+                 states: List[StateBase],
+                 default_initial_state: str,
+                 step_limit_state_name: str,
+                 clear_scratch_pad_after_answer: bool = False,
+                 clear_data_after_answer: bool = False,
+                 step_limit: int = 10,
+                 memory_factory: Optional[Callable[[], Memory]] = None,
+                 max_sessions: int = 1024,
+                 session_idle_ttl: Optional[float] = None,
+                 session_spill_dir: Optional[str] = None,
+                 metrics_sink: Optional[metrics.MetricsSink] = None,
+                 checkpoint_store: Optional[CheckpointStore] = None,
+                 max_fan_out: int = 8):
+        if len(states) == 0:
+            raise ValueError("At least one state must be provided.")
+        if max_fan_out < 1:
+            raise ValueError("max_fan_out must be at least 1.")
+
+        self.persona: Persona = persona
+        self.memory: Memory = memory
+        self.sessions: SessionStore = SessionStore(
+            memory_factory=memory_factory if memory_factory is not None else Memory,
+            max_sessions=max_sessions,
+            idle_ttl=session_idle_ttl,
+            spill_dir=session_spill_dir
+        )
+        self.states: Dict[str, StateBase] = {
+            state.name: state
+            for state in states
+        }
+        self.current_state: str = SystemStates.IDLE.value
+        self.default_initial_state: str = default_initial_state
+        self.clear_scratch_pad_after_answer: bool = clear_scratch_pad_after_answer
+        self.clear_data_after_answer: bool = clear_data_after_answer
+        self.step_limit: int = step_limit
+        self.step_limit_state_name: str = step_limit_state_name
+        # Falls back to the process-wide default sink when None.
+        self.metrics_sink: Optional[metrics.MetricsSink] = metrics_sink
+        # Checkpoints each completed step of a run so it can be resumed after a restart.
+        self.checkpoint_store: Optional[CheckpointStore] = checkpoint_store
+        # Upper bound on fan-out branches running at once across all of the agent's runs.
+        self.max_fan_out: int = max_fan_out
+        self._fan_out_pool: Optional[ThreadPoolExecutor] = None
+        self._fan_out_pool_lock = threading.Lock()
+
+    @property
+    def _label(self) -> str:
+        return f"{self.__class__.__name__}:{getattr(self, 'actor_urn', id(self))}"
+
+    def _run(self,
+             goal: str,
+             from_caller: str,
+             memory: Memory,
+             initial_state: str = None,
+             on_step: Optional[Callable[[Step], None]] = None,
+             on_token: Optional[Callable[[str, str], None]] = None,
+             on_retry: Optional[Callable[[str], None]] = None,
+             query_id: Optional[str] = None,
+             session_id: Optional[str] = None) -> List[Step]:
+        initial_state = self._begin_run(goal, from_caller, memory, initial_state)
+        checkpoint = self._new_checkpoint(goal, from_caller, initial_state, query_id, session_id)
+        return self._drive(memory, [], initial_state, initial_state, on_step, on_token, on_retry, checkpoint)
+
+    def _resume(self,
+                checkpoint: Checkpoint,
+                memory: Memory,
+                on_step: Optional[Callable[[Step], None]] = None,
+                on_token: Optional[Callable[[str, str], None]] = None,
+                on_retry: Optional[Callable[[str], None]] = None) -> List[Step]:
+        steps = self._begin_resume(checkpoint, memory)
+        return self._drive(memory, steps, checkpoint.current_state, checkpoint.initial_state, on_step, on_token,
+                           on_retry, checkpoint)
+
+    def _drive(self,
+               memory: Memory,
+               steps: List[Step],
+               current_state: str,
+               initial_state: str,
+               on_step: Optional[Callable[[Step], None]],
+               on_token: Optional[Callable[[str, str], None]],
+               on_retry: Optional[Callable[[str], None]],
+               checkpoint: Optional[Checkpoint]) -> List[Step]:
+        while current_state in self.states:
+            check_cancelled()
+            state = self._resolve_state(current_state, len(steps))
+            with self._state_metrics(state):
+                response = state.execute(self.persona, memory, on_token=self._token_callback(state, on_token),
+                                         on_retry=self._retry_callback(state, on_retry))
+            emitted = len(steps)
+            current_state = self._complete_step(state, response, memory, steps)
+            branches = self._fan_out_states(state, response, current_state)
+            if branches:
+                self._join(branches, self._fan_out(branches, memory, on_token, on_retry), current_state, memory, steps)
+            memory.compact()
+            self._save_checkpoint(checkpoint, memory, steps, current_state)
+            for step in steps[emitted:]:
+                self._emit_step(step, on_step)
+
+        steps = self._end_run(memory, steps, initial_state)
+        self._finish_checkpoint(checkpoint)
+        return steps
+
+    async def _arun(self,
+                    goal: str,
+                    from_caller: str,
+                    memory: Memory,
+                    initial_state: str = None,
+                    on_step: Optional[Callable[[Step], None]] = None,
+                    on_token: Optional[Callable[[str, str], None]] = None,
+                    on_retry: Optional[Callable[[str], None]] = None,
+                    query_id: Optional[str] = None,
+                    session_id: Optional[str] = None) -> List[Step]:
+        initial_state = self._begin_run(goal, from_caller, memory, initial_state)
+        checkpoint = self._new_checkpoint(goal, from_caller, initial_state, query_id, session_id)
+        return await self._adrive(memory, [], initial_state, initial_state, on_step, on_token, on_retry,
+                                  checkpoint)
+
+    async def _aresume(self,
+                       checkpoint: Checkpoint,
+                       memory: Memory,
+                       on_step: Optional[Callable[[Step], None]] = None,
+                       on_token: Optional[Callable[[str, str], None]] = None,
+                       on_retry: Optional[Callable[[str], None]] = None) -> List[Step]:
+        steps = self._begin_resume(checkpoint, memory)
+        return await self._adrive(memory, steps, checkpoint.current_state, checkpoint.initial_state, on_step,
+                                  on_token, on_retry, checkpoint)
+
+    async def _adrive(self,
+                      memory: Memory,
+                      steps: List[Step],
+                      current_state: str,
+                      initial_state: str,
+                      on_step: Optional[Callable[[Step], None]],
+                      on_token: Optional[Callable[[str, str], None]],
+                      on_retry: Optional[Callable[[str], None]],
+                      checkpoint: Optional[Checkpoint]) -> List[Step]:
+        while current_state in self.states:
+            check_cancelled()
+            state = self._resolve_state(current_state, len(steps))
+            with self._state_metrics(state):
+                response = await state.aexecute(self.persona, memory,
+                                                on_token=self._token_callback(state, on_token),
+                                                on_retry=self._retry_callback(state, on_retry))
+            emitted = len(steps)
+            current_state = self._complete_step(state, response, memory, steps)
+            branches = self._fan_out_states(state, response, current_state)
+            if branches:
+                responses = await self._afan_out(branches, memory, on_token, on_retry)
+                self._join(branches, responses, current_state, memory, steps)
+            await memory.acompact()
+            if checkpoint is not None:
+                await asyncio.to_thread(self._save_checkpoint, checkpoint, memory, steps, current_state)
+            for step in steps[emitted:]:
+                self._emit_step(step, on_step)
+
+        steps = self._end_run(memory, steps, initial_state)
+        if checkpoint is not None:
+            await asyncio.to_thread(self._finish_checkpoint, checkpoint)
+        return steps
+
+    def _fan_out(self,
+                 branches: List[StateBase],
+                 memory: Memory,
+                 on_token: Optional[Callable[[str, str], None]],
+                 on_retry: Optional[Callable[[str], None]]) -> List[StateResponse]:
+        """ Run the branch states concurrently on the agent's pool, returning their responses in branch order. """
+        pool = self._fan_out_executor()
+        # Branches share a child of the run's token, so a failed branch can stop its siblings like a TaskGroup does.
+        parent = current_token()
+        token = parent.child() if parent is not None else CancellationToken()
+
+        def run_branch(state: StateBase) -> StateResponse:
+            with bind_token(token), self._state_metrics(state):
+                return state.execute(self.persona, memory, on_token=self._token_callback(state, on_token),
+                                     on_retry=self._retry_callback(state, on_retry))
+
+        # Each branch gets its own copy of the context so the run's cancellation token and metrics tags follow it.
+        futures = [pool.submit(contextvars.copy_context().run, run_branch, state) for state in branches]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            token.cancel("A sibling fan-out branch failed.")
+            for future in futures:
+                future.cancel()
+            # Wait for running branches to stop so none of them writes to memory after the step has failed.
+            concurrent.futures.wait(futures)
+            raise
+
+    async def _afan_out(self,
+                        branches: List[StateBase],
+                        memory: Memory,
+                        on_token: Optional[Callable[[str, str], None]],
+                        on_retry: Optional[Callable[[str], None]]) -> List[StateResponse]:
+        async def run_branch(state: StateBase) -> StateResponse:
+            with self._state_metrics(state):
+                return await state.aexecute(self.persona, memory, on_token=self._token_callback(state, on_token),
+                                            on_retry=self._retry_callback(state, on_retry))
+
+        try:
+            async with asyncio.TaskGroup() as group:
+                tasks = [group.create_task(run_branch(state)) for state in branches]
+        except ExceptionGroup as e:
+            # The group cancels the remaining branches; surface the first failure like a sequential run would.
+            raise e.exceptions[0]
+        return [task.result() for task in tasks]
+
+    def _fan_out_executor(self) -> ThreadPoolExecutor:
+        with self._fan_out_pool_lock:
+            if self._fan_out_pool is None:
+                self._fan_out_pool = ThreadPoolExecutor(max_workers=self.max_fan_out,
+                                                        thread_name_prefix=f"{self.__class__.__name__}-fan-out")
+            return self._fan_out_pool
+
+    def shutdown_fan_out(self):
+        """ Release the fan-out pool's threads; a later fan-out starts a new pool. """
+        with self._fan_out_pool_lock:
+            pool, self._fan_out_pool = self._fan_out_pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _fan_out_states(self, state: StateBase, response: StateResponse, join_state: str) -> List[StateBase]:
+        """ Return the branch states a response fans out to, validating them before any of them run. """
+        if not response.parallel_states or join_state == SystemStates.EXIT.value:
+            return []
+        missing = [name for name in response.parallel_states if name not in self.states]
+        if missing:
+            raise ValueError(
+                f"Invalid fan-out from: {state.name}. Missing state nodes for parallel states {missing}.")
+
+        logger.info(f"Agent {self._label} fanning out to states {response.parallel_states}, joining at: {join_state}")
+        return [self.states[name] for name in response.parallel_states]
+
+    @staticmethod
+    def _join(branches: List[StateBase],
+              responses: List[StateResponse],
+              join_state: str,
+              memory: Memory,
+              steps: List[Step]):
+        """ Record the branch responses in branch order and hand their outputs to the join state. """
+        results: Dict[str, Optional[str]] = {}
+        for state, response in zip(branches, responses):
+            if response is None:
+                raise ValueError(f"Invalid state transition from fan-out branch: {state.name}.")
+            memory.scratch_pad.set(f"{state.name.upper()}: {response.response}")
+            results[state.name] = response.response
+            steps.append(
+                Step(
+                    state_name=f"{state.name}",
+                    prompt=response.prompt,
+                    output=response.response,
+                    next_state=f"{join_state}",
+                    token_usage=response.token_usage
+                )
+            )
+        memory.data.set(FAN_OUT_RESULTS_KEY, results)
+
+    def load_checkpoint(self, query_id: str) -> Checkpoint:
+        """ Return the last checkpoint of an unfinished run, raising ValueError if there is none. """
+        if self.checkpoint_store is None:
+            raise ValueError(f"Agent {self._label} has no checkpoint store to resume from.")
+        checkpoint = self.checkpoint_store.load(query_id)
+        if checkpoint is None:
+            raise ValueError(f"Agent {self._label} has no checkpoint for query {query_id}.")
+        return checkpoint
+
+    def _new_checkpoint(self,
+                        goal: str,
+                        from_caller: str,
+                        initial_state: str,
+                        query_id: Optional[str],
+                        session_id: Optional[str]) -> Optional[Checkpoint]:
+        if self.checkpoint_store is None or query_id is None:
+            return None
+        return Checkpoint(
+            query_id=query_id,
+            goal=goal,
+            from_caller=from_caller,
+            initial_state=initial_state,
+            current_state=initial_state,
+            session_id=session_id
+        )
+
+    def _begin_resume(self, checkpoint: Checkpoint, memory: Memory) -> List[Step]:
+        logger.info(f"Agent {self._label} resuming query {checkpoint.query_id} at state: {checkpoint.current_state}")
+        checkpoint.restore(memory)
+        self.current_state = checkpoint.current_state
+        return [Step(**step) for step in checkpoint.steps]
+
+    def _save_checkpoint(self, checkpoint: Optional[Checkpoint], memory: Memory, steps: List[Step], current_state: str):
+        if checkpoint is None:
+            return
+        checkpoint.current_state = current_state
+        checkpoint.steps = [step.model_dump() for step in steps]
+        checkpoint.capture(memory)
+        self.checkpoint_store.save(checkpoint)
+
+    def _finish_checkpoint(self, checkpoint: Optional[Checkpoint]):
+        if checkpoint is not None:
+            self.checkpoint_store.delete(checkpoint.query_id)
+
+    def _bind_metrics(self):
+        """ Bind the agent's sink and tag for the duration of a run. """
+        return metrics.bind_metrics(self.metrics_sink, agent=self.__class__.__name__)
+
+    @staticmethod
+    @contextmanager
+    def _state_metrics(state: StateBase) -> Iterator[None]:
+        with metrics.bind_metrics(state=getattr(state.name, "value", state.name)):
+            with metrics.timed("state.duration_seconds"):
+                yield
+
+    @staticmethod
+    def _token_callback(state: StateBase,
+                        on_token: Optional[Callable[[str, str], None]]) -> Optional[Callable[[str], None]]:
+        if on_token is None or not state.stream_tokens:
+            return None
+
+        def callback(token: str):
+            try:
+                on_token(state.name, token)
+            except Exception as e:
+                logger.error(f"Token callback failed for state {state.name}: {e}")
+
+        return callback
+
+    @staticmethod
+    def _retry_callback(state: StateBase,
+                        on_retry: Optional[Callable[[str], None]]) -> Optional[Callable[[], None]]:
+        if on_retry is None or not state.stream_tokens:
+            return None
+
+        def callback():
+            try:
+                on_retry(state.name)
+            except Exception as e:
+                logger.error(f"Retry callback failed for state {state.name}: {e}")
+
+        return callback
+
+    def _emit_step(self, step: Step, on_step: Optional[Callable[[Step], None]]):
+        if on_step is None:
+            return
+        try:
+            on_step(step)
+        except Exception as e:
+            logger.error(f"Step callback failed for agent {self._label}: {e}")
+
+    def _begin_run(self, goal: str, from_caller: str, memory: Memory, initial_state: Optional[str]) -> str:
+        if initial_state is None:
+            initial_state = self.default_initial_state
+        self.current_state = initial_state
+        memory.data.add_message(Message(name=from_caller, content=goal))
+        return initial_state
+
+    def _resolve_state(self, current_state: str, step_count: int) -> StateBase:
+        if step_count > self.step_limit:
+            current_state = self.step_limit_state_name
+            self.current_state = current_state
+
+        logger.info(f"Agent {self._label} executing state: {current_state}")
+        return self.states[current_state]
+
+    def _complete_step(self, state: StateBase, response: StateResponse, memory: Memory, steps: List[Step]) -> str:
+        """ Record a state's response and return the name of the state to run next. """
+        if response is None:
+            raise ValueError(
+                f"Invalid state transition from: {state.name}.")
+
+        memory.scratch_pad.set(f"{state.name.upper()}: {response.response}")
+
+        next_state = response.next_state
+        if state.name == self.step_limit_state_name:
+            next_state = SystemStates.EXIT.value
+
+        self.current_state = next_state
+        if next_state != SystemStates.EXIT.value and not self.states[next_state]:
+            raise ValueError(
+                f"Invalid state transition: {state.name} -> {response.next_state}. Missing "
+                f"state node for next state of {next_state}.")
+
+        steps.append(
+            Step(
+                state_name=f"{state.name}",
+                prompt=response.prompt,
+                output=response.response,
+                next_state=f"{next_state}",
+                token_usage=response.token_usage
+            )
+        )
+        return next_state
+
+    def _end_run(self, memory: Memory, steps: List[Step], initial_state: str) -> List[Step]:
+        if self.clear_scratch_pad_after_answer:
+            memory.reset_scratch_pad()
+            logger.info(f"Agent {self._label} cleared scratch pad.")
+        elif self.clear_data_after_answer:
+            memory.reset_data()
+            logger.info(f"Agent {self._label} cleared data.")
+
+        if len(steps) == 0:
+            raise ValueError(f"Agent {self._label} failed to execute, initial state "
+                             f"{initial_state} not found.")
+
+        memory.data.add_message(Message(name=self.__class__.__name__, content=steps[-1].output))
+        logger.info(f"Agent {self._label} finished execution.")
+        return steps
@@ -0,0 +1,87 @@
+import dataclasses
+import enum
+import queue
+from dataclasses import dataclass
+from typing import Optional, Iterator, Callable
+
+import pykka
+from pykka import ActorRef, Future
+
+from assemble.app.core.agents.machine import Step, Response
+from assemble.app.core.messages import Query
+
+
+class StreamEventType(str, enum.Enum):
+    TOKEN = "token"
+    # The state is retrying, so the tokens it streamed since its last step should be discarded.
+    RETRY = "retry"
+    STEP = "step"
+    RESPONSE = "response"
+
+
+@dataclass
+class StreamEvent:
+    type: StreamEventType
+    state_name: Optional[str] = None
+    token: Optional[str] = None
+    step: Optional[Step] = None
+    response: Optional[Response] = None
+
+
+def with_stream_callbacks(query: Query, emit: Callable[[StreamEvent], None]) -> Query:
+    """ Return a copy of the query whose callbacks also emit stream events, keeping any callbacks already set. """
+    on_step, on_token, on_retry = query.on_step, query.on_token, query.on_retry
+
+    def stream_step(step: Step):
+        emit(StreamEvent(type=StreamEventType.STEP, state_name=step.state_name, step=step))
+        if on_step is not None:
+            on_step(step)
+
+    def stream_token(state_name: str, token: str):
+        emit(StreamEvent(type=StreamEventType.TOKEN, state_name=state_name, token=token))
+        if on_token is not None:
+            on_token(state_name, token)
+
+    def stream_retry(state_name: str):
+        emit(StreamEvent(type=StreamEventType.RETRY, state_name=state_name))
+        if on_retry is not None:
+            on_retry(state_name)
+
+    return dataclasses.replace(query, on_step=stream_step, on_token=stream_token, on_retry=stream_retry)
+
+
+class ResponseStream:
+    """ Iterates over a query's tokens and steps as they're produced, ending with its Response. """
+
+    def __init__(self, poll_interval: float = 0.05):
+        self.poll_interval = poll_interval
+        self._events: queue.Queue = queue.Queue()
+        self._future: Optional[Future] = None
+
+    @classmethod
+    def ask(cls, agent: ActorRef, query: Query, poll_interval: float = 0.05) -> "ResponseStream":
+        stream = cls(poll_interval=poll_interval)
+        stream._future = agent.ask(with_stream_callbacks(query, stream._events.put))
+        return stream
+
+    def __iter__(self) -> Iterator[StreamEvent]:
+        if self._future is None:
+            raise ValueError("ResponseStream must be created with ResponseStream.ask.")
+
+        while True:
+            try:
+                yield self._events.get(timeout=self.poll_interval)
+                continue
+            except queue.Empty:
+                pass
+
+            try:
+                response = self._future.get(timeout=0)
+            except pykka.Timeout:
+                continue
+
+            # Callbacks run before the future resolves, so anything left in the queue precedes the response.
+            while not self._events.empty():
+                yield self._events.get_nowait()
+            yield StreamEvent(type=StreamEventType.RESPONSE, response=response)
+            return
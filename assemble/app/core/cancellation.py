@@ -0,0 +1,102 @@
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Iterator
+
+
+class RunCancelledException(Exception):
+    """ Raised inside a run once it has been cancelled. """
+    pass
+
+
+class DeadlineExceededException(RunCancelledException):
+    """ Raised inside a run once its deadline has passed. """
+    pass
+
+
+class CancellationToken:
+    """ Cooperative cancellation flag with an optional deadline, checked at safe points during a run. """
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.deadline: Optional[float] = time.monotonic() + timeout if timeout is not None else None
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+        self._children: "weakref.WeakSet[CancellationToken]" = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def child(self) -> "CancellationToken":
+        """ A token with the same deadline that's cancelled along with this one, but can also be cancelled alone. """
+        child = CancellationToken()
+        child.deadline = self.deadline
+        with self._lock:
+            self._children.add(child)
+            cancelled = self.cancelled
+        if cancelled:
+            child.cancel(self.reason)
+        return child
+
+    def cancel(self, reason: str = "Run was cancelled."):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            children = list(self._children)
+        for child in children:
+            child.cancel(reason)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self) -> Optional[float]:
+        """ Seconds left before the deadline, or None if there isn't one. """
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def check(self):
+        """ Raise if the run has been cancelled or its deadline has passed. """
+        if self.cancelled:
+            raise RunCancelledException(self.reason)
+        if self.expired:
+            raise DeadlineExceededException("Run exceeded its deadline.")
+
+    def sleep(self, seconds: float):
+        """ Sleep like time.sleep, but wake and raise as soon as the run is cancelled or expires. """
+        remaining = self.remaining()
+        if remaining is not None and remaining < seconds:
+            self._event.wait(remaining)
+        else:
+            self._event.wait(seconds)
+        self.check()
+
+
+_current_token: ContextVar[Optional[CancellationToken]] = ContextVar("cancellation_token", default=None)
+
+
+def current_token() -> Optional[CancellationToken]:
+    return _current_token.get()
+
+
+def check_cancelled():
+    """ Raise if the run bound to the current context has been cancelled or has expired. """
+    token = _current_token.get()
+    if token is not None:
+        token.check()
+
+
+@contextmanager
+def bind_token(token: Optional[CancellationToken]) -> Iterator[Optional[CancellationToken]]:
+    """ Make a token the current one for the enclosed run, including worker threads it spawns via to_thread. """
+    reset = _current_token.set(token)
+    try:
+        yield token
+    finally:
+        _current_token.reset(reset)
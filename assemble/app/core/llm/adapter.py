@@ -1,17 +1,50 @@
+import asyncio
 from abc import ABC, abstractmethod
-from typing import Tuple, Dict, List
+from typing import Tuple, Dict, List, Callable, Optional
+
+from assemble.app.core.retry import Failure
 
 
 class LLMAdapter(ABC):
+    # Whether generate and stream accept a json_schema kwarg and constrain the response to it.
+    supports_json_schema: bool = False
 
     @abstractmethod
     def generate(self, prompt: str, **backend_kwargs) -> Tuple[str, Dict[str, int]]:
         pass
 
+    async def agenerate(self, prompt: str, **backend_kwargs) -> Tuple[str, Dict[str, int]]:
+        """ Generate without blocking the event loop; backends with a native async client should override this. """
+        return await asyncio.to_thread(self.generate, prompt, **backend_kwargs)
+
+    def stream(self,
+               prompt: str,
+               on_token: Callable[[str], Optional[bool]],
+               **backend_kwargs) -> Tuple[str, Dict[str, int]]:
+        """ Stream tokens to on_token, stopping early if it returns True; this default emits the response once. """
+        response, usage = self.generate(prompt, **backend_kwargs)
+        on_token(response)
+        return response, usage
+
+    async def astream(self,
+                      prompt: str,
+                      on_token: Callable[[str], Optional[bool]],
+                      **backend_kwargs) -> Tuple[str, Dict[str, int]]:
+        """ Async variant of stream; on_token may be called from a worker thread. """
+        return await asyncio.to_thread(self.stream, prompt, on_token, **backend_kwargs)
+
     @abstractmethod
     def tokenize(self, text: str) -> List[int]:
         pass
 
+    def classify_error(self, error: BaseException) -> Optional[Failure]:
+        """ Classify an error raised by the backend's client for retries; None falls back to the generic rules. """
+        return None
+
+    def count_tokens(self, text: str) -> int:
+        """ Count the tokens in a piece of a prompt; backends should leave out special tokens added per call. """
+        return len(self.tokenize(text))
+
     @abstractmethod
     def context_length(self) -> int:
         pass
@@ -0,0 +1,204 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from assemble.app.core import metrics
+from assemble.app.core.llm.adapter import LLMAdapter
+
+logger = logging.getLogger(__name__)
+
+CachedGeneration = Tuple[str, Dict[str, int]]
+
+
+@dataclass
+class CacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    bypassed: int = 0
+    evictions: int = 0
+    disk_bytes: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+
+
+class ResponseCache:
+    """ Two-tier cache of generations: an in-memory LRU in front of an optional size-bounded SQLite database. """
+
+    def __init__(self,
+                 max_entries: int = 1024,
+                 path: Optional[str] = None,
+                 max_disk_bytes: int = 64 * 1024 * 1024,
+                 max_temperature: float = 0.2):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1.")
+
+        self.max_entries = max_entries
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        # Generations sampled above this temperature, or without an explicit one, are too random to replay.
+        self.max_temperature = max_temperature
+        self._entries: OrderedDict[str, CachedGeneration] = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = CacheStats()
+        self._local = threading.local()
+        if path is not None:
+            with self._connection() as connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, response TEXT NOT NULL, usage TEXT NOT NULL, size INTEGER NOT NULL, "
+                    "accessed_at REAL NOT NULL)")
+                connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+                row = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+                self._stats.disk_bytes = row[0]
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def key(self,
+            service: LLMAdapter,
+            prompt: str,
+            backend_kwargs: Dict[str, Any],
+            count_bypass: bool = True) -> Optional[str]:
+        """ Return the cache key for a generation, or None if its sampling settings make it uncacheable; count_bypass
+        is off for lookups that aren't generations, so they don't count as bypasses. """
+        temperature = backend_kwargs.get("temperature")
+        if temperature is None or temperature > self.max_temperature:
+            if count_bypass:
+                with self._lock:
+                    self._stats.bypassed += 1
+            return None
+
+        backend = f"{service.__class__.__name__}:{getattr(service, 'model', '')}"
+        payload = json.dumps([backend, prompt, backend_kwargs], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[CachedGeneration]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats.memory_hits += 1
+        if entry is not None:
+            metrics.increment("llm.cache_hits", tier="memory")
+            return entry
+
+        entry = self._load(key) if self.path is not None else None
+        if entry is None:
+            with self._lock:
+                self._stats.misses += 1
+            metrics.increment("llm.cache_misses")
+            return None
+
+        with self._lock:
+            self._stats.disk_hits += 1
+            self._remember(key, entry)
+        metrics.increment("llm.cache_hits", tier="disk")
+        return entry
+
+    def put(self, key: str, response: str, usage: Dict[str, int]):
+        with self._lock:
+            self._remember(key, (response, usage))
+        if self.path is not None:
+            self._store(key, response, usage)
+
+    def remove(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.path is not None:
+            with self._connection() as connection:
+                row = connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            if row is not None:
+                with self._lock:
+                    self._stats.disk_bytes -= row[0]
+
+    async def aget(self, key: str) -> Optional[CachedGeneration]:
+        """ Async variant of get; only the disk tier is read on a worker thread. """
+        with self._lock:
+            in_memory = key in self._entries
+        if in_memory or self.path is None:
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key: str, response: str, usage: Dict[str, int]):
+        if self.path is None:
+            self.put(key, response, usage)
+        else:
+            await asyncio.to_thread(self.put, key, response, usage)
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(**vars(self._stats))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stats.disk_bytes = 0
+        if self.path is not None:
+            with self._connection() as connection:
+                connection.execute("DELETE FROM responses")
+
+    def _remember(self, key: str, entry: CachedGeneration):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load(self, key: str) -> Optional[CachedGeneration]:
+        with self._connection() as connection:
+            row = connection.execute("SELECT response, usage FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return row[0], json.loads(row[1])
+
+    def _store(self, key: str, response: str, usage: Dict[str, int]):
+        encoded_usage = json.dumps(usage)
+        size = len(key) + len(response.encode("utf-8")) + len(encoded_usage)
+        if size > self.max_disk_bytes:
+            logger.debug(f"Skipping disk cache for a {size} byte response, it exceeds the cache size.")
+            return
+
+        with self._connection() as connection:
+            previous = connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            connection.execute(
+                "INSERT INTO responses (key, response, usage, size, accessed_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET response = excluded.response, usage = excluded.usage, "
+                "size = excluded.size, accessed_at = excluded.accessed_at",
+                (key, response, encoded_usage, size, time.time()))
+            with self._lock:
+                self._stats.disk_bytes += size - (previous[0] if previous is not None else 0)
+                overflow = self._stats.disk_bytes - self.max_disk_bytes
+            if overflow > 0:
+                self._evict(connection, overflow)
+
+    def _evict(self, connection: sqlite3.Connection, overflow: int):
+        """ Delete the least recently used rows until at least overflow bytes are freed. """
+        freed, evicted = 0, []
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            if freed >= overflow:
+                break
+            evicted.append((key,))
+            freed += size
+        connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        with self._lock:
+            self._stats.disk_bytes -= freed
+            self._stats.evictions += len(evicted)
+        metrics.increment("llm.cache_evictions", len(evicted))
+        logger.debug(f"Evicted {len(evicted)} responses ({freed} bytes) from the disk cache.")
@@ -1,19 +1,152 @@
-from typing import Tuple
+from typing import Tuple, Callable, Optional, Dict, Type, Any
 
+from pydantic import BaseModel
+
+from assemble.app.core import metrics
+from assemble.app.core.cancellation import check_cancelled
 from assemble.app.core.llm.adapter import LLMAdapter
+from assemble.app.core.llm.cache import ResponseCache
+from assemble.app.core.llm.structured import JsonObjectStream, json_stop_callback
+from assemble.app.core.llm.tokens import token_counter
 from assemble.app.core.types import Usage
 
 
 class Generator:
-    def __init__(self, service: LLMAdapter, token_limit_buffer: int = 512, **backend_kwargs):
+    def __init__(self,
+                 service: LLMAdapter,
+                 token_limit_buffer: int = 512,
+                 cache: Optional[ResponseCache] = None,
+                 route: Optional[str] = None,
+                 escalate_to: Optional["Generator"] = None,
+                 **backend_kwargs):
         self.service = service
         self.backend_kwargs = backend_kwargs
         self.token_limit_buffer = token_limit_buffer
+        self.cache = cache
+        self.token_counter = token_counter(service)
+        # Name the generator's metrics are tagged with, so latency and token usage can be compared per route.
+        self.route = route
+        # A stronger generator a state retries with when this one's response fails to parse or validate.
+        self.escalate_to = escalate_to
+
+    def generate(self,
+                 prompt: str,
+                 on_token: Optional[Callable[[str], None]] = None,
+                 stop_at_json: bool = False,
+                 response_schema: Optional[Type[BaseModel]] = None,
+                 json_schema: Optional[Dict[str, Any]] = None) -> Tuple[str, Usage]:
+        """ Generate a response; with stop_at_json, decoding stops once a complete, schema-valid JSON object is out. """
+        check_cancelled()
+        backend_kwargs = self._backend_kwargs(json_schema)
+        key = self.cache.key(self.service, prompt, backend_kwargs) if self.cache is not None else None
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return self._cached(cached, on_token)
+
+        with metrics.timed("llm.latency_seconds", **self._tags):
+            if stop_at_json:
+                parser, callback = json_stop_callback(response_schema, on_token)
+                response, usage = self.service.stream(prompt, self._cancellable(callback), **backend_kwargs)
+                response = self._early_stopped(parser, response)
+            elif on_token is not None:
+                response, usage = self.service.stream(prompt, self._cancellable(on_token), **backend_kwargs)
+            else:
+                response, usage = self.service.generate(prompt, **backend_kwargs)
+        check_cancelled()
+        if key is not None:
+            self.cache.put(key, response, usage)
+        return response, self._usage(usage)
+
+    async def agenerate(self,
+                        prompt: str,
+                        on_token: Optional[Callable[[str], None]] = None,
+                        stop_at_json: bool = False,
+                        response_schema: Optional[Type[BaseModel]] = None,
+                        json_schema: Optional[Dict[str, Any]] = None) -> Tuple[str, Usage]:
+        check_cancelled()
+        backend_kwargs = self._backend_kwargs(json_schema)
+        key = self.cache.key(self.service, prompt, backend_kwargs) if self.cache is not None else None
+        if key is not None:
+            cached = await self.cache.aget(key)
+            if cached is not None:
+                return self._cached(cached, on_token)
+
+        with metrics.timed("llm.latency_seconds", **self._tags):
+            if stop_at_json:
+                parser, callback = json_stop_callback(response_schema, on_token)
+                response, usage = await self.service.astream(prompt, self._cancellable(callback),
+                                                             **backend_kwargs)
+                response = self._early_stopped(parser, response)
+            elif on_token is not None:
+                response, usage = await self.service.astream(prompt, self._cancellable(on_token),
+                                                             **backend_kwargs)
+            else:
+                response, usage = await self.service.agenerate(prompt, **backend_kwargs)
+        check_cancelled()
+        if key is not None:
+            await self.cache.aput(key, response, usage)
+        return response, self._usage(usage)
+
+    def invalidate(self, prompt: str, json_schema: Optional[Dict[str, Any]] = None):
+        """ Drop a prompt's cached response, e.g. once it has failed to parse, so a retry asks the backend again. """
+        if self.cache is None:
+            return
+        key = self.cache.key(self.service, prompt, self._backend_kwargs(json_schema), count_bypass=False)
+        if key is not None:
+            self.cache.remove(key)
+
+    def _backend_kwargs(self, json_schema: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """ Add the response's JSON schema for backends that can constrain decoding to it. """
+        if json_schema is None or not self.service.supports_json_schema:
+            return self.backend_kwargs
+        return {**self.backend_kwargs, "json_schema": json_schema}
+
+    @property
+    def _backend(self) -> str:
+        return self.service.__class__.__name__
+
+    @property
+    def _tags(self) -> Dict[str, str]:
+        if self.route is None:
+            return {"backend": self._backend}
+        return {"backend": self._backend, "route": self.route}
+
+    def _usage(self, usage: Dict[str, int]) -> Usage:
+        usage = Usage(**usage)
+        metrics.observe("llm.prompt_tokens", usage.prompt_tokens, **self._tags)
+        metrics.observe("llm.completion_tokens", usage.completion_tokens, **self._tags)
+        return usage
+
+    @staticmethod
+    def _cached(cached: Tuple[str, Dict[str, int]], on_token: Optional[Callable[[str], None]]) -> Tuple[str, Usage]:
+        """ Replay a cached generation; streaming callers get it as a single token, like a non-streaming backend. """
+        response, usage = cached
+        if on_token is not None:
+            on_token(response)
+        return response, Usage(**usage, cached=True)
+
+    def _early_stopped(self, parser: JsonObjectStream, response: str) -> str:
+        """ Trim the response to the JSON object decoding stopped at, if it stopped at one. """
+        if parser.result is None:
+            return response
+        metrics.increment("llm.early_stops", **self._tags)
+        return parser.result
+
+    @staticmethod
+    def _cancellable(on_token: Callable[[str], Optional[bool]]) -> Callable[[str], Optional[bool]]:
+        """ Check for cancellation on every streamed token so an abandoned run stops decoding mid-stream. """
+        def callback(token: str) -> Optional[bool]:
+            check_cancelled()
+            return on_token(token)
+
+        return callback
 
-    def generate(self, prompt: str) -> Tuple[str, Usage]:
-        response, usage = self.service.generate(prompt, **self.backend_kwargs)
-        return response, Usage(**usage)
+    def token_budget(self) -> int:
+        """ Tokens a prompt may use, leaving token_limit_buffer of the context for the response. """
+        return self.service.context_length() - self.token_limit_buffer
 
     def is_context_limit(self, prompt: str) -> bool:
-        tokenized = self.service.tokenize(prompt)
-        return len(tokenized) + self.token_limit_buffer > self.service.context_length()
+        with metrics.timed("llm.tokenize_seconds", **self._tags):
+            token_count = self.token_counter.count_prompt(prompt)
+        return token_count + self.token_limit_buffer > self.service.context_length()
@@ -0,0 +1,303 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import logging
+import math
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple, Deque
+
+from assemble.app.core import metrics
+from assemble.app.core.cancellation import RunCancelledException
+from assemble.app.core.llm.adapter import LLMAdapter
+from assemble.app.core.retry import Failure
+
+logger = logging.getLogger(__name__)
+
+Generation = Tuple[str, Dict[str, int]]
+
+
+@dataclass
+class HedgeStats:
+    requests: int = 0
+    # Requests that sent at least one duplicate to another backend.
+    hedged: int = 0
+    # Hedged requests a duplicate won rather than the primary.
+    hedge_wins: int = 0
+    failures: int = 0
+
+    @property
+    def hedge_rate(self) -> float:
+        return self.hedged / self.requests if self.requests else 0.0
+
+    @property
+    def hedge_win_rate(self) -> float:
+        return self.hedge_wins / self.hedged if self.hedged else 0.0
+
+
+class _StreamClaim:
+    """ Lets the first attempt to stream a token own the caller's on_token; the others are asked to stop. """
+
+    def __init__(self, on_token: Callable[[str], Optional[bool]]):
+        self.on_token = on_token
+        self.owner: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def claim(self, attempt: int) -> bool:
+        """ Claim the stream for an attempt unless another already has, returning whether the attempt owns it. """
+        with self._lock:
+            if self.owner is None:
+                self.owner = attempt
+            return self.owner == attempt
+
+    def callback(self, attempt: int) -> Callable[[str], Optional[bool]]:
+        def on_token(token: str) -> Optional[bool]:
+            if not self.claim(attempt):
+                return True
+            return self.on_token(token)
+
+        return on_token
+
+
+class HedgedLLMAdapter(LLMAdapter):
+    """ Sends a duplicate request to the next backend whenever the current ones are slower than usual. """
+
+    def __init__(self,
+                 backends: List[LLMAdapter],
+                 hedge_delay: Optional[float] = None,
+                 hedge_percentile: float = 95,
+                 initial_hedge_delay: float = 2.0,
+                 min_samples: int = 20,
+                 window: int = 512,
+                 max_workers: Optional[int] = None):
+        if len(backends) < 2:
+            raise ValueError("Hedging needs at least two backends.")
+
+        self.backends = backends
+        # A fixed delay, or None to hedge after the primary's observed hedge_percentile latency.
+        self.hedge_delay = hedge_delay
+        self.hedge_percentile = hedge_percentile
+        # Delay used until min_samples latencies have been observed.
+        self.initial_hedge_delay = initial_hedge_delay
+        self.min_samples = min_samples
+        # Threads running sync attempts; losers that can't be interrupted hold theirs until they finish.
+        self.max_workers = max_workers if max_workers is not None else 32 * len(backends)
+        self.supports_json_schema = all(backend.supports_json_schema for backend in backends)
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._stats = HedgeStats()
+        self._lock = threading.Lock()
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+    def stats(self) -> HedgeStats:
+        with self._lock:
+            return HedgeStats(**vars(self._stats))
+
+    def delay(self) -> float:
+        """ Seconds to wait on the running attempts before hedging to the next backend. """
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return self.initial_hedge_delay
+            latencies = sorted(self._latencies)
+        return latencies[min(math.ceil(self.hedge_percentile / 100 * len(latencies)), len(latencies)) - 1]
+
+    def close(self):
+        """ Stop the worker threads once running attempts finish. """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def generate(self, prompt: str, **backend_kwargs) -> Generation:
+        return self._hedge(lambda backend, _: backend.generate(prompt, **backend_kwargs))
+
+    def stream(self,
+               prompt: str,
+               on_token: Callable[[str], Optional[bool]],
+               **backend_kwargs) -> Generation:
+        claim = _StreamClaim(on_token)
+        return self._hedge(
+            lambda backend, attempt: backend.stream(prompt, claim.callback(attempt), **backend_kwargs), claim)
+
+    async def agenerate(self, prompt: str, **backend_kwargs) -> Generation:
+        return await self._ahedge(lambda backend, _: backend.agenerate(prompt, **backend_kwargs))
+
+    async def astream(self,
+                      prompt: str,
+                      on_token: Callable[[str], Optional[bool]],
+                      **backend_kwargs) -> Generation:
+        claim = _StreamClaim(on_token)
+        return await self._ahedge(
+            lambda backend, attempt: backend.astream(prompt, claim.callback(attempt), **backend_kwargs), claim)
+
+    def _hedge(self, call: Callable[[LLMAdapter, int], Generation], claim: Optional[_StreamClaim] = None) -> Generation:
+        pool = self._pool()
+        attempts: Dict[concurrent.futures.Future, int] = {}
+        started: List[threading.Event] = []
+        errors: List[BaseException] = []
+
+        def run(backend: LLMAdapter, attempt: int) -> Generation:
+            started[attempt].set()
+            if attempt == 0:
+                start = time.monotonic()
+                result = call(backend, attempt)
+                self._observe(time.monotonic() - start)
+                return result
+            return call(backend, attempt)
+
+        def launch() -> concurrent.futures.Future:
+            attempt = len(attempts)
+            started.append(threading.Event())
+            # Each attempt gets a copy of the context so the run's cancellation token and metrics tags follow it.
+            future = pool.submit(contextvars.copy_context().run, run, self.backends[attempt], attempt)
+            attempts[future] = attempt
+            return future
+
+        latest = launch()
+        pending = {latest}
+        while True:
+            can_hedge = len(attempts) < len(self.backends) and self._may_hedge(claim)
+            timeout = None
+            if can_hedge:
+                # Time spent queued for a worker isn't the backend being slow, so the delay runs from the start.
+                while not started[-1].wait(0.01) and not latest.done():
+                    pass
+                timeout = self.delay()
+            done, pending = concurrent.futures.wait(pending, timeout=timeout,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except RunCancelledException:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Backend {self._name(attempts[future])} failed during a hedged request: {e}")
+                    errors.append(e)
+                    if claim is not None and claim.owner == attempts[future]:
+                        # Its tokens already reached the caller, so no other attempt can take over the stream.
+                        self._finish(None, len(attempts), pending)
+                        raise
+                    continue
+                if claim is not None and not claim.claim(attempts[future]):
+                    # Another attempt owns the stream, so this one was told to stop and its text is partial.
+                    continue
+                self._finish(attempts[future], len(attempts), pending)
+                return result
+
+            if not pending and len(attempts) == len(self.backends):
+                self._record(len(attempts), None)
+                raise errors[0]
+            if (can_hedge and self._may_hedge(claim)) or not pending:
+                # Hedge once the delay passes, unless a stream started meanwhile, or fail over at once when an
+                # attempt fails.
+                latest = launch()
+                pending.add(latest)
+
+    async def _ahedge(self, call: Callable, claim: Optional[_StreamClaim] = None) -> Generation:
+        attempts: Dict[asyncio.Task, int] = {}
+        errors: List[BaseException] = []
+
+        def launch() -> asyncio.Task:
+            attempt = len(attempts)
+            task = asyncio.ensure_future(call(self.backends[attempt], attempt))
+            attempts[task] = attempt
+            if attempt == 0:
+                self._observe_primary(task)
+            return task
+
+        pending = {launch()}
+        try:
+            while True:
+                can_hedge = len(attempts) < len(self.backends) and self._may_hedge(claim)
+                done, pending = await asyncio.wait(pending, timeout=self.delay() if can_hedge else None,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if isinstance(task.exception(), RunCancelledException):
+                        raise task.exception()
+                    if task.exception() is not None:
+                        logger.warning(f"Backend {self._name(attempts[task])} failed during a hedged request: "
+                                       f"{task.exception()}")
+                        errors.append(task.exception())
+                        if claim is not None and claim.owner == attempts[task]:
+                            self._record(len(attempts), None)
+                            raise task.exception()
+                        continue
+                    if claim is not None and not claim.claim(attempts[task]):
+                        continue
+                    self._finish(attempts[task], len(attempts), pending)
+                    return task.result()
+
+                if not pending and len(attempts) == len(self.backends):
+                    self._record(len(attempts), None)
+                    raise errors[0]
+                if (can_hedge and self._may_hedge(claim)) or not pending:
+                    pending.add(launch())
+        finally:
+            for task in attempts:
+                task.cancel()
+
+    @staticmethod
+    def _may_hedge(claim: Optional[_StreamClaim]) -> bool:
+        # Once a stream has started emitting tokens, switching backends would garble it.
+        return claim is None or claim.owner is None
+
+    def _observe_primary(self, attempt):
+        """ Record the primary's latency once it's done, even if it lost, so slow calls still raise the delay. """
+        start = time.monotonic()
+
+        def observe(future):
+            # A cancelled async loser took at least this long, which is still a fair sample of a slow call.
+            if future.cancelled() or future.exception() is None:
+                self._observe(time.monotonic() - start)
+
+        attempt.add_done_callback(observe)
+
+    def _observe(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def _finish(self, winner: Optional[int], launched: int, losers: set):
+        for loser in losers:
+            # Sync losers that are already running can't be interrupted, so their results are ignored.
+            loser.cancel()
+        self._record(launched, winner)
+
+    def _record(self, launched: int, winner: Optional[int]):
+        with self._lock:
+            self._stats.requests += 1
+            if launched > 1:
+                self._stats.hedged += 1
+            if winner is None:
+                self._stats.failures += 1
+            elif winner > 0:
+                self._stats.hedge_wins += 1
+        if launched > 1:
+            metrics.increment("llm.hedges", winner="none" if winner is None else "primary" if winner == 0 else "hedge")
+
+    def _name(self, attempt: int) -> str:
+        return self.backends[attempt].__class__.__name__
+
+    def _pool(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="llm-hedge")
+            return self._executor
+
+    def tokenize(self, text: str) -> List[int]:
+        return self.backends[0].tokenize(text)
+
+    def count_tokens(self, text: str) -> int:
+        return self.backends[0].count_tokens(text)
+
+    def classify_error(self, error: BaseException) -> Optional[Failure]:
+        for backend in self.backends:
+            failure = backend.classify_error(error)
+            if failure is not None:
+                return failure
+        return None
+
+    def context_length(self) -> int:
+        # A prompt has to fit whichever backend ends up answering it.
+        return min(backend.context_length() for backend in self.backends)
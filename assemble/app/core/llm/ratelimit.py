@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import time
+from typing import Optional
+
+from assemble.app.core import metrics
+from assemble.app.core.cancellation import current_token
+
+
+class TokenBucket:
+    """ Refills at a steady rate up to a per-minute capacity; reservations may overdraw it and wait off the debt. """
+
+    def __init__(self, per_minute: float):
+        if per_minute <= 0:
+            raise ValueError("per_minute must be positive.")
+
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self._available = per_minute
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """ Take amount from the bucket, returning how many seconds to wait before it may be spent. """
+        with self._lock:
+            now = time.monotonic()
+            self._available = min(self.capacity, self._available + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._available -= amount
+            return max(-self._available / self.rate, 0.0)
+
+    def refund(self, amount: float):
+        """ Return an unspent reservation, or the part of an estimate that went unused. """
+        with self._lock:
+            self._available = min(self.capacity, self._available + amount)
+
+
+class RateLimiter:
+    """ Paces requests ahead of time against requests-per-minute and tokens-per-minute budgets. """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute is not None else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute is not None else None
+
+    def _reserve(self, tokens: int) -> float:
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(tokens))
+        if wait > 0:
+            metrics.observe("llm.rate_limit_wait_seconds", wait)
+        return wait
+
+    def _refund(self, tokens: int):
+        if self.requests is not None:
+            self.requests.refund(1)
+        if self.tokens is not None:
+            self.tokens.refund(tokens)
+
+    def acquire(self, tokens: int):
+        """ Wait until a request estimated at tokens fits the budgets; the wait ends early if the run is cancelled. """
+        wait = self._reserve(tokens)
+        if wait <= 0:
+            return
+        try:
+            token = current_token()
+            if token is None:
+                time.sleep(wait)
+            else:
+                token.sleep(wait)
+        except BaseException:
+            self._refund(tokens)
+            raise
+
+    async def aacquire(self, tokens: int):
+        wait = self._reserve(tokens)
+        if wait <= 0:
+            return
+        try:
+            await asyncio.sleep(wait)
+        except BaseException:
+            self._refund(tokens)
+            raise
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        """ Correct the token budget once a request's actual usage is known. """
+        if self.tokens is None or actual_tokens == estimated_tokens:
+            return
+        if actual_tokens < estimated_tokens:
+            self.tokens.refund(estimated_tokens - actual_tokens)
+        else:
+            self.tokens.reserve(actual_tokens - estimated_tokens)
@@ -0,0 +1,270 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+import weakref
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple, IO
+
+from assemble.app.core.cancellation import check_cancelled, current_token
+from assemble.app.core.llm.adapter import LLMAdapter
+from assemble.app.core.retry import Failure
+
+logger = logging.getLogger(__name__)
+
+Generation = Tuple[str, Dict[str, int]]
+# Draws a latency in seconds, such as the time to first token, from the request's seeded random generator.
+LatencyDistribution = Callable[[random.Random], float]
+
+
+class MissingRecordingException(LookupError):
+    """ Raised in strict replay when a prompt and its kwargs were never recorded. """
+    pass
+
+
+def constant_latency(seconds: float) -> LatencyDistribution:
+    return lambda rng: seconds
+
+
+def uniform_latency(low: float, high: float) -> LatencyDistribution:
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal_latency(median: float, sigma: float = 0.5) -> LatencyDistribution:
+    """ Long-tailed latencies, like a remote endpoint's, around a median in seconds. """
+    return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+
+def recording_key(prompt: str, backend_kwargs: Dict[str, Any]) -> str:
+    payload = json.dumps({"prompt": prompt, "kwargs": backend_kwargs}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def recording_group(prompt: str, backend_kwargs: Dict[str, Any]) -> str:
+    """ Key shared by prompts from the same state: the same kwargs and the same closing instruction line. """
+    lines = prompt.rstrip().splitlines()
+    return recording_key(lines[-1] if lines else "", backend_kwargs)
+
+
+def _open(path: str, mode: str) -> IO[str]:
+    return gzip.open(path, mode + "t", encoding="utf-8") if path.endswith(".gz") else open(path, mode, encoding="utf-8")
+
+
+class RecordingLLMAdapter(LLMAdapter):
+    """ Passes calls through to a backend, appending each generation to a JSON lines file, gzipped for .gz paths.
+
+    The file stays open so a gzipped recording compresses across records; close the adapter once recording finishes
+    to write out what is buffered.
+    """
+
+    def __init__(self, backend: LLMAdapter, path: str, store_prompts: bool = False):
+        self.backend = backend
+        self.path = path
+        # Records are keyed by a hash of the prompt; keeping the prompt text too makes them readable but larger.
+        self.store_prompts = store_prompts
+        self.supports_json_schema = backend.supports_json_schema
+        self._lock = threading.Lock()
+        self._file: Optional[IO[str]] = None
+        self._finalizer: Optional[weakref.finalize] = None
+
+    def close(self):
+        """ Flush and close the recording; later generations append to it again. """
+        with self._lock:
+            if self._finalizer is not None:
+                self._finalizer()
+            self._file, self._finalizer = None, None
+
+    def generate(self, prompt: str, **backend_kwargs) -> Generation:
+        start = time.monotonic()
+        result = self.backend.generate(prompt, **backend_kwargs)
+        return self._record(prompt, backend_kwargs, result, start)
+
+    def stream(self,
+               prompt: str,
+               on_token: Callable[[str], Optional[bool]],
+               **backend_kwargs) -> Generation:
+        start = time.monotonic()
+        result = self.backend.stream(prompt, on_token, **backend_kwargs)
+        return self._record(prompt, backend_kwargs, result, start)
+
+    async def agenerate(self, prompt: str, **backend_kwargs) -> Generation:
+        start = time.monotonic()
+        result = await self.backend.agenerate(prompt, **backend_kwargs)
+        return await asyncio.to_thread(self._record, prompt, backend_kwargs, result, start)
+
+    async def astream(self,
+                      prompt: str,
+                      on_token: Callable[[str], Optional[bool]],
+                      **backend_kwargs) -> Generation:
+        start = time.monotonic()
+        result = await self.backend.astream(prompt, on_token, **backend_kwargs)
+        return await asyncio.to_thread(self._record, prompt, backend_kwargs, result, start)
+
+    def _record(self, prompt: str, backend_kwargs: Dict[str, Any], result: Generation, start: float) -> Generation:
+        response, usage = result
+        record = {
+            "key": recording_key(prompt, backend_kwargs),
+            "group": recording_group(prompt, backend_kwargs),
+            "response": response,
+            "usage": usage,
+            "latency": round(time.monotonic() - start, 4)
+        }
+        if self.store_prompts:
+            record["prompt"] = prompt
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = _open(self.path, "a")
+                # Closing writes the gzip trailer, so a recording that's never closed is still readable.
+                self._finalizer = weakref.finalize(self, self._file.close)
+            self._file.write(line)
+            if not self.path.endswith(".gz"):
+                # Plain recordings stay readable while they're written; gzip only flushes on close, across records.
+                self._file.flush()
+        return result
+
+    def tokenize(self, text: str) -> List[int]:
+        return self.backend.tokenize(text)
+
+    def count_tokens(self, text: str) -> int:
+        return self.backend.count_tokens(text)
+
+    def classify_error(self, error: BaseException) -> Optional[Failure]:
+        return self.backend.classify_error(error)
+
+    def context_length(self) -> int:
+        return self.backend.context_length()
+
+
+class ReplayLLMAdapter(LLMAdapter):
+    """ Serves recorded generations without a model, simulating the latency and token rate of a real backend. """
+
+    def __init__(self,
+                 path: str,
+                 latency: Optional[LatencyDistribution] = None,
+                 use_recorded_latency: bool = False,
+                 tokens_per_second: Optional[float] = None,
+                 strict: bool = True,
+                 seed: int = 0,
+                 context_window_length: int = 4096):
+        # Time to first token, drawn per request; use_recorded_latency replays the recorded wall time instead.
+        self.latency = latency
+        self.use_recorded_latency = use_recorded_latency
+        # Completion tokens streamed per second after the first, or None to return the whole response at once.
+        self.tokens_per_second = tokens_per_second
+        # Strict replay fails on unrecorded prompts; otherwise one is served a recording from the same state, chosen
+        # by its hash, so load tests can vary their queries.
+        self.strict = strict
+        self.seed = seed
+        self.context_window_length = context_window_length
+        self.recordings: Dict[str, List[Dict[str, Any]]] = {}
+        groups: Dict[str, set] = {}
+        with _open(path, "r") as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    self.recordings.setdefault(record["key"], []).append(record)
+                    groups.setdefault(record.get("group"), set()).add(record["key"])
+        self._groups = {group: sorted(keys) for group, keys in groups.items()}
+        # Repeated calls with the same prompt cycle through its recordings in order.
+        self._served: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        logger.info(f"Loaded {sum(map(len, self.recordings.values()))} recordings from {path}.")
+
+    def generate(self, prompt: str, **backend_kwargs) -> Generation:
+        record, rng = self._lookup(prompt, backend_kwargs)
+        self._sleep(self._first_token_delay(record, rng) + self._decode_time(record))
+        return record["response"], dict(record["usage"])
+
+    def stream(self,
+               prompt: str,
+               on_token: Callable[[str], Optional[bool]],
+               **backend_kwargs) -> Generation:
+        record, rng = self._lookup(prompt, backend_kwargs)
+        self._sleep(self._first_token_delay(record, rng))
+        chunks, delay = self._chunks(record)
+        for index, chunk in enumerate(chunks):
+            self._sleep(delay)
+            if on_token(chunk):
+                return "".join(chunks[:index + 1]), dict(record["usage"])
+        return record["response"], dict(record["usage"])
+
+    async def agenerate(self, prompt: str, **backend_kwargs) -> Generation:
+        record, rng = self._lookup(prompt, backend_kwargs)
+        await self._asleep(self._first_token_delay(record, rng) + self._decode_time(record))
+        return record["response"], dict(record["usage"])
+
+    async def astream(self,
+                      prompt: str,
+                      on_token: Callable[[str], Optional[bool]],
+                      **backend_kwargs) -> Generation:
+        record, rng = self._lookup(prompt, backend_kwargs)
+        await self._asleep(self._first_token_delay(record, rng))
+        chunks, delay = self._chunks(record)
+        for index, chunk in enumerate(chunks):
+            await self._asleep(delay)
+            if on_token(chunk):
+                return "".join(chunks[:index + 1]), dict(record["usage"])
+        return record["response"], dict(record["usage"])
+
+    def _lookup(self, prompt: str, backend_kwargs: Dict[str, Any]) -> Tuple[Dict[str, Any], random.Random]:
+        key = recording_key(prompt, backend_kwargs)
+        records = self.recordings.get(key)
+        if records is None:
+            keys = self._groups.get(recording_group(prompt, backend_kwargs))
+            if self.strict or not keys:
+                raise MissingRecordingException(f"No recording for prompt with key {key}.")
+            records = self.recordings[keys[int(key, 16) % len(keys)]]
+        with self._lock:
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+        # Seeded per prompt and call, so a replay draws the same latencies however requests interleave.
+        return records[served % len(records)], random.Random(f"{self.seed}:{key}:{served}")
+
+    def _first_token_delay(self, record: Dict[str, Any], rng: random.Random) -> float:
+        if self.use_recorded_latency:
+            return record.get("latency", 0.0)
+        return max(self.latency(rng), 0.0) if self.latency is not None else 0.0
+
+    def _decode_time(self, record: Dict[str, Any]) -> float:
+        if self.tokens_per_second is None:
+            return 0.0
+        return record["usage"].get("completion_tokens", 0) / self.tokens_per_second
+
+    def _chunks(self, record: Dict[str, Any]) -> Tuple[List[str], float]:
+        """ Split the response into word-sized chunks, returning them and the decode delay before each. """
+        response = record["response"]
+        chunks = re.findall(r"\s*\S+|\s+$", response) or [response]
+        if self.tokens_per_second is None:
+            return chunks, 0.0
+        return chunks, self._decode_time(record) / len(chunks)
+
+    @staticmethod
+    def _sleep(seconds: float):
+        if seconds <= 0:
+            check_cancelled()
+            return
+        token = current_token()
+        if token is None:
+            time.sleep(seconds)
+        else:
+            token.sleep(seconds)
+
+    @staticmethod
+    async def _asleep(seconds: float):
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+        check_cancelled()
+
+    def tokenize(self, text: str) -> List[int]:
+        # Without the recorded model's tokenizer, words and punctuation stand in for tokens.
+        return [zlib.crc32(piece.encode("utf-8")) for piece in re.findall(r"\w+|[^\w\s]", text)]
+
+    def context_length(self) -> int:
+        return self.context_window_length
@@ -0,0 +1,85 @@
+import logging
+from typing import Callable, Optional, Type, Tuple
+
+from pydantic import BaseModel, ValidationError
+
+from assemble.app.core import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class JsonObjectStream:
+    """ Scans streamed text for a complete top-level JSON object, looking at each character only once. """
+
+    def __init__(self, schema: Optional[Type[BaseModel]] = None):
+        self.schema = schema
+        self.text = ""
+        self.result: Optional[str] = None
+        self._start: Optional[int] = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk: str) -> bool:
+        """ Add streamed text, returning True once a complete object, valid against the schema if any, is found. """
+        if self.result is not None:
+            return True
+        scanned = len(self.text)
+        self.text += chunk
+        for index in range(scanned, len(self.text)):
+            if self._closes_object(index, self.text[index]) and self._accept(self.text[self._start:index + 1]):
+                return True
+        return False
+
+    def _closes_object(self, index: int, char: str) -> bool:
+        if self._in_string:
+            if self._escaped:
+                self._escaped = False
+            elif char == "\\":
+                self._escaped = True
+            elif char == '"':
+                self._in_string = False
+            return False
+
+        if self._start is None:
+            # Anything before the object, such as whitespace or a code fence, is skipped.
+            if char == "{":
+                self._start = index
+                self._depth = 1
+            return False
+
+        if char == '"':
+            self._in_string = True
+        elif char == "{":
+            self._depth += 1
+        elif char == "}":
+            self._depth -= 1
+            return self._depth == 0
+        return False
+
+    def _accept(self, candidate: str) -> bool:
+        self._start = None
+        if self.schema is not None:
+            try:
+                self.schema.model_validate_json(candidate)
+            except ValidationError:
+                # Keep decoding in case the model corrects itself; after_generation handles it otherwise.
+                logger.debug("Complete JSON object didn't match the response schema, continuing generation.")
+                return False
+        self.result = candidate
+        return True
+
+
+def json_stop_callback(
+        schema: Optional[Type[BaseModel]],
+        on_token: Optional[Callable[[str], None]] = None) -> Tuple[JsonObjectStream, Callable[[str], bool]]:
+    """ Return a parser and a streaming callback that asks the backend to stop once the parser has a result. """
+    parser = JsonObjectStream(schema)
+
+    def callback(token: str) -> bool:
+        done = parser.feed(token)
+        if on_token is not None:
+            on_token(token)
+        return done
+
+    return parser, callback
@@ -0,0 +1,53 @@
+import threading
+import weakref
+from collections import OrderedDict
+from typing import List
+
+from assemble.app.core.llm.adapter import LLMAdapter
+
+
+class TokenCounter:
+    """ Counts a prompt's tokens piece by piece, memoizing each piece so unchanged text is only tokenized once. """
+
+    def __init__(self, service: LLMAdapter, max_entries: int = 16384):
+        # Weak, so the shared registry below doesn't keep services alive.
+        self._service = weakref.ref(service)
+        self.max_entries = max_entries
+        self._counts: OrderedDict[str, int] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def split(prompt: str) -> List[str]:
+        """ Split a prompt into lines, which line up with its components: persona, notes, messages and tools. """
+        return prompt.splitlines(keepends=True)
+
+    def count(self, text: str) -> int:
+        with self._lock:
+            count = self._counts.get(text)
+            if count is not None:
+                self._counts.move_to_end(text)
+                return count
+
+        count = self._service().count_tokens(text)
+        with self._lock:
+            self._counts[text] = count
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return count
+
+    def count_prompt(self, prompt: str) -> int:
+        """ Sum the memoized counts of the prompt's lines; splitting can only overcount, erring on the safe side. """
+        return sum(self.count(piece) for piece in self.split(prompt))
+
+
+_counters: "weakref.WeakKeyDictionary[LLMAdapter, TokenCounter]" = weakref.WeakKeyDictionary()
+_counters_lock = threading.Lock()
+
+
+def token_counter(service: LLMAdapter) -> TokenCounter:
+    """ Return the counter shared by every generator on a service, since their prompts repeat the same notes. """
+    with _counters_lock:
+        counter = _counters.get(service)
+        if counter is None:
+            counter = _counters[service] = TokenCounter(service)
+        return counter
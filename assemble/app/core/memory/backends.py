@@ -0,0 +1,404 @@
+import dataclasses
+import itertools
+import logging
+import pickle
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Sequence, Tuple
+
+from assemble.app.core.memory.messages import Message, MessageStore
+
+logger = logging.getLogger(__name__)
+
+
+class ReadOnlyMemoryException(Exception):
+    """ Raised when writing to a memory snapshot. """
+    pass
+
+
+def merge_notes(expected: Sequence[str], current: Sequence[str], notes: Sequence[str]) -> Tuple[str, ...]:
+    """ Replace the expected notes with notes, keeping any appended since expected was read; if the notes were
+    cleared or replaced in the meantime, that other write wins. """
+    if tuple(current[:len(expected)]) != tuple(expected):
+        return tuple(current)
+    return tuple(notes) + tuple(current[len(expected):])
+
+
+class MemoryBackend(ABC):
+    """ Where a memory's messages, notes and data live; implementations must be safe to write from several threads
+    and snapshot() must never block writers. """
+
+    @abstractmethod
+    def append_message(self, message: Message):
+        pass
+
+    @abstractmethod
+    def read_messages(self, start: int, stop: int) -> List[Message]:
+        """ Messages from start up to stop, oldest first. """
+        pass
+
+    @abstractmethod
+    def count_messages(self) -> int:
+        pass
+
+    @abstractmethod
+    def clear_messages(self):
+        pass
+
+    @abstractmethod
+    def message_epoch(self) -> Hashable:
+        """ Identifies the messages until they're next cleared, so readers can cache them by position. """
+        pass
+
+    @abstractmethod
+    def append_note(self, note: str):
+        pass
+
+    @abstractmethod
+    def notes(self) -> Tuple[str, ...]:
+        pass
+
+    @abstractmethod
+    def replace_notes(self, expected: Sequence[str], notes: List[str]):
+        """ Replace notes read earlier, such as after compacting them, without losing notes appended since. """
+        pass
+
+    @abstractmethod
+    def clear_notes(self):
+        pass
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def get(self, key: str) -> Any:
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: Any):
+        pass
+
+    @abstractmethod
+    def pop(self, key: str) -> Any:
+        pass
+
+    @abstractmethod
+    def items(self) -> List[Tuple[str, Any]]:
+        pass
+
+    @abstractmethod
+    def clear_data(self):
+        pass
+
+    @abstractmethod
+    def snapshot(self) -> "MemoryBackend":
+        """ A read-only view of the memory as it is now, unaffected by later writes. """
+        pass
+
+
+_epochs = itertools.count()
+_MAX_ROWID = 2 ** 63 - 1
+
+
+@dataclass(frozen=True)
+class _State:
+    # Appended to in place, since readers only look at the first message_count messages; replaced when cleared.
+    messages: MessageStore
+    message_count: int
+    epoch: int
+    notes: Tuple[str, ...]
+    # Never modified once published, only copied.
+    data: Dict[str, Any]
+
+
+class InMemoryBackend(MemoryBackend):
+    """ Publishes each write as a new immutable state, so readers and snapshots never take the write lock; writers
+    only serialize among themselves. Reading messages briefly holds the message store's lock to copy the in-memory
+    ones, and reads spilled ones from disk without it. """
+
+    def __init__(self, message_window: Optional[int] = 256, message_spill_dir: Optional[str] = None):
+        self.message_window = message_window
+        self.message_spill_dir = message_spill_dir
+        self._state = _State(MessageStore(message_window, message_spill_dir), 0, next(_epochs), (), {})
+        self._write_lock = threading.Lock()
+
+    @contextmanager
+    def _write(self) -> Iterator[_State]:
+        with self._write_lock:
+            yield self._state
+
+    def _publish(self, state: _State, **changes):
+        self._state = dataclasses.replace(state, **changes)
+
+    def append_message(self, message: Message):
+        with self._write() as state:
+            state.messages.append(message)
+            self._publish(state, message_count=state.message_count + 1)
+
+    def read_messages(self, start: int, stop: int) -> List[Message]:
+        state = self._state
+        return state.messages.range(start, min(stop, state.message_count))
+
+    def count_messages(self) -> int:
+        return self._state.message_count
+
+    def clear_messages(self):
+        with self._write() as state:
+            # Snapshots keep the old store, which is closed once the last of them is gone.
+            self._publish(state, messages=MessageStore(self.message_window, self.message_spill_dir),
+                          message_count=0, epoch=next(_epochs))
+
+    def message_epoch(self) -> Hashable:
+        return self._state.epoch
+
+    def append_note(self, note: str):
+        with self._write() as state:
+            self._publish(state, notes=state.notes + (note,))
+
+    def notes(self) -> Tuple[str, ...]:
+        return self._state.notes
+
+    def replace_notes(self, expected: Sequence[str], notes: List[str]):
+        with self._write() as state:
+            self._publish(state, notes=merge_notes(expected, state.notes, notes))
+
+    def clear_notes(self):
+        with self._write() as state:
+            self._publish(state, notes=())
+
+    def exists(self, key: str) -> bool:
+        return key in self._state.data
+
+    def get(self, key: str) -> Any:
+        return self._state.data.get(key, None)
+
+    def set(self, key: str, value: Any):
+        with self._write() as state:
+            self._publish(state, data={**state.data, key: value})
+
+    def pop(self, key: str) -> Any:
+        with self._write() as state:
+            if key not in state.data:
+                return None
+            data = dict(state.data)
+            value = data.pop(key)
+            self._publish(state, data=data)
+            return value
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return list(self._state.data.items())
+
+    def clear_data(self):
+        with self._write() as state:
+            self._publish(state, data={})
+
+    def snapshot(self) -> MemoryBackend:
+        return _InMemorySnapshot(self._state)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = dict(self.__dict__)
+        state.pop("_write_lock")
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self._write_lock = threading.Lock()
+        # Epochs are only unique within a process.
+        self._state = dataclasses.replace(self._state, epoch=next(_epochs))
+
+
+class _InMemorySnapshot(InMemoryBackend):
+
+    def __init__(self, state: _State):
+        self._state = state
+
+    @contextmanager
+    def _write(self) -> Iterator[_State]:
+        raise ReadOnlyMemoryException("Memory snapshots are read-only.")
+        yield
+
+    def snapshot(self) -> MemoryBackend:
+        return self
+
+
+class SQLiteMemoryBackend(MemoryBackend):
+    """ Keeps a session's memory in a local SQLite database, so agents in several threads or processes can share it.
+
+    Appends are single atomic inserts and ordered by a never-reused rowid. Data values are pickled, so only share a
+    database with processes you trust.
+    """
+
+    def __init__(self, path: str, session: str = "default", timeout: float = 30.0):
+        self.path = path
+        self.session = session
+        # Seconds to wait on another process's write before failing.
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS memory_sessions ("
+                               "session TEXT PRIMARY KEY, epoch INTEGER NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS memory_messages ("
+                               "id INTEGER PRIMARY KEY AUTOINCREMENT, session TEXT NOT NULL, name TEXT NOT NULL, "
+                               "content TEXT NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS memory_messages_session ON memory_messages (session, id)")
+            connection.execute("CREATE TABLE IF NOT EXISTS memory_notes ("
+                               "id INTEGER PRIMARY KEY AUTOINCREMENT, session TEXT NOT NULL, note TEXT NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS memory_notes_session ON memory_notes (session, id)")
+            connection.execute("CREATE TABLE IF NOT EXISTS memory_data ("
+                               "session TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, "
+                               "PRIMARY KEY (session, key))")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared across threads, so each worker gets its own.
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self, mode: str = "IMMEDIATE") -> Iterator[sqlite3.Connection]:
+        """ Reads and writes that must see each other atomically; IMMEDIATE takes the write lock up front. """
+        connection = self._connection()
+        connection.execute(f"BEGIN {mode}")
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+    def append_message(self, message: Message):
+        with self._connection() as connection:
+            connection.execute("INSERT INTO memory_messages (session, name, content) VALUES (?, ?, ?)",
+                               (self.session, message.name, message.content))
+
+    def read_messages(self, start: int, stop: int, last_id: Optional[int] = None) -> List[Message]:
+        start = max(start, 0)
+        if stop <= start:
+            return []
+        # Snapshots pass the last message id they saw, so messages appended since are left out.
+        rows = self._connection().execute(
+            "SELECT name, content FROM memory_messages WHERE session = ? AND id <= ? ORDER BY id LIMIT ? OFFSET ?",
+            (self.session, last_id if last_id is not None else _MAX_ROWID, stop - start, start)).fetchall()
+        return [Message(name=name, content=content) for name, content in rows]
+
+    def count_messages(self) -> int:
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM memory_messages WHERE session = ?", (self.session,)).fetchone()[0]
+
+    def clear_messages(self):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM memory_messages WHERE session = ?", (self.session,))
+            connection.execute("INSERT INTO memory_sessions (session, epoch) VALUES (?, 1) "
+                               "ON CONFLICT(session) DO UPDATE SET epoch = epoch + 1", (self.session,))
+
+    def message_epoch(self) -> Hashable:
+        row = self._connection().execute(
+            "SELECT epoch FROM memory_sessions WHERE session = ?", (self.session,)).fetchone()
+        return self.path, self.session, row[0] if row is not None else 0
+
+    def append_note(self, note: str):
+        with self._connection() as connection:
+            connection.execute("INSERT INTO memory_notes (session, note) VALUES (?, ?)", (self.session, note))
+
+    def notes(self) -> Tuple[str, ...]:
+        return self._notes(self._connection())
+
+    def _notes(self, connection: sqlite3.Connection) -> Tuple[str, ...]:
+        rows = connection.execute(
+            "SELECT note FROM memory_notes WHERE session = ? ORDER BY id", (self.session,)).fetchall()
+        return tuple(row[0] for row in rows)
+
+    def replace_notes(self, expected: Sequence[str], notes: List[str]):
+        with self._transaction() as connection:
+            merged = merge_notes(expected, self._notes(connection), notes)
+            connection.execute("DELETE FROM memory_notes WHERE session = ?", (self.session,))
+            connection.executemany("INSERT INTO memory_notes (session, note) VALUES (?, ?)",
+                                   [(self.session, note) for note in merged])
+
+    def clear_notes(self):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM memory_notes WHERE session = ?", (self.session,))
+
+    def exists(self, key: str) -> bool:
+        return self._connection().execute(
+            "SELECT 1 FROM memory_data WHERE session = ? AND key = ?", (self.session, key)).fetchone() is not None
+
+    def get(self, key: str) -> Any:
+        row = self._connection().execute(
+            "SELECT value FROM memory_data WHERE session = ? AND key = ?", (self.session, key)).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def set(self, key: str, value: Any):
+        with self._connection() as connection:
+            connection.execute("INSERT INTO memory_data (session, key, value) VALUES (?, ?, ?) "
+                               "ON CONFLICT(session, key) DO UPDATE SET value = excluded.value",
+                               (self.session, key, pickle.dumps(value)))
+
+    def pop(self, key: str) -> Any:
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT value FROM memory_data WHERE session = ? AND key = ?", (self.session, key)).fetchone()
+            connection.execute("DELETE FROM memory_data WHERE session = ? AND key = ?", (self.session, key))
+        return pickle.loads(row[0]) if row is not None else None
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return self._items(self._connection())
+
+    def _items(self, connection: sqlite3.Connection) -> List[Tuple[str, Any]]:
+        rows = connection.execute(
+            "SELECT key, value FROM memory_data WHERE session = ? ORDER BY key", (self.session,)).fetchall()
+        return [(key, pickle.loads(value)) for key, value in rows]
+
+    def clear_data(self):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM memory_data WHERE session = ?", (self.session,))
+
+    def snapshot(self) -> MemoryBackend:
+        # One read transaction sees a consistent state in WAL mode without blocking writers.
+        with self._transaction("DEFERRED") as connection:
+            last_id, count = connection.execute(
+                "SELECT COALESCE(MAX(id), 0), COUNT(*) FROM memory_messages WHERE session = ?",
+                (self.session,)).fetchone()
+            return _SQLiteSnapshot(self, last_id, count, self.message_epoch(), self._notes(connection),
+                                   dict(self._items(connection)))
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Pickling, e.g. to spill a session, keeps a reference to the database rather than its contents.
+        return {"path": self.path, "session": self.session, "timeout": self.timeout}
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__init__(**state)
+
+
+class _SQLiteSnapshot(InMemoryBackend):
+    """ Notes and data copied at snapshot time; messages are read lazily up to the last one that existed then. """
+
+    def __init__(self,
+                 backend: SQLiteMemoryBackend,
+                 last_id: int,
+                 message_count: int,
+                 epoch: Hashable,
+                 notes: Tuple[str, ...],
+                 data: Dict[str, Any]):
+        self.backend = backend
+        self.last_id = last_id
+        self._state = _State(None, message_count, epoch, notes, data)
+
+    @contextmanager
+    def _write(self) -> Iterator[_State]:
+        raise ReadOnlyMemoryException("Memory snapshots are read-only.")
+        yield
+
+    def read_messages(self, start: int, stop: int) -> List[Message]:
+        # Messages cleared since the snapshot was taken can no longer be read.
+        return self.backend.read_messages(start, min(stop, self._state.message_count), last_id=self.last_id)
+
+    def snapshot(self) -> MemoryBackend:
+        return self
@@ -1,67 +1,128 @@
+import copy
 import logging
-from dataclasses import dataclass
-from typing import Any, List
+from typing import Any, Callable, List, Optional, Tuple
 
+from assemble.app.core.memory.backends import InMemoryBackend, MemoryBackend
+from assemble.app.core.memory.messages import Message, tail_within
+from assemble.app.core.memory.retrieval import Retrieval
 from assemble.app.core.memory.scratch_pad import ContextStrategy, ScratchPad
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
-class Message:
-    name: str
-    content: str
-
-
 class DataStore:
-    _messages_key = "messages"
+    """ A memory's messages and data, kept in its backend. """
 
-    def __init__(self):
-        messages: List[Message] = []
-        self.data = {
-            self._messages_key: messages,
-        }
+    def __init__(self, backend: Optional[MemoryBackend] = None):
+        self.backend = backend if backend is not None else InMemoryBackend()
 
     def exists(self, key) -> bool:
-        return key in self.data
+        return self.backend.exists(key)
 
     def get(self, key) -> Any:
-        return self.data.get(key, None)
+        return self.backend.get(key)
 
     def set(self, key, value):
-        self.data[key] = value
+        self.backend.set(key, value)
 
     def pop(self, key) -> Any:
-        return self.data.pop(key, None)
+        return self.backend.pop(key)
 
     def remove(self, key):
-        self.data.pop(key, None)
+        self.backend.pop(key)
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return self.backend.items()
+
+    def update(self, data: dict):
+        for key, value in data.items():
+            self.backend.set(key, value)
+
+    def clear(self):
+        """ Clear the data and messages. """
+        self.backend.clear_data()
+        self.backend.clear_messages()
 
     def get_current_message(self) -> Message:
-        return self.data[self._messages_key][-1]
+        count = self.backend.count_messages()
+        messages = self.backend.read_messages(count - 1, count)
+        if not messages:
+            raise IndexError("No messages stored.")
+        return messages[0]
 
     def get_all_messages(self) -> List[Message]:
-        return self.data[self._messages_key]
+        """ Every message, including those spilled to disk; prefer the tail reads below for prompts. """
+        return self.backend.read_messages(0, self.backend.count_messages())
+
+    def get_recent_messages(self, count: int) -> List[Message]:
+        total = self.backend.count_messages()
+        return self.backend.read_messages(max(total - count, 0), total)
+
+    def get_messages_within(self, token_budget: int, count: Callable[[str], int]) -> List[Message]:
+        """ The newest messages that could fit in token_budget, measured by count, oldest first. """
+        return tail_within(self.backend.read_messages, self.backend.count_messages(), token_budget, count)
+
+    def count_messages(self) -> int:
+        return self.backend.count_messages()
 
     def add_message(self, message: Message):
-        self.data[self._messages_key].append(message)
+        self.backend.append_message(message)
 
     def clear_messages(self):
-        self.data[self._messages_key] = []
+        self.backend.clear_messages()
 
 
 class Memory:
     """ Memory class for storing and managing session-specific data and notes. """
 
-    def __init__(self, context_strategy: ContextStrategy = ContextStrategy.TRUNCATE):
-        self.data: DataStore = DataStore()
-        self.scratch_pad: ScratchPad = ScratchPad(context_strategy)
+    def __init__(self,
+                 context_strategy: ContextStrategy = ContextStrategy.TRUNCATE,
+                 message_window: Optional[int] = 256,
+                 message_spill_dir: Optional[str] = None,
+                 retrieval: Optional[Retrieval] = None,
+                 backend: Optional[MemoryBackend] = None,
+                 **context_options):
+        """ context_options configure the strategy, e.g. token_budget, or generator for ROLLING_SUMMARY. Messages
+        beyond the newest message_window are spilled to a file in message_spill_dir, or never with None. With
+        retrieval, prompts get the notes and messages most relevant to the current message instead of all of them.
+        backend defaults to an in-process one; pass a SQLiteMemoryBackend to share the memory between agents. """
+        self.retrieval = retrieval
+        self.backend = backend if backend is not None else InMemoryBackend(message_window, message_spill_dir)
+        self.data: DataStore = DataStore(self.backend)
+        self.scratch_pad: ScratchPad = ScratchPad(context_strategy, backend=self.backend, **context_options)
+
+    def snapshot(self) -> "Memory":
+        """ A read-only copy of the memory as it is now, for building prompts while other runs keep writing. """
+        snapshot = copy.copy(self)
+        snapshot.backend = self.backend.snapshot()
+        snapshot.data = DataStore(snapshot.backend)
+        snapshot.scratch_pad = self.scratch_pad.view(snapshot.backend)
+        return snapshot
 
     def reset_data(self):
-        self.data = DataStore()
+        self.data.clear()
+
+    def prompt_messages(self, token_budget: int, count: Callable[[str], int]) -> List[Message]:
+        """ Messages for a prompt: the relevant ones with retrieval, otherwise the newest that could fit. """
+        if self.retrieval is None or not self.data.count_messages():
+            return self.data.get_messages_within(token_budget, count)
+        return self.retrieval.messages(self.backend, self.data.get_current_message().content)
+
+    def prompt_notes(self) -> List[str]:
+        """ Notes for a prompt: the relevant ones with retrieval, otherwise all of them. """
+        notes = self.scratch_pad.get()
+        if self.retrieval is None or not self.data.count_messages():
+            return notes
+        return self.retrieval.notes(notes, self.data.get_current_message().content)
 
     def reset_scratch_pad(self):
         self.scratch_pad.clear()
 
     def run_context_handlers(self):
         self.scratch_pad.run_context_handler()
+
+    def compact(self):
+        self.scratch_pad.compact()
+
+    async def acompact(self):
+        await self.scratch_pad.acompact()
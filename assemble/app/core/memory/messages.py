@@ -0,0 +1,188 @@
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import weakref
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class Message:
+    name: str
+    content: str
+
+    def formatted(self) -> str:
+        """ The message as states render it into their prompts. """
+        return f"{self.name}: {self.content}\n"
+
+
+def tail_within(read: Callable[[int, int], List[Message]],
+                total: int,
+                token_budget: int,
+                count: Callable[[str], int]) -> List[Message]:
+    """ The newest of total messages whose token counts fit the budget, plus the one that overflows it, so prompt
+    assembly only sees the messages it could keep instead of the whole history.
+
+    Counts aren't cached on the messages since generators on different models tokenize differently; pass a memoizing
+    counter such as TokenCounter.count.
+    """
+    messages: List[Message] = []
+    used, start = 0, total
+    while start > 0 and used <= token_budget:
+        page = read(max(start - 64, 0), start)
+        if not page:
+            break
+        for message in reversed(page):
+            start -= 1
+            used += count(message.formatted())
+            messages.append(message)
+            if used > token_budget:
+                break
+    messages.reverse()
+    return messages
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class MessageStore:
+    """ A conversation's messages, keeping the newest in memory and spilling older ones to an append-only SQLite
+    file so long sessions stay bounded. """
+
+    def __init__(self, max_in_memory: Optional[int] = 256, spill_dir: Optional[str] = None):
+        # Messages kept in memory, or None to never spill.
+        self.max_in_memory = max_in_memory
+        # Directory for the spill file, or None for the system's temporary directory.
+        self.spill_dir = spill_dir
+        self._window: Deque[Message] = deque()
+        # Index of the first message in the window; everything before it is on disk.
+        self._offset = 0
+        self._connection: Optional[sqlite3.Connection] = None
+        self._path: Optional[str] = None
+        self._finalizer: Optional[weakref.finalize] = None
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._offset + len(self._window)
+
+    def __iter__(self) -> Iterator[Message]:
+        return iter(self.range(0, len(self)))
+
+    def append(self, message: Message):
+        with self._lock:
+            self._window.append(message)
+            if self.max_in_memory is not None and len(self._window) > self.max_in_memory:
+                # Spill a quarter of the window at once, so appends don't each pay for a write.
+                self._spill(len(self._window) - self.max_in_memory * 3 // 4)
+
+    def current(self) -> Message:
+        """ The newest message, raising IndexError when there are none. """
+        with self._lock:
+            if self._window:
+                return self._window[-1]
+            offset = self._offset
+        if offset:
+            return self.range(offset - 1, offset)[0]
+        raise IndexError("No messages stored.")
+
+    def tail(self, count: int) -> List[Message]:
+        """ The newest count messages, oldest first. """
+        total = len(self)
+        return self.range(max(total - count, 0), total)
+
+    def range(self, start: int, stop: int) -> List[Message]:
+        """ Messages from start up to stop, reading only the spilled ones the range covers.
+
+        The lock is only held to copy the in-memory messages; spilled positions never change, so they're read after
+        releasing it, leaving appends free to proceed while a long history is read from disk.
+        """
+        with self._lock:
+            start, stop = max(start, 0), min(stop, self._offset + len(self._window))
+            if start >= stop:
+                return []
+            offset, path = self._offset, self._path
+            window_start, window_stop = max(start - offset, 0), stop - offset
+            window = [self._window[index] for index in range(window_start, window_stop)] if window_stop > 0 else []
+        if start >= offset:
+            return window
+        return self._read(path, start, min(stop, offset)) + window
+
+    def clear(self):
+        with self._lock:
+            self._window.clear()
+            self._offset = 0
+            if self._connection is not None:
+                self._connection.execute("DELETE FROM messages")
+                self._connection.commit()
+
+    def close(self):
+        """ Close and delete the spill file, dropping the spilled messages. """
+        with self._lock:
+            if self._finalizer is not None:
+                self._finalizer()
+            self._connection, self._path, self._finalizer = None, None, None
+            self._window.clear()
+            self._offset = 0
+
+    def _spill(self, count: int):
+        connection = self._connect()
+        spilled = [self._window.popleft() for _ in range(count)]
+        connection.executemany(
+            "INSERT INTO messages (position, name, content) VALUES (?, ?, ?)",
+            [(self._offset + index, message.name, message.content)
+             for index, message in enumerate(spilled)])
+        connection.commit()
+        self._offset += count
+        logger.debug(f"Spilled {count} messages to disk, {self._offset} in total.")
+
+    @staticmethod
+    def _read(path: str, start: int, stop: int) -> List[Message]:
+        # Readers get a connection of their own, so they don't queue behind a spill on the writer's.
+        connection = sqlite3.connect(path)
+        try:
+            rows = connection.execute(
+                "SELECT name, content FROM messages WHERE position >= ? AND position < ? ORDER BY position",
+                (start, stop)).fetchall()
+        finally:
+            connection.close()
+        return [Message(name=name, content=content) for name, content in rows]
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            descriptor, path = tempfile.mkstemp(prefix="messages-", suffix=".sqlite", dir=self.spill_dir)
+            os.close(descriptor)
+            # Append-only and private to this store, so durability isn't worth an fsync per spill. WAL lets readers
+            # read committed spills while the next one is written.
+            connection = sqlite3.connect(path, check_same_thread=False, isolation_level="DEFERRED")
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute(
+                "CREATE TABLE messages (position INTEGER PRIMARY KEY, name TEXT NOT NULL, content TEXT NOT NULL)")
+            self._connection, self._path = connection, path
+            self._finalizer = weakref.finalize(self, MessageStore._release, connection, path)
+        return self._connection
+
+    @staticmethod
+    def _release(connection: sqlite3.Connection, path: str):
+        connection.close()
+        for suffix in ("", "-wal", "-shm"):
+            _remove(path + suffix)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # The spill file belongs to this process, so pickling, e.g. to spill a whole session, reads it back in.
+        return {"max_in_memory": self.max_in_memory, "spill_dir": self.spill_dir, "messages": list(self)}
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__init__(state["max_in_memory"], state["spill_dir"])
+        for message in state["messages"]:
+            self.append(message)
@@ -0,0 +1,78 @@
+from typing import Dict, List, Tuple
+
+from assemble.app.core.memory.retrieval import Vector, VectorIndex
+
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError("Please install NumPy library: pip install numpy")
+
+
+class NumpyVectorIndex(VectorIndex):
+    """ Exact cosine search over a contiguous matrix of normalized vectors, scored with one matrix-vector product. """
+
+    def __init__(self, initial_capacity: int = 256):
+        self.initial_capacity = initial_capacity
+        self._matrix = None
+        self._keys: List[str] = []
+        self._positions: Dict[str, int] = {}
+
+    def add(self, keys: List[str], vectors: List[Vector]):
+        if not keys:
+            return
+        rows = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(rows, axis=1, keepdims=True)
+        rows /= np.where(norms == 0, 1, norms)
+        self._reserve(len(self._keys) + len(keys), rows.shape[1])
+        for key, row in zip(keys, rows):
+            position = self._positions.get(key)
+            if position is None:
+                position = self._positions[key] = len(self._keys)
+                self._keys.append(key)
+            self._matrix[position] = row
+
+    def remove(self, keys: List[str]):
+        for key in keys:
+            position = self._positions.pop(key, None)
+            if position is None:
+                continue
+            # Move the last row into the gap, so the live rows stay contiguous.
+            last = len(self._keys) - 1
+            if position != last:
+                self._matrix[position] = self._matrix[last]
+                self._keys[position] = self._keys[last]
+                self._positions[self._keys[position]] = position
+            self._keys.pop()
+
+    def search(self, vector: Vector, k: int) -> List[Tuple[str, float]]:
+        count = len(self._keys)
+        if count == 0 or k <= 0:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        scores = self._matrix[:count] @ (query / norm)
+        if k < count:
+            top = np.argpartition(scores, -k)[-k:]
+            top = top[np.argsort(scores[top])[::-1]]
+        else:
+            top = np.argsort(scores)[::-1]
+        return [(self._keys[position], float(scores[position])) for position in top]
+
+    def keys(self) -> List[str]:
+        return list(self._keys)
+
+    def clear(self):
+        self._matrix = None
+        self._keys = []
+        self._positions = {}
+
+    def _reserve(self, size: int, dimensions: int):
+        if self._matrix is None:
+            self._matrix = np.zeros((max(size, self.initial_capacity), dimensions), dtype=np.float32)
+        elif size > self._matrix.shape[0]:
+            # Grow geometrically so appends are amortized constant time.
+            matrix = np.zeros((max(size, 2 * self._matrix.shape[0]), dimensions), dtype=np.float32)
+            matrix[:len(self._keys)] = self._matrix[:len(self._keys)]
+            self._matrix = matrix
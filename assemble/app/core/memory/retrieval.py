@@ -0,0 +1,183 @@
+import logging
+import math
+import re
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Set, Tuple
+
+from assemble.app.core import metrics
+from assemble.app.core.memory.backends import MemoryBackend
+from assemble.app.core.memory.messages import Message
+
+logger = logging.getLogger(__name__)
+
+Vector = List[float]
+
+
+class Embedder(ABC):
+    """ Turns text into fixed-size vectors, where similar texts get a high cosine similarity. """
+
+    @abstractmethod
+    def embed(self, texts: List[str]) -> List[Vector]:
+        pass
+
+
+class HashedNgramEmbedder(Embedder):
+    """ Offline default: words and their character n-grams hashed into a fixed number of signed buckets. """
+
+    def __init__(self, dimensions: int = 512, ngram: int = 3):
+        self.dimensions = dimensions
+        self.ngram = ngram
+
+    def embed(self, texts: List[str]) -> List[Vector]:
+        return [self._embed(text) for text in texts]
+
+    def _embed(self, text: str) -> Vector:
+        vector = [0.0] * self.dimensions
+        for feature, frequency in Counter(self._features(text)).items():
+            hashed = zlib.crc32(feature.encode("utf-8"))
+            # A sign per feature keeps bucket collisions from adding up into false similarity.
+            sign = 1.0 if hashed & 0x80000000 else -1.0
+            vector[hashed % self.dimensions] += sign * (1.0 + math.log(frequency))
+        norm = math.sqrt(sum(value * value for value in vector))
+        return [value / norm for value in vector] if norm else vector
+
+    def _features(self, text: str) -> List[str]:
+        features = []
+        for word in re.findall(r"\w+", text.lower()):
+            features.append(word)
+            padded = f"#{word}#"
+            features.extend(padded[index:index + self.ngram] for index in range(len(padded) - self.ngram + 1))
+        return features
+
+
+class VectorIndex(ABC):
+    """ Keyed vectors searched by cosine similarity. """
+
+    @abstractmethod
+    def add(self, keys: List[str], vectors: List[Vector]):
+        pass
+
+    @abstractmethod
+    def remove(self, keys: List[str]):
+        pass
+
+    @abstractmethod
+    def search(self, vector: Vector, k: int) -> List[Tuple[str, float]]:
+        """ The k most similar keys and their scores, most similar first. """
+        pass
+
+    @abstractmethod
+    def keys(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+
+def numpy_index() -> VectorIndex:
+    from assemble.app.core.memory.numpy_index import NumpyVectorIndex
+    return NumpyVectorIndex()
+
+
+class Retrieval:
+    """ Picks the notes and messages most relevant to the current message, so prompts stay small on long sessions.
+
+    Notes and messages are embedded lazily as they're first searched, and the most recent ones are always kept so
+    the agent doesn't lose track of the latest turn or step.
+    """
+
+    def __init__(self,
+                 embedder: Optional[Embedder] = None,
+                 index_factory: Callable[[], VectorIndex] = numpy_index,
+                 top_k_messages: int = 8,
+                 top_k_notes: int = 8,
+                 recent_messages: int = 4,
+                 recent_notes: int = 4):
+        self.embedder = embedder if embedder is not None else HashedNgramEmbedder()
+        self.index_factory = index_factory
+        self.top_k_messages = top_k_messages
+        self.top_k_notes = top_k_notes
+        self.recent_messages = recent_messages
+        self.recent_notes = recent_notes
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._messages: Optional[VectorIndex] = None
+        self._notes: Optional[VectorIndex] = None
+        # The epoch of the messages the index was built from and how many of them are in it.
+        self._epoch: Optional[Hashable] = None
+        self._indexed = 0
+
+    def messages(self, backend: MemoryBackend, query: str) -> List[Message]:
+        """ The messages most relevant to the query plus the most recent ones, oldest first. """
+        total = backend.count_messages()
+        if total <= self.recent_messages + self.top_k_messages:
+            return backend.read_messages(0, total)
+        with self._lock:
+            self._sync_messages(backend, total)
+            recent = set(range(max(total - self.recent_messages, 0), total))
+            found = self._search(self._messages, query, self.top_k_messages, exclude={str(index) for index in recent})
+        positions = recent | {int(key) for key in found}
+        return [message for position in sorted(positions) for message in backend.read_messages(position, position + 1)]
+
+    def notes(self, notes: Sequence[str], query: str) -> List[str]:
+        """ The notes most relevant to the query plus the most recent ones, in their original order. """
+        if len(notes) <= self.recent_notes + self.top_k_notes:
+            return list(notes)
+        with self._lock:
+            self._sync_notes(notes)
+            recent = len(notes) - self.recent_notes
+            relevant = set(self._search(self._notes, query, self.top_k_notes, exclude=set(notes[recent:])))
+        return [note for index, note in enumerate(notes) if index >= recent or note in relevant]
+
+    def _search(self, index: VectorIndex, query: str, k: int, exclude: Set[str]) -> List[str]:
+        """ The k keys most similar to the query, skipping the recent ones that are kept anyway. """
+        if k <= 0 or not query:
+            return []
+        with metrics.timed("memory.retrieval_seconds"):
+            results = index.search(self.embedder.embed([query])[0], k + len(exclude))
+        return [key for key, _ in results if key not in exclude][:k]
+
+    def _sync_messages(self, backend: MemoryBackend, total: int):
+        if self._messages is None:
+            self._messages = self.index_factory()
+        epoch = backend.message_epoch()
+        if epoch != self._epoch:
+            # Cleared messages, such as after Memory.reset_data, are indexed from scratch.
+            self._messages.clear()
+            self._epoch, self._indexed = epoch, 0
+        if total > self._indexed:
+            added = backend.read_messages(self._indexed, total)
+            self._messages.add([str(self._indexed + offset) for offset in range(len(added))],
+                               self.embedder.embed([message.content for message in added]))
+            metrics.increment("memory.embeddings", len(added), kind="message")
+            self._indexed += len(added)
+
+    def _sync_notes(self, notes: Sequence[str]):
+        if self._notes is None:
+            self._notes = self.index_factory()
+        # Notes come and go with the scratch pad's strategy, so the index follows their current text.
+        current, indexed = set(notes), set(self._notes.keys())
+        stale = list(indexed - current)
+        if stale:
+            self._notes.remove(stale)
+        added = [note for note in dict.fromkeys(notes) if note not in indexed]
+        if added:
+            self._notes.add(added, self.embedder.embed(added))
+            metrics.increment("memory.embeddings", len(added), kind="note")
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Indexes are rebuilt after unpickling, e.g. when a spilled session is reloaded.
+        state = dict(self.__dict__)
+        for key in ("_lock", "_messages", "_notes", "_epoch", "_indexed"):
+            state.pop(key)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self._reset()
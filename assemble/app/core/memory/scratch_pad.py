@@ -1,6 +1,14 @@
+import copy
 import enum
+import logging
 from abc import abstractmethod, ABC
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Callable, Tuple
+
+from assemble.app.core import metrics
+from assemble.app.core.llm.generator import Generator
+from assemble.app.core.memory.backends import InMemoryBackend, MemoryBackend
+
+logger = logging.getLogger(__name__)
 
 
 class ContextException(Exception):
@@ -9,13 +17,32 @@ class ContextException(Exception):
 
 class ContextStrategy(str, enum.Enum):
     TRUNCATE = "truncate"
+    # Keep the most recent notes that fit a token budget.
+    SLIDING_WINDOW = "sliding_window"
+    # Like SLIDING_WINDOW, but evict other notes before pinned ones such as tool outputs.
+    PRIORITY = "priority"
+    # Like SLIDING_WINDOW, but fold evicted notes into a running summary written by a Generator.
+    ROLLING_SUMMARY = "rolling_summary"
+
+
+def approximate_tokens(text: str) -> int:
+    """ Rough token count for when no tokenizer is given, at about four characters a token. """
+    return len(text) // 4 + 1
 
 
 class BaseHandler(ABC):
     @abstractmethod
-    def run(self, context: str) -> str:
+    def run(self, context: List[str]) -> List[str]:
+        """ Reduce the notes further after a prompt built from them didn't fit. """
         pass
 
+    def compact(self, context: List[str]) -> List[str]:
+        """ Keep the notes within the strategy's bounds after a step adds to them. """
+        return context
+
+    async def acompact(self, context: List[str]) -> List[str]:
+        return self.compact(context)
+
 
 class TruncateHandler(BaseHandler):
     def run(self, context: List[str]) -> List[str]:
@@ -25,41 +52,204 @@ class TruncateHandler(BaseHandler):
         return context[-1:]
 
 
+class SlidingWindowHandler(BaseHandler):
+    def __init__(self, token_budget: int = 2048, counter: Optional[Callable[[str], int]] = None):
+        self.token_budget = token_budget
+        # Pass e.g. token_counter(llm).count_prompt for exact counts, memoized across steps.
+        self.counter = counter if counter is not None else approximate_tokens
+
+    def run(self, context: List[str]) -> List[str]:
+        if len(context) <= 1:
+            raise ContextException("Context cannot be reduced any further.")
+
+        # The prompt didn't fit within the budget, so evict at least one more note.
+        kept, _ = self._evict(context, sum(map(self.counter, context)) - 1)
+        return kept
+
+    def compact(self, context: List[str]) -> List[str]:
+        kept, evicted = self._evict(context, self.token_budget)
+        return kept
+
+    def _evict(self, context: List[str], budget: int) -> Tuple[List[str], List[str]]:
+        """ Split the notes into those kept within the budget and those evicted, keeping the newest regardless. """
+        costs = [self.counter(note) for note in context]
+        total = sum(costs)
+        if total <= budget:
+            return context, []
+
+        evicted = set()
+        for index in self._eviction_order(context):
+            if total <= budget:
+                break
+            evicted.add(index)
+            total -= costs[index]
+        metrics.increment("memory.notes_evicted", len(evicted), strategy=self.__class__.__name__)
+        return ([note for index, note in enumerate(context) if index not in evicted],
+                [note for index, note in enumerate(context) if index in evicted])
+
+    def _eviction_order(self, context: List[str]) -> List[int]:
+        return list(range(len(context) - 1))
+
+
+class PriorityHandler(SlidingWindowHandler):
+    def __init__(self,
+                 token_budget: int = 2048,
+                 counter: Optional[Callable[[str], int]] = None,
+                 pinned_prefixes: Tuple[str, ...] = ("ACTION:",)):
+        super().__init__(token_budget, counter)
+        # Notes starting with these are evicted last; the action state's notes hold each tool's input and output.
+        self.pinned_prefixes = pinned_prefixes
+
+    def _eviction_order(self, context: List[str]) -> List[int]:
+        indexes = super()._eviction_order(context)
+        return sorted(indexes, key=lambda index: context[index].startswith(self.pinned_prefixes))
+
+
+class RollingSummaryHandler(SlidingWindowHandler):
+    summary_prefix = "SUMMARY: "
+
+    def __init__(self,
+                 generator: Generator,
+                 token_budget: int = 2048,
+                 counter: Optional[Callable[[str], int]] = None,
+                 summary_budget: int = 256):
+        super().__init__(token_budget, counter if counter is not None else generator.token_counter.count_prompt)
+        # A cheap model is enough, it only ever sees the previous summary and the notes just evicted.
+        self.generator = generator
+        # Part of the budget set aside for the summary itself.
+        self.summary_budget = summary_budget
+
+    def run(self, context: List[str]) -> List[str]:
+        summary, notes = self._unpack(context)
+        if len(notes) <= 1:
+            raise ContextException("Context cannot be reduced any further.")
+
+        kept, evicted = self._evict(notes, sum(map(self.counter, notes)) - 1)
+        response, _ = self.generator.generate(self._summary_prompt(summary, evicted))
+        return self._summarized(response, kept)
+
+    def compact(self, context: List[str]) -> List[str]:
+        summary, notes = self._unpack(context)
+        kept, evicted = self._evict(notes, self.token_budget - self.summary_budget)
+        if not evicted:
+            return context
+        response, _ = self.generator.generate(self._summary_prompt(summary, evicted))
+        return self._summarized(response, kept)
+
+    async def acompact(self, context: List[str]) -> List[str]:
+        summary, notes = self._unpack(context)
+        kept, evicted = self._evict(notes, self.token_budget - self.summary_budget)
+        if not evicted:
+            return context
+        response, _ = await self.generator.agenerate(self._summary_prompt(summary, evicted))
+        return self._summarized(response, kept)
+
+    def _unpack(self, context: List[str]) -> Tuple[Optional[str], List[str]]:
+        """ Separate the running summary, always the first note once there is one, from the other notes. """
+        if context and context[0].startswith(self.summary_prefix):
+            return context[0][len(self.summary_prefix):], context[1:]
+        return None, context
+
+    def _summarized(self, response: str, kept: List[str]) -> List[str]:
+        metrics.increment("memory.summaries")
+        return [self.summary_prefix + response.strip()] + kept
+
+    @staticmethod
+    def _summary_prompt(summary: Optional[str], evicted: List[str]) -> str:
+        notes = "\n".join(evicted)
+        return f'''Summarize an agent's notes from its earlier steps into a short paragraph. Keep the tools used, \
+their important inputs and outputs, and any facts that may be needed to finish the task.
+
+Current summary:
+"""
+{summary or "None yet."}
+"""
+
+Notes to add to the summary:
+"""
+{notes}
+"""
+
+Updated summary:'''
+
+
 class ContextHandler:
-    def __init__(self, strategy: ContextStrategy):
+    def __init__(self, strategy: ContextStrategy, **options):
         self.strategy_map = {
-            ContextStrategy.TRUNCATE: TruncateHandler()
+            ContextStrategy.TRUNCATE: TruncateHandler,
+            ContextStrategy.SLIDING_WINDOW: SlidingWindowHandler,
+            ContextStrategy.PRIORITY: PriorityHandler,
+            ContextStrategy.ROLLING_SUMMARY: RollingSummaryHandler
         }
-        self.handler = self.strategy_map[strategy]
+        self.handler = self.strategy_map[strategy](**options)
 
     def run(self, context: List[str]) -> List[str]:
         return self.handler.run(context)
 
+    def compact(self, context: List[str]) -> List[str]:
+        return self.handler.compact(context)
+
+    async def acompact(self, context: List[str]) -> List[str]:
+        return await self.handler.acompact(context)
+
 
 class ScratchPad:
     """ ScratchPad class for storing and managing session-specific notes. """
 
-    def __init__(self, context_strategy: ContextStrategy):
+    def __init__(self, context_strategy: ContextStrategy, backend: Optional[MemoryBackend] = None, **context_options):
         self.data: Dict[str, Any] = {}
-        self.notes: List[str] = []
-        self.context_handler = ContextHandler(context_strategy)
+        self.backend = backend if backend is not None else InMemoryBackend()
+        self.context_handler = ContextHandler(context_strategy, **context_options)
+
+    def view(self, backend: MemoryBackend) -> "ScratchPad":
+        """ The same scratch pad over another backend, such as a snapshot of this one's. """
+        view = copy.copy(self)
+        view.backend = backend
+        return view
+
+    @property
+    def notes(self) -> List[str]:
+        return list(self.backend.notes())
 
     def set(self, note: str):
         """ Append a note to the scratch pad. """
-        self.notes.append(note)
+        self.backend.append_note(note)
 
     def clear(self):
         """ Clear all notes from the scratch pad. """
-        self.notes = []
+        self.backend.clear_notes()
 
     def get(self) -> List[str]:
         """ Retrieve all notes from the scratch pad. """
         return self.notes
 
-    def prompt(self) -> str:
-        """ Generate a prompt for the scratch pad. """
+    def prompt(self, notes: Optional[List[str]] = None) -> str:
+        """ Generate a prompt for the scratch pad, or for a subset of its notes. """
         template = "\n{}"
-        return template.format("\n- ".join(self.notes))
+        return template.format("\n- ".join(self.notes if notes is None else notes))
 
     def run_context_handler(self):
-        self.notes = self.context_handler.run(self.notes)
+        notes = self.backend.notes()
+        self.backend.replace_notes(notes, self._handler().run(list(notes)))
+
+    def compact(self):
+        """ Apply the context strategy's bounds, such as its token budget, to the notes. """
+        notes = self.backend.notes()
+        self.backend.replace_notes(notes, self._handler().compact(list(notes)))
+
+    async def acompact(self):
+        # Notes appended while e.g. a rolling summary is written are kept by replace_notes.
+        notes = self.backend.notes()
+        self.backend.replace_notes(notes, await self._handler().acompact(list(notes)))
+
+    def _handler(self) -> ContextHandler:
+        if self.context_handler is None:
+            raise ContextException("The scratch pad was unpickled without a context handler, attach one first.")
+        return self.context_handler
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Handlers can hold generators and tokenizers that belong to this process, so they aren't pickled; whoever
+        # loads the scratch pad attaches a new one, as SessionStore does from its memory factory.
+        state = dict(self.__dict__)
+        state["context_handler"] = None
+        return state
@@ -0,0 +1,165 @@
+import asyncio
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+from assemble.app.core.memory.memory import Memory
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Session:
+    memory: Memory
+    last_access: float
+    in_use: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    async_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+class SessionStore:
+    """ LRU map of session ids to Memory with max-session and idle-TTL eviction and optional disk spill. """
+
+    def __init__(self,
+                 memory_factory: Callable[[], Memory] = Memory,
+                 max_sessions: int = 1024,
+                 idle_ttl: Optional[float] = None,
+                 spill_dir: Optional[str] = None):
+        if max_sessions < 1:
+            raise ValueError("max_sessions must be at least 1.")
+
+        self.memory_factory = memory_factory
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.spill_dir = spill_dir
+        self._sessions: OrderedDict[str, _Session] = OrderedDict()
+        self._lock = threading.Lock()
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    @contextmanager
+    def session(self, session_id: str) -> Iterator[Memory]:
+        """ Hold a session's memory for the duration of a run; runs on the same session are serialized. """
+        entry = self._acquire(session_id)
+        try:
+            with entry.lock:
+                yield entry.memory
+        finally:
+            self._release(session_id, entry)
+
+    @asynccontextmanager
+    async def asession(self, session_id: str) -> AsyncIterator[Memory]:
+        """ Async variant of session, serializing runs on the same session without blocking the event loop. """
+        entry = self._acquire(session_id)
+        try:
+            async with entry.async_lock:
+                yield entry.memory
+        finally:
+            self._release(session_id, entry)
+
+    def get(self, session_id: str) -> Memory:
+        """ Return the memory for a session, creating or reloading it if needed. """
+        with self._lock:
+            return self._get_or_load(session_id).memory
+
+    def remove(self, session_id: str):
+        """ Drop a session from memory and from the spill directory. """
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            path = self._spill_path(session_id)
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    def evict_expired(self):
+        with self._lock:
+            self._evict()
+
+    def _acquire(self, session_id: str) -> _Session:
+        with self._lock:
+            entry = self._get_or_load(session_id)
+            entry.in_use += 1
+            return entry
+
+    def _release(self, session_id: str, entry: _Session):
+        with self._lock:
+            entry.in_use -= 1
+            entry.last_access = time.monotonic()
+            # Keep the entries in access order, which _evict relies on to stop early.
+            if self._sessions.get(session_id) is entry:
+                self._sessions.move_to_end(session_id)
+            self._evict()
+
+    def _get_or_load(self, session_id: str) -> _Session:
+        now = time.monotonic()
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            memory = self._load(session_id)
+            if memory is None:
+                memory = self.memory_factory()
+            entry = _Session(memory=memory, last_access=now)
+            self._sessions[session_id] = entry
+        else:
+            entry.last_access = now
+            self._sessions.move_to_end(session_id)
+        # The session being handed out can't be evicted before its caller gets to use it.
+        self._evict(keep=session_id)
+        return entry
+
+    def _evict(self, keep: Optional[str] = None):
+        now = time.monotonic()
+        for session_id, entry in list(self._sessions.items()):
+            over_capacity = len(self._sessions) > self.max_sessions
+            expired = self.idle_ttl is not None and now - entry.last_access > self.idle_ttl
+            if not over_capacity and not expired:
+                # Entries are in access order, so nothing newer can be expired either.
+                break
+            if entry.in_use > 0 or session_id == keep:
+                continue
+            del self._sessions[session_id]
+            self._spill(session_id, entry.memory)
+            logger.debug(f"Evicted session {session_id} ({'capacity' if over_capacity else 'idle'}).")
+
+    def _spill_path(self, session_id: str) -> Optional[str]:
+        if self.spill_dir is None:
+            return None
+        return os.path.join(self.spill_dir, hashlib.sha1(session_id.encode("utf-8")).hexdigest() + ".pkl")
+
+    def _spill(self, session_id: str, memory: Memory):
+        path = self._spill_path(session_id)
+        if path is None:
+            return
+        try:
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(memory, f)
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            logger.warning(f"Failed to spill session {session_id} to disk, dropping it: {e}")
+
+    def _load(self, session_id: str) -> Optional[Memory]:
+        path = self._spill_path(session_id)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                memory = pickle.load(f)
+            # Context handlers aren't pickled, so the session gets a fresh one configured like any new session's.
+            memory.scratch_pad.context_handler = self.memory_factory().scratch_pad.context_handler
+            os.remove(path)
+            logger.debug(f"Reloaded session {session_id} from disk.")
+            return memory
+        except Exception as e:
+            logger.warning(f"Failed to reload session {session_id} from disk, starting fresh: {e}")
+            return None
@@ -1,5 +1,6 @@
-from dataclasses import dataclass
-from typing import Optional
+import uuid
+from dataclasses import dataclass, field
+from typing import Optional, Callable, Any
 
 
 @dataclass
@@ -7,3 +8,28 @@ class Query:
     goal: str
     initial_state: Optional[str] = None
     from_caller: str = "user"
+    session_id: Optional[str] = None
+    # Called with each Step as soon as its state completes.
+    on_step: Optional[Callable[[Any], None]] = None
+    # Called with (state_name, token) while states that stream tokens are generating.
+    on_token: Optional[Callable[[str, str], None]] = None
+    # Called with the state's name when a state that streamed tokens retries, so the tokens it streamed are stale.
+    on_retry: Optional[Callable[[str], None]] = None
+    # Seconds from when the agent receives the query until the run is abandoned, including time spent queued.
+    timeout: Optional[float] = None
+    query_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+
+
+@dataclass
+class Cancel:
+    query_id: str
+
+
+@dataclass
+class Resume:
+    """ Continue a checkpointed run from its last completed step. """
+    query_id: str
+    on_step: Optional[Callable[[Any], None]] = None
+    on_token: Optional[Callable[[str, str], None]] = None
+    on_retry: Optional[Callable[[str], None]] = None
+    timeout: Optional[float] = None
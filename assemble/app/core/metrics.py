@@ -0,0 +1,178 @@
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, Optional, Tuple
+
+
+class MetricsSink(ABC):
+
+    @abstractmethod
+    def observe(self, name: str, value: float, tags: Dict[str, str]):
+        """ Record a sample, such as a latency or a token count, into a distribution. """
+        pass
+
+    @abstractmethod
+    def increment(self, name: str, value: float, tags: Dict[str, str]):
+        """ Add to a counter. """
+        pass
+
+
+class NullMetricsSink(MetricsSink):
+
+    def observe(self, name: str, value: float, tags: Dict[str, str]):
+        pass
+
+    def increment(self, name: str, value: float, tags: Dict[str, str]):
+        pass
+
+
+@dataclass
+class Histogram:
+    """ Log-bucketed histogram; percentiles are accurate to within one bucket's growth factor. """
+    growth: float = 1.1
+    count: int = 0
+    total: float = 0.0
+    min: float = math.inf
+    max: float = -math.inf
+    buckets: Dict[int, int] = field(default_factory=dict)
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        index = math.ceil(math.log(value, self.growth)) if value > 0 else -math.inf
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                upper = self.growth ** index if index != -math.inf else 0.0
+                return min(max(upper, self.min), self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "min": self.min if self.count else 0.0,
+            "max": self.max if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+        }
+
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class InMemoryHistogramSink(MetricsSink):
+    """ Keeps a histogram per observed metric and a running total per counter, keyed by name and tags. """
+
+    def __init__(self, growth: float = 1.1):
+        self.growth = growth
+        self.histograms: Dict[MetricKey, Histogram] = {}
+        self.counters: Dict[MetricKey, float] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, tags: Dict[str, str]) -> MetricKey:
+        return name, tuple(sorted(tags.items()))
+
+    def observe(self, name: str, value: float, tags: Dict[str, str]):
+        key = self._key(name, tags)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(growth=self.growth)
+            histogram.add(value)
+
+    def increment(self, name: str, value: float, tags: Dict[str, str]):
+        key = self._key(name, tags)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name: str, **tags: str) -> Optional[Histogram]:
+        return self.histograms.get(self._key(name, tags))
+
+    def counter(self, name: str, **tags: str) -> float:
+        return self.counters.get(self._key(name, tags), 0)
+
+    def snapshot(self) -> Dict[str, list]:
+        """ Return every histogram summary and counter as plain data, e.g. for logging or JSON export. """
+        with self._lock:
+            return {
+                "histograms": [
+                    {"name": name, "tags": dict(tags), **histogram.summary()}
+                    for (name, tags), histogram in self.histograms.items()
+                ],
+                "counters": [
+                    {"name": name, "tags": dict(tags), "value": value}
+                    for (name, tags), value in self.counters.items()
+                ],
+            }
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+
+_default_sink: MetricsSink = NullMetricsSink()
+_current_sink: ContextVar[Optional[MetricsSink]] = ContextVar("metrics_sink", default=None)
+_current_tags: ContextVar[Dict[str, str]] = ContextVar("metrics_tags", default={})
+
+
+def set_default_sink(sink: MetricsSink):
+    """ Set the process-wide sink used by runs that aren't bound to a sink of their own. """
+    global _default_sink
+    _default_sink = sink
+
+
+def current_sink() -> MetricsSink:
+    sink = _current_sink.get()
+    return sink if sink is not None else _default_sink
+
+
+@contextmanager
+def bind_metrics(sink: Optional[MetricsSink] = None, **tags: str) -> Iterator[MetricsSink]:
+    """ Route metrics recorded in the enclosed block to a sink and tag them; nested binds add to outer tags. """
+    sink_reset = _current_sink.set(sink) if sink is not None else None
+    tags_reset = _current_tags.set({**_current_tags.get(), **tags})
+    try:
+        yield current_sink()
+    finally:
+        _current_tags.reset(tags_reset)
+        if sink_reset is not None:
+            _current_sink.reset(sink_reset)
+
+
+def observe(name: str, value: float, **tags: str):
+    current_sink().observe(name, value, {**_current_tags.get(), **tags})
+
+
+def increment(name: str, value: float = 1, **tags: str):
+    current_sink().increment(name, value, {**_current_tags.get(), **tags})
+
+
+@contextmanager
+def timed(name: str, **tags: str) -> Iterator[None]:
+    """ Observe the wall time of the enclosed block in seconds, whether or not it raises. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **tags)
@@ -0,0 +1,75 @@
+import enum
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+class FailureKind(str, enum.Enum):
+    # A backend hiccup, such as a dropped connection or a 5xx, worth backing off from.
+    TRANSIENT = "transient"
+    # The backend asked for fewer requests, and may say for how long.
+    RATE_LIMITED = "rate_limited"
+    # The model's response couldn't be parsed or validated, so it's asked again with the error right away.
+    INVALID_RESPONSE = "invalid_response"
+    # Retrying won't help, such as a bad API key or a bug.
+    FATAL = "fatal"
+
+
+@dataclass
+class Failure:
+    kind: FailureKind
+    # Seconds the backend asked to wait before retrying, if it said.
+    retry_after: Optional[float] = None
+
+
+class InvalidResponseException(Exception):
+    """ Raised when a state can't handle the model's response, carrying the response so it can be repaired. """
+
+    def __init__(self, response: str, error: Exception):
+        super().__init__(f"Invalid response: {error}")
+        self.response = response
+        self.error = error
+
+
+def classify_failure(error: BaseException) -> Failure:
+    """ Classify an error by its type, or by the HTTP status most client libraries attach to theirs. """
+    if isinstance(error, InvalidResponseException):
+        return Failure(FailureKind.INVALID_RESPONSE)
+
+    status_code = getattr(error, "status_code", None)
+    if status_code == 429:
+        return Failure(FailureKind.RATE_LIMITED, retry_after=retry_after(error))
+    if isinstance(status_code, int):
+        return Failure(FailureKind.TRANSIENT if status_code >= 500 or status_code == 408 else FailureKind.FATAL)
+
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return Failure(FailureKind.TRANSIENT)
+    if isinstance(error, (LookupError, TypeError, ValueError, AttributeError, NotImplementedError)):
+        return Failure(FailureKind.FATAL)
+    # Unknown errors, such as a custom backend's, keep being retried with backoff.
+    return Failure(FailureKind.TRANSIENT)
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """ Seconds to wait from an error's retry_after attribute or its response's Retry-After headers, if any. """
+    seconds = getattr(error, "retry_after", None)
+    if isinstance(seconds, (int, float)):
+        return max(float(seconds), 0.0)
+
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers is None:
+        return None
+    try:
+        milliseconds = headers.get("retry-after-ms")
+        if milliseconds is not None:
+            return max(float(milliseconds) / 1000, 0.0)
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
@@ -1,14 +1,22 @@
+import asyncio
+import json
 import logging
+import time
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Optional, List
+from typing import Optional, List, Callable, Dict, Type, Any, Tuple
 
 import tenacity
+from pydantic import BaseModel, ValidationError
 
+from assemble.app.core import metrics
+from assemble.app.core.cancellation import RunCancelledException, check_cancelled, current_token
 from assemble.app.core.llm.generator import Generator
 from assemble.app.core.memory.memory import Memory
 from assemble.app.core.memory.scratch_pad import ContextException
 from assemble.app.core.persona import Persona
+from assemble.app.core.retry import Failure, FailureKind, InvalidResponseException, classify_failure
+from assemble.app.core.states.prompt import PromptAssembler, Segment
 from assemble.app.core.states.states import SystemStates
 from assemble.app.core.tools.adapter import ToolAdapter
 from assemble.app.core.types import Usage
@@ -16,11 +24,17 @@ from assemble.app.core.types import Usage
 logger = logging.getLogger(__name__)
 
 
+# Data key the join state reads fan-out branch outputs from, as a dict of state name to response.
+FAN_OUT_RESULTS_KEY = "fan_out_results"
+
+
 @dataclass
 class Transition:
     next_state: str
     updated_response: Optional[str] = None
     token_usage: Optional[Usage] = None
+    # States to run concurrently before next_state, which then acts as their join.
+    parallel_states: Optional[List[str]] = None
 
 
 @dataclass
@@ -29,10 +43,40 @@ class StateResponse:
     prompt: Optional[str] = None
     response: Optional[str] = None
     token_usage: Optional[Usage] = None
+    parallel_states: Optional[List[str]] = None
+
+
+class _AttemptStream:
+    """ Forwards an execution's streamed tokens, calling on_retry before an attempt that follows one which streamed,
+    so callers can discard the failed attempt's tokens. """
+
+    def __init__(self, on_token: Optional[Callable[[str], None]], on_retry: Optional[Callable[[], None]]):
+        self._on_token = on_token
+        self._on_retry = on_retry
+        self._streamed = False
+        self.on_token = self._forward if on_token is not None else None
+
+    def begin(self):
+        if self._streamed and self._on_retry is not None:
+            self._on_retry()
+        self._streamed = False
+
+    def _forward(self, token: str):
+        self._streamed = True
+        return self._on_token(token)
 
 
 class StateBase(ABC):
     name: str
+    # Whether the state's generation is streamed to a query's on_token callback.
+    stream_tokens: bool = False
+    # Whether the state's response is a single JSON object, so decoding can stop as soon as it is complete.
+    stop_at_json: bool = False
+    # Optional model the JSON response must match before decoding stops early.
+    response_schema: Optional[Type[BaseModel]] = None
+    # Errors from after_generation that mean the response itself was bad, retried at once with a repair prompt. Handlers
+    # that do more than parse, such as running tools, raise InvalidResponseException themselves for their parse step.
+    invalid_response_errors: Tuple[Type[Exception], ...] = (json.JSONDecodeError, ValidationError)
 
     def __init__(self,
                  generator: Generator,
@@ -43,16 +87,19 @@ class StateBase(ABC):
                  retry_max: int = 30):
         self.generator = generator
         self.tools = tools
-        self.retry = tenacity.retry(
+        self._backoff = tenacity.wait_random_exponential(multiplier=retry_multiplier, min=retry_min, max=retry_max)
+        retry_kwargs = dict(
             stop=tenacity.stop_after_attempt(retry_attempts),
-            wait=tenacity.wait_exponential(multiplier=retry_multiplier, min=retry_min, max=retry_max),
-            retry=tenacity.retry_if_exception_type(Exception),
+            wait=self._wait,
+            # Cancellation and fatal errors are never retried, they have to unwind the run.
+            retry=tenacity.retry_if_exception(self._should_retry),
             reraise=True,
-            retry_error_callback=lambda retry_state: logger.error(
-                f"Retry failed after {retry_state.attempt_number} attempts: {retry_state.outcome.exception()}"),
+            retry_error_callback=self._retries_exhausted,
             after=tenacity.after_log(logger, logging.INFO),
             before=tenacity.before_log(logger, logging.INFO)
         )
+        self.retry = tenacity.retry(sleep=self._sleep, **retry_kwargs)
+        self.async_retry = tenacity.retry(sleep=self._asleep, **retry_kwargs)
         self._context_handler_limit = 50
 
     def __init_subclass__(cls, **kwargs):
@@ -61,6 +108,60 @@ class StateBase(ABC):
             logger.error(f"Class {cls.__name__} is missing a static 'name' attribute, it is not a string, or it is "
                          f"empty.")
             raise ValueError(f"Class {cls.__name__} must have a non-empty static 'name' string attribute.")
+        # Segmented prompts are only ever built by render_prompt, so catch a missing one when the class is defined.
+        if cls.prompt_segments is not StateBase.prompt_segments and cls.render_prompt is StateBase.render_prompt:
+            logger.error(f"Class {cls.__name__} overrides prompt_segments without overriding render_prompt.")
+            raise ValueError(f"Class {cls.__name__} must implement render_prompt since it returns prompt segments.")
+
+    def classify_failure(self, error: BaseException) -> Failure:
+        """ Classify a failed attempt, letting the backend recognize its own errors first. """
+        failure = self.generator.service.classify_error(error)
+        return failure if failure is not None else classify_failure(error)
+
+    def _should_retry(self, error: BaseException) -> bool:
+        if not isinstance(error, Exception) or isinstance(error, RunCancelledException):
+            return False
+        kind = self.classify_failure(error).kind
+        metrics.increment("state.failed_attempts", kind=kind.value)
+        if kind == FailureKind.FATAL:
+            logger.error(f"State {self.name} failed with an error that won't be retried: {error}")
+            return False
+        return True
+
+    def _wait(self, retry_state: tenacity.RetryCallState) -> float:
+        failure = self.classify_failure(retry_state.outcome.exception())
+        if failure.kind == FailureKind.INVALID_RESPONSE:
+            return 0.0
+        if failure.kind == FailureKind.RATE_LIMITED and failure.retry_after is not None:
+            return failure.retry_after
+        return self._backoff(retry_state)
+
+    def _retries_exhausted(self, retry_state: tenacity.RetryCallState):
+        error = retry_state.outcome.exception()
+        metrics.increment("state.retries_exhausted", kind=self.classify_failure(error).kind.value)
+        logger.error(f"Retry failed after {retry_state.attempt_number} attempts: {error}")
+        # Surface the last error instead of returning the callback's None as the state's response, unwrapping invalid
+        # responses so callers see the state's own error.
+        if isinstance(error, InvalidResponseException):
+            raise error.error
+        raise error
+
+    @staticmethod
+    def _sleep(seconds: float):
+        """ Back off between retries, waking early if the run is cancelled or its deadline passes. """
+        token = current_token()
+        if token is None:
+            time.sleep(seconds)
+        else:
+            token.sleep(seconds)
+
+    @staticmethod
+    async def _asleep(seconds: float):
+        token = current_token()
+        if token is not None and token.remaining() is not None:
+            seconds = min(seconds, token.remaining())
+        await asyncio.sleep(seconds)
+        check_cancelled()
 
     @abstractmethod
     def build_prompt(self,
@@ -69,6 +170,23 @@ class StateBase(ABC):
                      tools: Optional[List[ToolAdapter]]) -> str:
         pass
 
+    def prompt_segments(self, memory: Memory) -> List[Segment]:
+        """ Trimmable parts of the prompt; states that return any are fitted with render_prompt in a single pass. """
+        return []
+
+    def render_prompt(self,
+                      persona: Persona,
+                      memory: Memory,
+                      tools: Optional[List[ToolAdapter]],
+                      segments: Dict[str, List[str]]) -> str:
+        """ Build the prompt from the kept items of each of prompt_segments, keyed by segment name. """
+        raise NotImplementedError(f"State {self.name} returns prompt segments but doesn't implement render_prompt.")
+
+    def prompt_messages(self, memory: Memory) -> List[str]:
+        """ Formatted messages for the prompt, counted with the state's generator so only those that fit are read. """
+        messages = memory.prompt_messages(self.generator.token_budget(), self.generator.token_counter.count)
+        return [message.formatted() for message in messages]
+
     def before_generation(self,
                           memory: Memory,
                           tools: Optional[List[ToolAdapter]]) -> Optional[Transition]:
@@ -81,38 +199,200 @@ class StateBase(ABC):
                          tools: Optional[List[ToolAdapter]]) -> Transition:
         pass
 
-    def execute(self, persona: Persona, memory: Memory) -> StateResponse:
+    async def aafter_generation(self,
+                                generation: str,
+                                memory: Memory,
+                                tools: Optional[List[ToolAdapter]]) -> Transition:
+        """ Async variant of after_generation; runs it on a worker thread since handlers may call blocking tools. """
+        return await asyncio.to_thread(self.after_generation, generation, memory, tools)
+
+    def execute(self,
+                persona: Persona,
+                memory: Memory,
+                on_token: Optional[Callable[[str], None]] = None,
+                on_retry: Optional[Callable[[], None]] = None) -> StateResponse:
+        # The prompt is built once; retries reuse it, with the failed response and its error after a parse failure.
+        prompt: Optional[str] = None
+        repair: Optional[str] = None
+        generator = self.generator
+        stream = _AttemptStream(on_token, on_retry)
+
         @self.retry
         def _execute_with_retry():
-            transition = self.before_generation(memory, self.tools)
-            if transition is not None:
-                return StateResponse(transition.next_state)
+            nonlocal prompt, repair, generator
+            check_cancelled()
+            stream.begin()
+            if prompt is None:
+                transition = self.before_generation(memory, self.tools)
+                if transition is not None:
+                    return StateResponse(transition.next_state, parallel_states=transition.parallel_states)
+
+                prompt = self._fit_prompt(persona, memory)
+                if prompt is None:
+                    return StateResponse(SystemStates.EXIT.value)
+
+            generation_prompt = repair or prompt
+            json_schema = self.response_json_schema()
+            response, token_usage = generator.generate(generation_prompt, on_token=stream.on_token,
+                                                       stop_at_json=self.stop_at_json,
+                                                       response_schema=self.response_schema,
+                                                       json_schema=json_schema)
+
+            try:
+                transition = self.after_generation(response, memory, self.tools)
+            except Exception as e:
+                generator.invalidate(generation_prompt, json_schema)
+                cause = self._invalid_response_cause(e)
+                if cause is not None:
+                    if generator.escalate_to is not None:
+                        # A stronger model gets the original prompt rather than the weaker one's repair.
+                        generator, repair = self._escalate(generator), None
+                    else:
+                        repair = self._fit_repair(generator, prompt, response, cause)
+                    raise InvalidResponseException(response, cause) from cause
+                raise
+            return self._to_response(generation_prompt, response, token_usage, transition)
+
+        return _execute_with_retry()
+
+    async def aexecute(self,
+                       persona: Persona,
+                       memory: Memory,
+                       on_token: Optional[Callable[[str], None]] = None,
+                       on_retry: Optional[Callable[[], None]] = None) -> StateResponse:
+        prompt: Optional[str] = None
+        repair: Optional[str] = None
+        generator = self.generator
+        stream = _AttemptStream(on_token, on_retry)
+
+        @self.async_retry
+        async def _aexecute_with_retry():
+            nonlocal prompt, repair, generator
+            check_cancelled()
+            stream.begin()
+            if prompt is None:
+                transition = self.before_generation(memory, self.tools)
+                if transition is not None:
+                    return StateResponse(transition.next_state, parallel_states=transition.parallel_states)
+
+                # Fitting tokenizes and may run context handlers that call a model, all blocking work.
+                prompt = await asyncio.to_thread(self._fit_prompt, persona, memory)
+                if prompt is None:
+                    return StateResponse(SystemStates.EXIT.value)
+
+            generation_prompt = repair or prompt
+            json_schema = self.response_json_schema()
+            response, token_usage = await generator.agenerate(generation_prompt, on_token=stream.on_token,
+                                                              stop_at_json=self.stop_at_json,
+                                                              response_schema=self.response_schema,
+                                                              json_schema=json_schema)
 
-            prompt = None
             try:
-                for _ in range(self._context_handler_limit):
-                    prompt = self.build_prompt(persona, memory, self.tools)
-                    if self.generator.is_context_limit(prompt):
-                        memory.run_context_handlers()
+                transition = await self.aafter_generation(response, memory, self.tools)
+            except Exception as e:
+                generator.invalidate(generation_prompt, json_schema)
+                cause = self._invalid_response_cause(e)
+                if cause is not None:
+                    if generator.escalate_to is not None:
+                        # A stronger model gets the original prompt rather than the weaker one's repair.
+                        generator, repair = self._escalate(generator), None
                     else:
-                        break
-            except ContextException as e:
-                logger.error(f"Failed to generate LLM response: {e}")
-                return prompt, {}, Transition(
-                    next_state=SystemStates.EXIT.value
-                )
+                        repair = await asyncio.to_thread(self._fit_repair, generator, prompt, response, cause)
+                    raise InvalidResponseException(response, cause) from cause
+                raise
+            return self._to_response(generation_prompt, response, token_usage, transition)
 
-            response, token_usage = self.generator.generate(prompt)
+        return await _aexecute_with_retry()
 
-            transition = self.after_generation(response, memory, self.tools)
-            if transition.updated_response is not None:
-                response = transition.updated_response
+    def _escalate(self, generator: Generator) -> Generator:
+        logger.info(f"Escalating state {self.name} from route {generator.route} to {generator.escalate_to.route}.")
+        metrics.increment("llm.escalations", from_route=str(generator.route), to_route=str(generator.escalate_to.route))
+        return generator.escalate_to
 
-            if transition.token_usage is not None:
-                token_usage.total_tokens += transition.token_usage.total_tokens
-                token_usage.completion_tokens += transition.token_usage.completion_tokens
-                token_usage.prompt_tokens += transition.token_usage.prompt_tokens
+    def repair_prompt(self, prompt: str, response: str, error: Exception) -> str:
+        """ Ask again after a response failed to parse or validate, showing the model its response and the error. """
+        return f'''{prompt}
 
-            return StateResponse(transition.next_state, prompt, response, token_usage)
+Your previous response couldn't be used:
+"""
+{response}
+"""
 
-        return _execute_with_retry()
+Error:
+"""
+{error}
+"""
+
+Respond again, fixing the error:'''
+
+    def _invalid_response_cause(self, error: Exception) -> Optional[Exception]:
+        """ The error to show the model if after_generation failed because of its response, otherwise None. """
+        if isinstance(error, InvalidResponseException):
+            return error.error
+        if isinstance(error, self.invalid_response_errors):
+            return error
+        return None
+
+    def _fit_repair(self, generator: Generator, prompt: str, response: str, error: Exception) -> Optional[str]:
+        """ The repair prompt, cutting the quoted response down until it fits the generator's budget; None, retrying
+        with the plain prompt, if even an empty response doesn't fit. """
+        repair = self.repair_prompt(prompt, response, error)
+        while generator.is_context_limit(repair):
+            if not response:
+                logger.warning(f"State {self.name}'s repair prompt doesn't fit, retrying with the original prompt.")
+                return None
+            response = response[:len(response) // 2]
+            repair = self.repair_prompt(prompt, f"{response}\n[...truncated]" if response else "", error)
+        return repair
+
+    def response_json_schema(self) -> Optional[Dict[str, Any]]:
+        """ JSON schema backends that support it constrain decoding to, by default the response schema's. """
+        if self.response_schema is None:
+            return None
+        return self.response_schema.model_json_schema()
+
+    def _fit_prompt(self, persona: Persona, memory: Memory) -> Optional[str]:
+        """ Build the prompt, running the memory's context handlers until it fits; None if it never does.
+
+        Prompts are built from a snapshot, so concurrent runs writing to a shared memory neither block nor tear them.
+        """
+        snapshot = memory.snapshot()
+        segments = self.prompt_segments(snapshot)
+        if segments:
+            return self._assemble_prompt(persona, snapshot, segments)
+
+        prompt = None
+        try:
+            for _ in range(self._context_handler_limit):
+                prompt = self.build_prompt(persona, memory.snapshot(), self.tools)
+                if self.generator.is_context_limit(prompt):
+                    metrics.increment("state.context_handler_runs")
+                    memory.run_context_handlers()
+                else:
+                    break
+        except ContextException as e:
+            logger.error(f"Failed to generate LLM response: {e}")
+            return None
+        return prompt
+
+    def _assemble_prompt(self, persona: Persona, memory: Memory, segments: List[Segment]) -> Optional[str]:
+        assembler = PromptAssembler(self.generator.token_counter, self.generator.token_budget())
+        try:
+            with metrics.timed("state.prompt_assembly_seconds"):
+                return assembler.assemble(
+                    lambda kept: self.render_prompt(persona, memory, self.tools, kept), segments)
+        except ContextException as e:
+            logger.error(f"Failed to generate LLM response: {e}")
+            return None
+
+    @staticmethod
+    def _to_response(prompt: str, response: str, token_usage: Usage, transition: Transition) -> StateResponse:
+        if transition.updated_response is not None:
+            response = transition.updated_response
+
+        if transition.token_usage is not None:
+            token_usage.total_tokens += transition.token_usage.total_tokens
+            token_usage.completion_tokens += transition.token_usage.completion_tokens
+            token_usage.prompt_tokens += transition.token_usage.prompt_tokens
+
+        return StateResponse(transition.next_state, prompt, response, token_usage, transition.parallel_states)
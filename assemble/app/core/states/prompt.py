@@ -0,0 +1,72 @@
+import bisect
+import itertools
+import logging
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Tuple
+
+from assemble.app.core import metrics
+from assemble.app.core.llm.tokens import TokenCounter
+from assemble.app.core.memory.scratch_pad import ContextException
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Segment:
+    """ A trimmable part of a prompt, such as notes or messages, of which the most recent items are kept first. """
+    name: str
+    items: List[str]
+    # Segments with a higher priority are given budget first.
+    priority: int = 0
+
+
+class PromptAssembler:
+    """ Fits prompt segments into a token budget in one pass instead of rebuilding the prompt until it fits. """
+    _max_corrections = 3
+
+    def __init__(self, counter: TokenCounter, budget: int):
+        self.counter = counter
+        self.budget = budget
+
+    def assemble(self, render: Callable[[Dict[str, List[str]]], str], segments: List[Segment]) -> str:
+        """ Render the prompt with the largest recent window of each segment that fits within the budget. """
+        fixed_cost = self.counter.count_prompt(render({segment.name: [] for segment in segments}))
+        available = self.budget - fixed_cost
+        # Templates may add headings only when a segment is non-empty, so the rendered prompt is checked and any
+        # overshoot is taken off the segments' budget; unchanged lines are memoized, so rechecks are cheap.
+        for _ in range(self._max_corrections):
+            if available < 0:
+                break
+            kept = self._select(segments, available)
+            prompt = render(kept)
+            overshoot = self.counter.count_prompt(prompt) - self.budget
+            if overshoot <= 0:
+                self._record_dropped(segments, kept)
+                return prompt
+            available -= overshoot
+        raise ContextException(f"Prompt doesn't fit its budget of {self.budget} tokens, {fixed_cost} of which are "
+                               f"needed before any segments.")
+
+    def _select(self, segments: List[Segment], available: int) -> Dict[str, List[str]]:
+        kept: Dict[str, List[str]] = {}
+        for segment in sorted(segments, key=lambda s: s.priority, reverse=True):
+            count, cost = self.fit(segment.items, available)
+            kept[segment.name] = segment.items[len(segment.items) - count:] if count else []
+            available -= cost
+        return kept
+
+    @staticmethod
+    def _record_dropped(segments: List[Segment], kept: Dict[str, List[str]]):
+        for segment in segments:
+            dropped = len(segment.items) - len(kept[segment.name])
+            if dropped:
+                metrics.increment("prompt.dropped_items", dropped, segment=segment.name)
+                logger.debug(f"Dropped {dropped} of {len(segment.items)} items from prompt segment {segment.name} "
+                             f"to fit the token budget.")
+
+    def fit(self, items: List[str], budget: int) -> Tuple[int, int]:
+        """ Return how many of the newest items fit within the budget, and their token cost. """
+        # Suffix sums from the newest item back are non-decreasing, so the cut-off can be binary searched.
+        totals = list(itertools.accumulate(self.counter.count_prompt(item) for item in reversed(items)))
+        count = bisect.bisect_right(totals, budget)
+        return count, totals[count - 1] if count else 0
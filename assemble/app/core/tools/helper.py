@@ -1,6 +1,7 @@
-from typing import Dict, Any
+import copy
+from typing import Dict, Any, List
 
-from assemble.app.core.tools.adapter import ToolDetails
+from assemble.app.core.tools.adapter import ToolDetails, ToolAdapter
 
 
 def build_schema(name: str, description: str, tool_parameters: Dict) -> Dict[str, Any]:
@@ -12,3 +13,22 @@ def build_schema(name: str, description: str, tool_parameters: Dict) -> Dict[str
     tool_schema['properties']['tool_name'] = {'title': 'Name', 'type': 'string'}
     tool_schema['required'].append('tool_name')
     return tool_schema
+
+
+def tools_choice_schema(tools: List[ToolAdapter]) -> Dict[str, Any]:
+    """ JSON schema for the input of any one of the tools, with tool_name pinned to the tool it belongs to. """
+    choices = []
+    definitions: Dict[str, Dict[str, Any]] = {}
+    for tool in tools:
+        schema = copy.deepcopy(tool.schema())
+        # Nested models are only resolvable from the root, so every tool's definitions are hoisted to it.
+        for key in ("$defs", "definitions"):
+            definitions.setdefault(key, {}).update(schema.pop(key, {}))
+        properties = schema.get("properties", {})
+        properties.pop("tool_name", None)
+        schema["properties"] = {"tool_name": {"const": tool.name}, **properties}
+        choices.append(schema)
+
+    root = choices[0] if len(choices) == 1 else {"anyOf": choices}
+    root.update({key: value for key, value in definitions.items() if value})
+    return root
@@ -5,3 +5,5 @@ class Usage(BaseModel):
     total_tokens: int
     prompt_tokens: int
     completion_tokens: int
+    # Whether the usage was replayed from a response cache rather than spent on this call.
+    cached: bool = False
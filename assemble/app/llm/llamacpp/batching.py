@@ -0,0 +1,334 @@
+import codecs
+import ctypes
+import logging
+import queue
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+try:
+    import llama_cpp
+    import numpy as np
+    from llama_cpp import Llama, LlamaGrammar
+    from llama_cpp._internals import _LlamaTokenDataArray
+except ImportError:
+    raise ImportError("Please install LlamaCpp library: pip install llama-cpp-python")
+
+from assemble.app.core import metrics
+from assemble.app.core.cancellation import RunCancelledException, check_cancelled
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SamplingParams:
+    temperature: float = 0.2
+    top_p: float = 0.95
+    top_k: int = 40
+    max_tokens: Optional[int] = None
+    stop: List[str] = field(default_factory=list)
+    seed: Optional[int] = None
+
+
+@dataclass
+class BatchRequest:
+    """ A prompt waiting for, or being decoded as, one sequence of a shared batch. """
+    prompt_tokens: List[int]
+    sampling: SamplingParams
+    grammar: Optional[LlamaGrammar] = None
+    on_token: Optional[Callable[[str], Optional[bool]]] = None
+    completion_tokens: int = 0
+    text: str = ""
+    error: Optional[BaseException] = None
+    cancelled: bool = False
+    done: threading.Event = field(default_factory=threading.Event)
+
+    def wait(self, poll_interval: float = 0.1) -> str:
+        """ Block until the sequence finishes, leaving the batch early if the caller's run is cancelled. """
+        while not self.done.wait(poll_interval):
+            try:
+                check_cancelled()
+            except RunCancelledException:
+                self.cancelled = True
+                raise
+        if self.error is not None:
+            raise self.error
+        return self.text
+
+
+@dataclass
+class _Sequence:
+    seq_id: int
+    request: BatchRequest
+    max_tokens: int
+    rng: "np.random.Generator"
+    # Position of the next token in the sequence; prompt tokens before it have been decoded.
+    n_past: int = 0
+    next_token: Optional[int] = None
+    batch_index: Optional[int] = None
+    decoder: codecs.IncrementalDecoder = field(
+        default_factory=lambda: codecs.getincrementaldecoder("utf-8")(errors="replace"))
+
+
+class ContinuousBatcher:
+    """ Decodes many prompts on one Llama context at once, admitting and retiring sequences between batches. """
+
+    def __init__(self,
+                 llama: Llama,
+                 max_sequences: int = 4,
+                 max_batch_tokens: Optional[int] = None,
+                 default_max_tokens: int = 512,
+                 min_shared_prefix: int = 32):
+        self.max_batch_tokens = max_batch_tokens if max_batch_tokens is not None else llama.n_batch
+        if max_sequences < 1 or max_sequences > self.max_batch_tokens:
+            raise ValueError("max_sequences must be between 1 and the batch size, each sequence decodes a token per "
+                             "batch.")
+
+        self.llama = llama
+        self.max_sequences = max_sequences
+        self.default_max_tokens = default_max_tokens
+        # Shortest common prompt prefix worth copying between sequences; 0 disables prefix sharing.
+        self.min_shared_prefix = min_shared_prefix
+        self._n_ctx = llama.n_ctx()
+        self._n_vocab = llama.n_vocab()
+        self._requests: queue.Queue = queue.Queue()
+        self._active: Dict[int, _Sequence] = {}
+        # Finished sequences whose prompt cells are kept for prefix sharing, oldest first.
+        self._retained: OrderedDict[int, List[int]] = OrderedDict()
+        self._reserved = 0
+        self._batch = llama_cpp.llama_batch_init(self.max_batch_tokens, 0, 1)
+        self._candidates = _LlamaTokenDataArray(n_vocab=self._n_vocab)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="llama-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, request: BatchRequest) -> BatchRequest:
+        if self._closed.is_set():
+            raise RuntimeError("Batcher has been closed.")
+        if len(request.prompt_tokens) >= self._n_ctx:
+            raise ValueError(f"Prompt of {len(request.prompt_tokens)} tokens doesn't fit the context of {self._n_ctx}.")
+        self._requests.put(request)
+        return request
+
+    def close(self):
+        self._closed.set()
+        self._requests.put(None)
+        self._thread.join()
+        llama_cpp.llama_batch_free(self._batch)
+
+    def _loop(self):
+        waiting: List[BatchRequest] = []
+        while not self._closed.is_set():
+            # Block only when idle; otherwise pick up whatever arrived while the last batch decoded.
+            block = not self._active and not waiting
+            try:
+                request = self._requests.get(block=block)
+                if request is not None:
+                    waiting.append(request)
+                while True:
+                    request = self._requests.get_nowait()
+                    if request is not None:
+                        waiting.append(request)
+            except queue.Empty:
+                pass
+
+            waiting = self._admit(waiting)
+            if self._active:
+                self._step()
+
+        for sequence in list(self._active.values()):
+            self._finish(sequence, RuntimeError("Batcher was closed."))
+        for request in waiting:
+            request.error = RuntimeError("Batcher was closed.")
+            request.done.set()
+
+    def _admit(self, waiting: List[BatchRequest]) -> List[BatchRequest]:
+        """ Start sequences for waiting requests while there are free sequence ids and KV cache room. """
+        still_waiting = []
+        for request in waiting:
+            if request.cancelled:
+                request.error = RunCancelledException("Request was cancelled before it was scheduled.")
+                request.done.set()
+                continue
+
+            max_tokens = min(request.sampling.max_tokens or self.default_max_tokens,
+                             self._n_ctx - len(request.prompt_tokens))
+            reservation = len(request.prompt_tokens) + max_tokens
+            if len(self._active) >= self.max_sequences:
+                still_waiting.append(request)
+                continue
+            while self._retained and (self._reserved + reservation > self._n_ctx
+                                      or len(self._active) + len(self._retained) >= self.max_sequences):
+                self._release(next(iter(self._retained)))
+            if self._reserved + reservation > self._n_ctx:
+                still_waiting.append(request)
+                continue
+
+            seq_id = next(i for i in range(self.max_sequences) if i not in self._active and i not in self._retained)
+            self._reserved += reservation
+            sequence = _Sequence(seq_id=seq_id, request=request, max_tokens=max_tokens,
+                                 rng=np.random.default_rng(request.sampling.seed))
+            self._share_prefix(sequence)
+            self._active[seq_id] = sequence
+        return still_waiting
+
+    def _share_prefix(self, sequence: _Sequence):
+        """ Copy the KV cells of the longest prompt prefix another sequence has already decoded, skipping its eval. """
+        prompt = sequence.request.prompt_tokens
+        best_source, best_length = None, 0
+        sources = [(seq_id, tokens) for seq_id, tokens in self._retained.items()]
+        sources += [(other.seq_id, other.request.prompt_tokens[:other.n_past]) for other in self._active.values()]
+        for seq_id, tokens in sources:
+            length = Llama.longest_token_prefix(tokens, prompt)
+            if length > best_length:
+                best_source, best_length = seq_id, length
+
+        # At least the last prompt token has to be decoded to get logits for the first sampled token.
+        best_length = min(best_length, len(prompt) - 1)
+        if best_source is None or best_length < self.min_shared_prefix:
+            return
+        llama_cpp.llama_kv_cache_seq_cp(self.llama.ctx, best_source, sequence.seq_id, 0, best_length)
+        sequence.n_past = best_length
+        metrics.increment("llm.prefix_cache_hits", tier="batch")
+        logger.debug(f"Sequence {sequence.seq_id} reused {best_length} prompt tokens from sequence {best_source}.")
+
+    def _release(self, seq_id: int):
+        """ Drop a finished sequence's retained prompt from the KV cache. """
+        tokens = self._retained.pop(seq_id)
+        llama_cpp.llama_kv_cache_seq_rm(self.llama.ctx, seq_id, -1, -1)
+        self._reserved -= len(tokens)
+
+    def _step(self):
+        """ Decode one batch: the next token of every generating sequence, then as much pending prompt as fits. """
+        batch = self._batch
+        batch.n_tokens = 0
+        for sequence in self._active.values():
+            sequence.batch_index = None
+            if sequence.next_token is not None:
+                self._add(sequence, [sequence.next_token])
+
+        for sequence in self._active.values():
+            prompt = sequence.request.prompt_tokens
+            room = self.max_batch_tokens - batch.n_tokens
+            if sequence.next_token is None and sequence.n_past < len(prompt) and room > 0:
+                self._add(sequence, prompt[sequence.n_past:sequence.n_past + room])
+
+        if batch.n_tokens == 0:
+            return
+        result = llama_cpp.llama_decode(self.llama.ctx, batch)
+        if result != 0:
+            error = RuntimeError(f"llama_decode failed with status {result}.")
+            for sequence in list(self._active.values()):
+                self._finish(sequence, error)
+            return
+
+        for sequence in list(self._active.values()):
+            if sequence.batch_index is not None:
+                self._sample(sequence)
+
+    def _add(self, sequence: _Sequence, tokens: List[int]):
+        batch = self._batch
+        for token in tokens:
+            i = batch.n_tokens
+            batch.token[i] = token
+            batch.pos[i] = sequence.n_past
+            batch.n_seq_id[i] = 1
+            batch.seq_id[i][0] = sequence.seq_id
+            batch.logits[i] = False
+            batch.n_tokens += 1
+            sequence.n_past += 1
+
+        # Only the last token's logits are needed, and only once the whole prompt is in the cache.
+        if sequence.n_past >= len(sequence.request.prompt_tokens):
+            batch.logits[batch.n_tokens - 1] = True
+            sequence.batch_index = batch.n_tokens - 1
+
+    def _sample(self, sequence: _Sequence):
+        request = sequence.request
+        if request.cancelled:
+            self._finish(sequence, RunCancelledException("Request was cancelled while decoding."))
+            return
+
+        logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(self.llama.ctx, sequence.batch_index),
+                                       shape=(self._n_vocab,))
+        if request.grammar is not None:
+            self._candidates.copy_logits(logits)
+            llama_cpp.llama_sample_grammar(self.llama.ctx, ctypes.byref(self._candidates.candidates),
+                                           request.grammar.grammar)
+            logits = self._candidates.candidates_data["logit"]
+
+        token = self._choose(logits, request.sampling, sequence.rng)
+        if llama_cpp.llama_token_is_eog(self.llama.model, token):
+            self._finish(sequence)
+            return
+        if request.grammar is not None:
+            llama_cpp.llama_grammar_accept_token(self.llama.ctx, request.grammar.grammar, token)
+
+        request.completion_tokens += 1
+        piece = sequence.decoder.decode(self.llama.detokenize([token]))
+        stopped = self._append(request, piece)
+        if stopped or request.completion_tokens >= sequence.max_tokens:
+            self._finish(sequence)
+        else:
+            sequence.next_token = token
+
+    @staticmethod
+    def _choose(logits: "np.ndarray", sampling: SamplingParams, rng: "np.random.Generator") -> int:
+        if sampling.temperature <= 0:
+            return int(np.argmax(logits))
+
+        k = min(sampling.top_k, logits.shape[0]) if sampling.top_k > 0 else logits.shape[0]
+        top = np.argpartition(logits, -k)[-k:]
+        top = top[np.argsort(logits[top])[::-1]]
+        scaled = logits[top] / sampling.temperature
+        probs = np.exp(scaled - scaled.max())
+        probs /= probs.sum()
+        # A float32 cumulative sum can end just below 1.0, so top_p >= 1 would otherwise cut past the last token.
+        cutoff = min(int(np.searchsorted(np.cumsum(probs), sampling.top_p, side="left")) + 1, len(probs))
+        probs = probs[:cutoff] / probs[:cutoff].sum()
+        return int(top[rng.choice(cutoff, p=probs)])
+
+    def _append(self, request: BatchRequest, piece: str) -> bool:
+        """ Add decoded text to a request, returning True once it hits a stop string or its callback asks to stop. """
+        text = request.text + piece
+        for stop in request.sampling.stop:
+            index = text.find(stop)
+            if index != -1:
+                piece = piece[:max(index - len(request.text), 0)]
+                request.text = text[:index]
+                self._emit(request, piece)
+                return True
+        request.text = text
+        return self._emit(request, piece)
+
+    @staticmethod
+    def _emit(request: BatchRequest, piece: str) -> bool:
+        """ Pass a piece to the request's callback, returning True if the callback asked to stop decoding. """
+        if not piece or request.on_token is None or request.error is not None:
+            return False
+        try:
+            return bool(request.on_token(piece))
+        except Exception as e:
+            # A callback raising, e.g. on cancellation, ends its own sequence rather than the batch.
+            request.error = e
+            request.cancelled = True
+            return False
+
+    def _finish(self, sequence: _Sequence, error: Optional[BaseException] = None):
+        request = sequence.request
+        tail = sequence.decoder.decode(b"", final=True)
+        if tail and error is None:
+            self._append(request, tail)
+        del self._active[sequence.seq_id]
+        self._reserved -= len(request.prompt_tokens) + sequence.max_tokens
+        if error is None and self.min_shared_prefix > 0:
+            # Keep the prompt's cells so later prompts with the same prefix can share them, until the room is needed.
+            llama_cpp.llama_kv_cache_seq_rm(self.llama.ctx, sequence.seq_id, len(request.prompt_tokens), -1)
+            self._retained[sequence.seq_id] = request.prompt_tokens
+            self._reserved += len(request.prompt_tokens)
+        else:
+            llama_cpp.llama_kv_cache_seq_rm(self.llama.ctx, sequence.seq_id, -1, -1)
+        if error is not None and request.error is None:
+            request.error = error
+        request.done.set()
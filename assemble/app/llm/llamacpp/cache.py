@@ -0,0 +1,86 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Sequence, Tuple
+
+try:
+    from llama_cpp import Llama
+    from llama_cpp.llama_cache import BaseLlamaCache, LlamaDiskCache
+    from llama_cpp.llama import LlamaState
+except ImportError:
+    raise ImportError("Please install LlamaCpp library: pip install llama-cpp-python")
+
+from assemble.app.core import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TieredPrefixCache(BaseLlamaCache):
+    """ Evaluated prompt states keyed by their tokens, in a RAM tier that spills its least recently used to disk. """
+
+    def __init__(self,
+                 capacity_bytes: int = 2 << 30,
+                 disk_dir: Optional[str] = None,
+                 disk_capacity_bytes: int = 8 << 30):
+        super().__init__(capacity_bytes=capacity_bytes)
+        self.states: OrderedDict[Tuple[int, ...], LlamaState] = OrderedDict()
+        self.disk: Optional[LlamaDiskCache] = None
+        if disk_dir is not None:
+            self.disk = LlamaDiskCache(cache_dir=disk_dir, capacity_bytes=disk_capacity_bytes)
+        self._lock = threading.Lock()
+
+    @property
+    def cache_size(self) -> int:
+        return sum(state.llama_state_size for state in self.states.values())
+
+    def _find_longest_prefix_key(self, key: Tuple[int, ...]) -> Tuple[Optional[Tuple[int, ...]], int]:
+        best_key, best_length = None, 0
+        for cached_key in self.states:
+            length = Llama.longest_token_prefix(cached_key, key)
+            if length > best_length:
+                best_key, best_length = cached_key, length
+        return best_key, best_length
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        with self._lock:
+            found, _ = self._find_longest_prefix_key(tuple(key))
+        return found is not None or (self.disk is not None and key in self.disk)
+
+    def __getitem__(self, key: Sequence[int]) -> LlamaState:
+        key = tuple(key)
+        with self._lock:
+            ram_key, ram_length = self._find_longest_prefix_key(key)
+
+        # The disk tier only wins when it holds a longer prefix than RAM, and is then promoted.
+        disk_state = None
+        if self.disk is not None:
+            disk_key = self.disk._find_longest_prefix_key(key)
+            if disk_key is not None and Llama.longest_token_prefix(disk_key, key) > ram_length:
+                disk_state = self.disk.cache.pop(disk_key)
+
+        if disk_state is not None:
+            metrics.increment("llm.prefix_cache_hits", tier="disk")
+            self[disk_key] = disk_state
+            return disk_state
+        if ram_key is None:
+            metrics.increment("llm.prefix_cache_misses")
+            raise KeyError("Key not found")
+
+        metrics.increment("llm.prefix_cache_hits", tier="memory")
+        with self._lock:
+            self.states.move_to_end(ram_key)
+            return self.states[ram_key]
+
+    def __setitem__(self, key: Sequence[int], value: LlamaState):
+        key = tuple(key)
+        with self._lock:
+            self.states.pop(key, None)
+            self.states[key] = value
+            evicted = []
+            while self.cache_size > self.capacity_bytes and len(self.states) > 1:
+                evicted.append(self.states.popitem(last=False))
+
+        for evicted_key, state in evicted:
+            if self.disk is not None:
+                self.disk[evicted_key] = state
+            logger.debug(f"Evicted a {state.llama_state_size} byte prompt state from the RAM prefix cache.")
@@ -1,37 +1,86 @@
+import json
 import logging
-from typing import Tuple, Dict, List
+import threading
+from collections import OrderedDict
+from typing import Tuple, Dict, List, Callable, Optional, Any
 
 try:
-    from llama_cpp import Llama
+    from llama_cpp import Llama, LlamaGrammar
+    from llama_cpp.llama_chat_format import Jinja2ChatFormatter
+    from llama_cpp.llama_grammar import JSON_GBNF, json_schema_to_gbnf
 except ImportError:
     raise ImportError("Please install LlamaCpp library: pip install llama-cpp-python")
 
 from assemble.app.core.llm.adapter import LLMAdapter
+from assemble.app.llm.llamacpp.batching import BatchRequest, ContinuousBatcher, SamplingParams
+from assemble.app.llm.llamacpp.cache import TieredPrefixCache
 
 logger = logging.getLogger(__name__)
 
 
 class LlamaCppService(LLMAdapter):
+    supports_json_schema: bool = True
 
     def __init__(
             self,
             model_path: str,
+            max_batch_sequences: int = 1,
+            max_batch_tokens: int = 512,
+            prefix_cache_bytes: int = 0,
+            prefix_cache_dir: Optional[str] = None,
+            prefix_cache_disk_bytes: int = 8 << 30,
+            max_cached_grammars: int = 64,
             **kwargs):
         self.llama = Llama(
             model_path=model_path,
             **kwargs
         )
         self.model = model_path
+        # Reuses evaluated prompt states for the longest shared prefix, such as the persona and static instructions
+        # every state's prompt starts with, instead of evaluating each prompt from scratch.
+        if prefix_cache_bytes > 0:
+            self.llama.set_cache(TieredPrefixCache(
+                capacity_bytes=prefix_cache_bytes,
+                disk_dir=prefix_cache_dir,
+                disk_capacity_bytes=prefix_cache_disk_bytes
+            ))
+        # Llama isn't thread-safe, and agenerate runs generate on worker threads.
+        self._lock = threading.Lock()
+        # GBNF compiled from each response schema; a state's schema rarely changes, so it's converted once.
+        self._grammars: OrderedDict[str, str] = OrderedDict()
+        self._max_cached_grammars = max_cached_grammars
+        self._grammars_lock = threading.Lock()
+        # With more than one sequence, concurrent calls from all agents are decoded together in shared batches.
+        self.batcher: Optional[ContinuousBatcher] = None
+        self._chat_formatter: Optional[Jinja2ChatFormatter] = None
+        if max_batch_sequences > 1:
+            self.batcher = ContinuousBatcher(
+                self.llama,
+                max_sequences=max_batch_sequences,
+                max_batch_tokens=min(max_batch_tokens, self.llama.n_batch)
+            )
+            self._chat_formatter = self._load_chat_formatter()
+
+    def close(self):
+        """ Stop the batch scheduler, failing any requests still in it. """
+        if self.batcher is not None:
+            self.batcher.close()
 
     def generate(self, prompt: str, **backend_kwargs) -> Tuple[str, Dict[str, int]]:
+        if self.batcher is not None:
+            return self._generate_batched(prompt, None, backend_kwargs)
+
         messages = [{"role": "system", "content": prompt}]
         try:
             use_json_model = backend_kwargs.pop("use_json_model", False)
-            completion = self.llama.create_chat_completion_openai_v1(
-                messages=messages,
-                response_format={"type": "json_object"} if use_json_model else {"type": "text"},
-                **backend_kwargs
-            )
+            grammar = self._grammar(backend_kwargs.pop("json_schema", None))
+            with self._lock:
+                completion = self.llama.create_chat_completion_openai_v1(
+                    messages=messages,
+                    response_format=self._response_format(use_json_model, grammar),
+                    grammar=grammar,
+                    **backend_kwargs
+                )
 
             response_content = completion.choices[0].message.content
             logger.debug(f"LLM response: {response_content}")
@@ -45,8 +94,134 @@ class LlamaCppService(LLMAdapter):
             logger.error(f"Failed to generate LLM response: {e}")
             raise e
 
+    def stream(self, prompt: str, on_token: Callable[[str], None], **backend_kwargs) -> Tuple[str, Dict[str, int]]:
+        if self.batcher is not None:
+            return self._generate_batched(prompt, on_token, backend_kwargs)
+
+        messages = [{"role": "system", "content": prompt}]
+        try:
+            use_json_model = backend_kwargs.pop("use_json_model", False)
+            grammar = self._grammar(backend_kwargs.pop("json_schema", None))
+            parts = []
+            with self._lock:
+                chunks = self.llama.create_chat_completion(
+                    messages=messages,
+                    response_format=self._response_format(use_json_model, grammar),
+                    grammar=grammar,
+                    stream=True,
+                    **backend_kwargs
+                )
+                for chunk in chunks:
+                    token = chunk["choices"][0]["delta"].get("content")
+                    if token:
+                        parts.append(token)
+                        if on_token(token):
+                            chunks.close()
+                            break
+
+            response_content = "".join(parts)
+            logger.debug(f"LLM response: {response_content}")
+
+            # Streamed chunks don't carry usage, so count it from the text.
+            prompt_tokens = len(self.tokenize(prompt))
+            completion_tokens = len(self.tokenize(response_content))
+            return response_content, {
+                "completion_tokens": completion_tokens,
+                "prompt_tokens": prompt_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        except Exception as e:
+            logger.error(f"Failed to generate LLM response: {e}")
+            raise e
+
+    def _generate_batched(self,
+                          prompt: str,
+                          on_token: Optional[Callable[[str], None]],
+                          backend_kwargs: Dict[str, Any]) -> Tuple[str, Dict[str, int]]:
+        use_json_model = backend_kwargs.pop("use_json_model", False)
+        grammar = self._grammar(backend_kwargs.pop("json_schema", None))
+        if grammar is None and use_json_model:
+            grammar = LlamaGrammar.from_string(JSON_GBNF, verbose=False)
+        formatted, stop = self._format_prompt(prompt)
+        prompt_tokens = self._tokenize_formatted(formatted)
+        sampling = SamplingParams(stop=stop)
+        for name in ("temperature", "top_p", "top_k", "max_tokens", "seed"):
+            if backend_kwargs.get(name) is not None:
+                setattr(sampling, name, backend_kwargs.pop(name))
+        if backend_kwargs.get("stop"):
+            extra_stop = backend_kwargs.pop("stop")
+            sampling.stop += [extra_stop] if isinstance(extra_stop, str) else list(extra_stop)
+        if backend_kwargs:
+            logger.debug(f"Ignoring backend kwargs the batch scheduler doesn't support: {list(backend_kwargs)}")
+
+        try:
+            request = self.batcher.submit(
+                BatchRequest(prompt_tokens=prompt_tokens, sampling=sampling, grammar=grammar, on_token=on_token))
+            response_content = request.wait()
+        except Exception as e:
+            logger.error(f"Failed to generate LLM response: {e}")
+            raise e
+
+        logger.debug(f"LLM response: {response_content}")
+        return response_content, {
+            "completion_tokens": request.completion_tokens,
+            "prompt_tokens": len(prompt_tokens),
+            "total_tokens": len(prompt_tokens) + request.completion_tokens
+        }
+
+    def _grammar(self, json_schema: Optional[Dict[str, Any]]) -> Optional[LlamaGrammar]:
+        """ Build a grammar for the schema from cached GBNF; each call gets its own, as grammar state advances. """
+        if json_schema is None:
+            return None
+        key = json.dumps(json_schema, sort_keys=True)
+        with self._grammars_lock:
+            gbnf = self._grammars.get(key)
+            if gbnf is not None:
+                self._grammars.move_to_end(key)
+        if gbnf is None:
+            gbnf = json_schema_to_gbnf(key)
+            with self._grammars_lock:
+                self._grammars[key] = gbnf
+                while len(self._grammars) > self._max_cached_grammars:
+                    self._grammars.popitem(last=False)
+        return LlamaGrammar.from_string(gbnf, verbose=False)
+
+    @staticmethod
+    def _response_format(use_json_model: bool, grammar: Optional[LlamaGrammar]) -> Dict[str, str]:
+        # A json_object response format makes llama.cpp swap in its generic JSON grammar for the schema's.
+        return {"type": "json_object"} if use_json_model and grammar is None else {"type": "text"}
+
+    def _load_chat_formatter(self) -> Optional[Jinja2ChatFormatter]:
+        template = self.llama.metadata.get("tokenizer.chat_template")
+        if template is None:
+            logger.warning(f"Model {self.model} has no chat template, batched prompts are decoded unformatted.")
+            return None
+        return Jinja2ChatFormatter(
+            template=template,
+            eos_token=self.llama._model.token_get_text(self.llama.token_eos()),
+            bos_token=self.llama._model.token_get_text(self.llama.token_bos())
+        )
+
+    def _format_prompt(self, prompt: str) -> Tuple[str, List[str]]:
+        """ Apply the model's chat template, as create_chat_completion would, returning its stop strings too. """
+        if self._chat_formatter is None:
+            return prompt, []
+        result = self._chat_formatter(messages=[{"role": "system", "content": prompt}])
+        stop = result.stop if isinstance(result.stop, list) else [result.stop] if result.stop else []
+        return result.prompt, stop
+
+    def _tokenize_formatted(self, formatted: str) -> List[int]:
+        bos = self._chat_formatter.bos_token if self._chat_formatter is not None else None
+        return self.llama.tokenize(bytes(formatted, 'utf-8'), add_bos=not (bos and formatted.startswith(bos)),
+                                   special=True)
+
     def tokenize(self, text: str) -> List[int]:
+        # Tokenizing only reads the model's vocabulary, not the context, so it doesn't wait on a running generation.
         return self.llama.tokenize(bytes(text, 'utf-8'))
 
+    def count_tokens(self, text: str) -> int:
+        # Leave out the BOS token tokenize adds, a prompt is counted a line at a time.
+        return len(self.llama.tokenize(bytes(text, 'utf-8'), add_bos=False))
+
     def context_length(self) -> int:
         return self.llama.n_ctx()
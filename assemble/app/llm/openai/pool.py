@@ -0,0 +1,46 @@
+import threading
+from typing import Dict, Optional, Tuple
+
+try:
+    from openai import OpenAI, AsyncOpenAI
+except ImportError:
+    raise ImportError("Please install OpenAI library: pip install openai")
+
+from assemble.app.core.llm.ratelimit import RateLimiter
+
+_clients: Dict[Tuple[str, Optional[str]], Tuple[OpenAI, AsyncOpenAI]] = {}
+_limiters: Dict[Tuple[str, Optional[str], str], RateLimiter] = {}
+_lock = threading.Lock()
+
+
+def openai_clients(api_key: str, base_url: Optional[str] = None) -> Tuple[OpenAI, AsyncOpenAI]:
+    """ Return the process-wide clients for an API key, so every service reuses one connection pool. """
+    with _lock:
+        clients = _clients.get((api_key, base_url))
+        if clients is None:
+            clients = _clients[(api_key, base_url)] = (
+                OpenAI(api_key=api_key, base_url=base_url),
+                AsyncOpenAI(api_key=api_key, base_url=base_url)
+            )
+        return clients
+
+
+def rate_limiter(api_key: str,
+                 model: str,
+                 requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None,
+                 base_url: Optional[str] = None) -> Optional[RateLimiter]:
+    """ Return the limiter shared by every service on an endpoint, API key and model, as OpenAI's limits are per
+    model; services sharing one must ask for the same limits. """
+    if requests_per_minute is None and tokens_per_minute is None:
+        return None
+    key = (api_key, base_url, model)
+    with _lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = RateLimiter(requests_per_minute, tokens_per_minute)
+        elif (limiter.requests_per_minute, limiter.tokens_per_minute) != (requests_per_minute, tokens_per_minute):
+            raise ValueError(f"A rate limiter for model {model} already exists with {limiter.requests_per_minute} "
+                             f"requests and {limiter.tokens_per_minute} tokens per minute, which conflicts with "
+                             f"{requests_per_minute} requests and {tokens_per_minute} tokens per minute.")
+        return limiter
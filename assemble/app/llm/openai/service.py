@@ -1,17 +1,20 @@
 import logging
-from typing import Tuple, Dict, List
+from typing import Tuple, Dict, List, Callable, Optional
 
 try:
-    import tiktoken
+    import openai
 except ImportError:
-    raise ImportError("Please install tiktoken library: pip install tiktoken")
+    raise ImportError("Please install OpenAI library: pip install openai")
 
 try:
-    from openai import OpenAI
+    import tiktoken
 except ImportError:
-    raise ImportError("Please install OpenAI library: pip install openai")
+    raise ImportError("Please install tiktoken library: pip install tiktoken")
 
 from assemble.app.core.llm.adapter import LLMAdapter
+from assemble.app.core.retry import Failure, FailureKind
+from assemble.app.core.llm.tokens import token_counter
+from assemble.app.llm.openai.pool import openai_clients, rate_limiter
 
 logger = logging.getLogger(__name__)
 
@@ -23,10 +26,20 @@ class OpenAIService(LLMAdapter):
             api_key: str,
             model: str = "gpt-3.5-turbo-0125",
             encoding_type: str = "cl100k_base",
-            context_window_length: int = 4094):
-        self.openai = OpenAI(api_key=api_key)
+            context_window_length: int = 4094,
+            requests_per_minute: Optional[float] = None,
+            tokens_per_minute: Optional[float] = None,
+            completion_token_estimate: int = 256,
+            base_url: Optional[str] = None):
+        self.openai, self.async_openai = openai_clients(api_key, base_url)
         self.model = model
+        # Shared by every service on the same endpoint, key and model, so agents pace requests together instead of
+        # hitting 429s.
+        self.rate_limiter = rate_limiter(api_key, model, requests_per_minute, tokens_per_minute, base_url)
+        # Completion tokens budgeted for a request that doesn't set max_tokens, corrected once usage is known.
+        self.completion_token_estimate = completion_token_estimate
         self.encoding_type = encoding_type
+        self.encoding = tiktoken.get_encoding(encoding_type)
         self._model_context_windows = {
             "gpt-4-turbo": 128000,
             "gpt-4-turbo-2024-04-09": 128000,
@@ -51,31 +64,160 @@ class OpenAIService(LLMAdapter):
             self._model_context_windows[self.model] = context_window_length
 
     def generate(self, prompt: str, **backend_kwargs) -> Tuple[str, Dict[str, int]]:
-        messages = [{"role": "system", "content": prompt}]
+        estimated_tokens = self._admit(prompt, backend_kwargs)
         try:
-            use_json_model = backend_kwargs.pop("use_json_model", False)
-            completion = self.openai.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                response_format={"type": "json_object"} if use_json_model else {"type": "text"},
-                **backend_kwargs
-            )
-
-            response_content = completion.choices[0].message.content
-            logger.debug(f"LLM response: {response_content}")
-
-            return response_content, {
-                "completion_tokens": completion.usage.completion_tokens,
-                "prompt_tokens": completion.usage.prompt_tokens,
-                "total_tokens": completion.usage.total_tokens
-            }
+            completion = self.openai.chat.completions.create(**self._completion_kwargs(prompt, backend_kwargs))
+            return self._settle(estimated_tokens, self._parse_completion(completion))
+        except Exception as e:
+            logger.error(f"Failed to generate LLM response: {e}")
+            raise e
+
+    async def agenerate(self, prompt: str, **backend_kwargs) -> Tuple[str, Dict[str, int]]:
+        estimated_tokens = await self._aadmit(prompt, backend_kwargs)
+        try:
+            completion = await self.async_openai.chat.completions.create(
+                **self._completion_kwargs(prompt, backend_kwargs))
+            return self._settle(estimated_tokens, self._parse_completion(completion))
         except Exception as e:
             logger.error(f"Failed to generate LLM response: {e}")
             raise e
 
+    def stream(self, prompt: str, on_token: Callable[[str], None], **backend_kwargs) -> Tuple[str, Dict[str, int]]:
+        estimated_tokens = self._admit(prompt, backend_kwargs)
+        try:
+            chunks = self.openai.chat.completions.create(
+                **self._completion_kwargs(prompt, backend_kwargs),
+                stream=True,
+                stream_options={"include_usage": True})
+            parts = []
+            usage = None
+            for chunk in chunks:
+                chunk_usage, stop = self._consume_chunk(chunk, parts, on_token)
+                usage = chunk_usage or usage
+                if stop:
+                    chunks.close()
+                    break
+            return self._settle(estimated_tokens, self._stream_result(prompt, parts, usage))
+        except Exception as e:
+            logger.error(f"Failed to generate LLM response: {e}")
+            raise e
+
+    async def astream(self,
+                      prompt: str,
+                      on_token: Callable[[str], None],
+                      **backend_kwargs) -> Tuple[str, Dict[str, int]]:
+        estimated_tokens = await self._aadmit(prompt, backend_kwargs)
+        try:
+            chunks = await self.async_openai.chat.completions.create(
+                **self._completion_kwargs(prompt, backend_kwargs),
+                stream=True,
+                stream_options={"include_usage": True})
+            parts = []
+            usage = None
+            async for chunk in chunks:
+                chunk_usage, stop = self._consume_chunk(chunk, parts, on_token)
+                usage = chunk_usage or usage
+                if stop:
+                    await chunks.close()
+                    break
+            return self._settle(estimated_tokens, self._stream_result(prompt, parts, usage))
+        except Exception as e:
+            logger.error(f"Failed to generate LLM response: {e}")
+            raise e
+
+    def classify_error(self, error: BaseException) -> Optional[Failure]:
+        # An exhausted quota is also a 429, but waiting won't refill it.
+        if isinstance(error, openai.RateLimitError) and error.code == "insufficient_quota":
+            return Failure(FailureKind.FATAL)
+        # Connection errors and timeouts carry no status code; other API errors are classified by theirs.
+        if isinstance(error, openai.APIConnectionError):
+            return Failure(FailureKind.TRANSIENT)
+        return None
+
+    def _estimate_tokens(self, prompt: str, backend_kwargs: Dict) -> int:
+        # Prompt counts are memoized per line, so this reuses the counts from the context-limit check.
+        completion_tokens = backend_kwargs.get("max_tokens") or self.completion_token_estimate
+        return token_counter(self).count_prompt(prompt) + completion_tokens
+
+    def _admit(self, prompt: str, backend_kwargs: Dict) -> int:
+        """ Wait for room in the shared rate limits, returning the tokens reserved for the request. """
+        if self.rate_limiter is None:
+            return 0
+        estimated_tokens = self._estimate_tokens(prompt, backend_kwargs)
+        self.rate_limiter.acquire(estimated_tokens)
+        return estimated_tokens
+
+    async def _aadmit(self, prompt: str, backend_kwargs: Dict) -> int:
+        if self.rate_limiter is None:
+            return 0
+        estimated_tokens = self._estimate_tokens(prompt, backend_kwargs)
+        await self.rate_limiter.aacquire(estimated_tokens)
+        return estimated_tokens
+
+    def _settle(self, estimated_tokens: int, result: Tuple[str, Dict[str, int]]) -> Tuple[str, Dict[str, int]]:
+        if self.rate_limiter is not None:
+            self.rate_limiter.settle(estimated_tokens, result[1]["total_tokens"])
+        return result
+
+    @staticmethod
+    def _consume_chunk(chunk,
+                       parts: List[str],
+                       on_token: Callable[[str], Optional[bool]]) -> Tuple[Optional[Dict[str, int]], bool]:
+        """ Collect a chunk's token and usage, and whether on_token asked to stop the stream. """
+        stop = False
+        if chunk.choices:
+            token = chunk.choices[0].delta.content
+            if token:
+                parts.append(token)
+                stop = bool(on_token(token))
+        if chunk.usage is not None:
+            return {
+                "completion_tokens": chunk.usage.completion_tokens,
+                "prompt_tokens": chunk.usage.prompt_tokens,
+                "total_tokens": chunk.usage.total_tokens
+            }, stop
+        return None, stop
+
+    def _stream_result(self,
+                       prompt: str,
+                       parts: List[str],
+                       usage: Optional[Dict[str, int]]) -> Tuple[str, Dict[str, int]]:
+        response_content = "".join(parts)
+        logger.debug(f"LLM response: {response_content}")
+        if usage is None:
+            # Only the final chunk carries usage; estimate it if the stream ended, or was stopped, without one.
+            prompt_tokens = len(self.tokenize(prompt))
+            completion_tokens = len(self.tokenize(response_content))
+            usage = {
+                "completion_tokens": completion_tokens,
+                "prompt_tokens": prompt_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        return response_content, usage
+
+    def _completion_kwargs(self, prompt: str, backend_kwargs: Dict) -> Dict:
+        backend_kwargs = dict(backend_kwargs)
+        use_json_model = backend_kwargs.pop("use_json_model", False)
+        return {
+            "model": self.model,
+            "messages": [{"role": "system", "content": prompt}],
+            "response_format": {"type": "json_object"} if use_json_model else {"type": "text"},
+            **backend_kwargs
+        }
+
+    @staticmethod
+    def _parse_completion(completion) -> Tuple[str, Dict[str, int]]:
+        response_content = completion.choices[0].message.content
+        logger.debug(f"LLM response: {response_content}")
+
+        return response_content, {
+            "completion_tokens": completion.usage.completion_tokens,
+            "prompt_tokens": completion.usage.prompt_tokens,
+            "total_tokens": completion.usage.total_tokens
+        }
+
     def tokenize(self, text: str) -> List[int]:
-        enc = tiktoken.get_encoding(self.encoding_type)
-        return enc.encode(text)
+        return self.encoding.encode(text)
 
     def context_length(self) -> int:
         return self._model_context_windows[self.model]
@@ -4,7 +4,10 @@ from typing import Optional, List
 from pydantic import BaseModel
 from pydantic.v1 import BaseModel as BaseModelV1
 
+from assemble.app.core import metrics
+from assemble.app.core.cancellation import check_cancelled
 from assemble.app.core.memory.memory import Memory
+from assemble.app.core.retry import InvalidResponseException
 from assemble.app.core.states.base import Transition
 from assemble.app.core.tools.adapter import ToolAdapter
 
@@ -29,18 +32,25 @@ def tools_handler(
     if tools is None:
         raise ValueError("Tools must be provided for this state handler.")
 
-    parsed_tool_input = json.loads(response)
-    tool = next((tool for tool in tools if tool.name == parsed_tool_input['tool_name']), None)
-    if tool is None:
-        return Transition(
-            updated_response="Invalid tool name for response. Please try again.",
-            next_state=next_state,
-        )
+    # Only parsing and validating the response is the model's fault; errors from running the tool aren't repaired.
+    try:
+        parsed_tool_input = json.loads(response)
+        tool = next((tool for tool in tools if tool.name == parsed_tool_input['tool_name']), None)
+        if tool is None:
+            return Transition(
+                updated_response="Invalid tool name for response. Please try again.",
+                next_state=next_state,
+            )
 
-    del parsed_tool_input['tool_name']
+        del parsed_tool_input['tool_name']
 
-    typed_input = tool.validate(parsed_tool_input)
-    output = tool.run(typed_input)
+        typed_input = tool.validate(parsed_tool_input)
+    except (ValueError, LookupError, TypeError) as e:
+        raise InvalidResponseException(response, e) from e
+    check_cancelled()
+    with metrics.timed("tool.duration_seconds", tool=tool.name):
+        output = tool.run(typed_input)
+    check_cancelled()
 
     tool_results = f'Tool executed for {tool.name}.'
     if not tool.exclude_input_from_scratch_pad:
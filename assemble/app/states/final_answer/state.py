@@ -1,8 +1,9 @@
-from typing import Optional, List
+from typing import Optional, List, Dict
 
 from assemble.app.core.memory.memory import Memory
 from assemble.app.core.persona import Persona
 from assemble.app.core.states.base import StateBase, Transition
+from assemble.app.core.states.prompt import Segment
 from assemble.app.states.defaults import text_handler
 from assemble.app.core.states.states import SystemStates
 from assemble.app.core.tools.adapter import ToolAdapter
@@ -10,11 +11,22 @@ from assemble.app.core.tools.adapter import ToolAdapter
 
 class FinalAnswerState(StateBase):
     name: str = "final_answer"
+    stream_tokens: bool = True
+
+    def prompt_segments(self, memory: Memory) -> List[Segment]:
+        return [Segment(name="notes", items=memory.scratch_pad.get())]
 
     def build_prompt(self,
                      persona: Persona,
                      memory: Memory,
                      tools: Optional[List[ToolAdapter]]) -> str:
+        return self.render_prompt(persona, memory, tools, {"notes": memory.scratch_pad.get()})
+
+    def render_prompt(self,
+                      persona: Persona,
+                      memory: Memory,
+                      tools: Optional[List[ToolAdapter]],
+                      segments: Dict[str, List[str]]) -> str:
         return f'''{persona.prompt()}
 
 Given the problem from the user, use your notes to give an answer. Directly address the problem.
@@ -26,7 +38,7 @@ Problem:
 
 Notes from oldest to newest:
 """
-{memory.scratch_pad.prompt()}
+{memory.scratch_pad.prompt(segments["notes"])}
 """
 
 Your complete and detailed answer to the problem.'''
@@ -1,9 +1,10 @@
-from typing import List, Optional
+from typing import List, Optional, Dict
 
 from assemble.app.core.llm.generator import Generator
 from assemble.app.core.memory.memory import Memory
 from assemble.app.core.persona import Persona
 from assemble.app.core.states.base import StateBase, Transition
+from assemble.app.core.states.prompt import Segment
 from assemble.app.core.tools.adapter import ToolAdapter
 from assemble.app.states.defaults import text_handler
 
@@ -31,15 +32,21 @@ class RewriteQuestionState(StateBase):
         self.user_name = user_name
         self.next_state = next_state
 
+    def prompt_segments(self, memory: Memory) -> List[Segment]:
+        return [Segment(name="messages", items=self.prompt_messages(memory))]
+
     def build_prompt(self,
                      persona: Persona,
                      memory: Memory,
                      tools: Optional[List[ToolAdapter]]) -> str:
-        messages_formatted = "\n".join(
-            [
-                f"{user_message.name}: {user_message.content}\n"
-                for user_message in memory.data.get_all_messages()
-            ])
+        return self.render_prompt(persona, memory, tools, {"messages": self.prompt_messages(memory)})
+
+    def render_prompt(self,
+                      persona: Persona,
+                      memory: Memory,
+                      tools: Optional[List[ToolAdapter]],
+                      segments: Dict[str, List[str]]) -> str:
+        messages_formatted = "\n".join(segments["messages"])
         return f'''Rewrite the last message from {self.user_name} into a single, coherent statement using the context from the conversation history.
 
 Please focus solely on rewriting the message clearly; do not respond to any queries it contains. Do not summarize, simply capture the subject being discussed to best rewrite the last message.
@@ -66,7 +73,7 @@ Rewritten message: '''
     def before_generation(self,
                           memory: Memory,
                           tools: Optional[List[ToolAdapter]]) -> Optional[Transition]:
-        if len(memory.data.get_all_messages()) == 1:
+        if memory.data.count_messages() == 1:
             return Transition(next_state=self.next_state)
 
     def after_generation(self, response: str, memory: Memory, tools: Optional[List[ToolAdapter]]) -> Transition:
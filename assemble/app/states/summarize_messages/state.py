@@ -1,9 +1,10 @@
-from typing import List, Optional
+from typing import List, Optional, Dict
 
 from assemble.app.core.llm.generator import Generator
 from assemble.app.core.memory.memory import Memory
 from assemble.app.core.persona import Persona
 from assemble.app.core.states.base import StateBase, Transition
+from assemble.app.core.states.prompt import Segment
 from assemble.app.core.tools.adapter import ToolAdapter
 from assemble.app.states.defaults import text_handler
 
@@ -29,12 +30,21 @@ class SummarizeMessagesState(StateBase):
         )
         self.next_state = next_state
 
+    def prompt_segments(self, memory: Memory) -> List[Segment]:
+        return [Segment(name="messages", items=self.prompt_messages(memory))]
+
     def build_prompt(self,
                      persona: Persona,
                      memory: Memory,
                      tools: Optional[List[ToolAdapter]]) -> str:
-        messages_formatted = "\n".join(
-            [f"{message.name}: {message.content}\n" for message in memory.data.get_all_messages()])
+        return self.render_prompt(persona, memory, tools, {"messages": self.prompt_messages(memory)})
+
+    def render_prompt(self,
+                      persona: Persona,
+                      memory: Memory,
+                      tools: Optional[List[ToolAdapter]],
+                      segments: Dict[str, List[str]]) -> str:
+        messages_formatted = "\n".join(segments["messages"])
         return f'''Given the conversation history, summarize the messages.
 
 Messages:
@@ -47,7 +57,7 @@ Summarize:'''
     def before_generation(self,
                           memory: Memory,
                           tools: Optional[List[ToolAdapter]]) -> Optional[Transition]:
-        if len(memory.data.get_all_messages()) == 1:
+        if memory.data.count_messages() == 1:
             return Transition(next_state=self.next_state)
 
     def after_generation(self, response: str, memory: Memory, tools: Optional[List[ToolAdapter]]) -> Transition:
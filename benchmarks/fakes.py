@@ -0,0 +1,62 @@
+import json
+import re
+from typing import Any, Dict, List, Tuple
+
+from pydantic import BaseModel
+
+from assemble.app.core.llm.adapter import LLMAdapter
+from assemble.app.core.tools.adapter import ToolAdapter
+from assemble.app.core.tools.helper import build_schema
+
+
+class ZeroLatencyLLM(LLMAdapter):
+    """ Answers every state instantly, so only the framework's own overhead is measured. """
+
+    def __init__(self, actions_per_query: int = 2, context_window_length: int = 128000):
+        # Tool calls the agent makes before answering each query.
+        self.actions_per_query = actions_per_query
+        self.context_window_length = context_window_length
+
+    def generate(self, prompt: str, **backend_kwargs) -> Tuple[str, Dict[str, int]]:
+        if prompt.endswith("Choice JSON:"):
+            # Only observations since the last answer count, when the scratch pad is kept across queries.
+            observations = prompt.rsplit("FINAL_ANSWER:", 1)[-1].count("OBSERVE:")
+            if observations < self.actions_per_query:
+                response = json.dumps({"type": "Action", "reason": "Echo the message back."})
+            else:
+                response = json.dumps({"type": "Answer", "reason": "The echo tool answered it."})
+        elif backend_kwargs.get("use_json_model"):
+            response = json.dumps({"tool_name": EchoTool.name, "text": "benchmark"})
+        else:
+            response = "The tool echoed the message back."
+        return response, {
+            "completion_tokens": len(response) // 4,
+            "prompt_tokens": len(prompt) // 4,
+            "total_tokens": (len(prompt) + len(response)) // 4
+        }
+
+    def tokenize(self, text: str) -> List[int]:
+        return [hash(piece) for piece in re.findall(r"\w+|[^\w\s]", text)]
+
+    def context_length(self) -> int:
+        return self.context_window_length
+
+
+class EchoInput(BaseModel):
+    text: str
+
+
+class EchoTool(ToolAdapter[EchoInput, str]):
+    name = "echo"
+    description = "Echoes the text it's given."
+    exclude_output_from_scratch_pad = False
+    exclude_input_from_scratch_pad = False
+
+    def run(self, input: EchoInput) -> str:
+        return input.text
+
+    def validate(self, input: Any) -> EchoInput:
+        return EchoInput.model_validate(input)
+
+    def schema(self) -> Dict[str, Any]:
+        return build_schema(self.name, self.description, EchoInput.model_json_schema())
@@ -0,0 +1,219 @@
+""" Benchmarks the framework's own overhead with a zero-latency LLM; run with python -m benchmarks.run. """
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+from assemble.app.agents.react.agent import ReActAgentFactory, ThoughtState
+from assemble.app.core.llm.generator import Generator
+from assemble.app.core.memory.memory import Memory, Message
+from assemble.app.core.messages import Query
+from assemble.app.core.persona import Persona
+from assemble.app.states.defaults import tools_handler
+from benchmarks.fakes import EchoTool, ZeroLatencyLLM
+
+logger = logging.getLogger(__name__)
+
+
+def _timings(function: Callable[[], Any], iterations: int, warmup: int = 10) -> Dict[str, float]:
+    """ Call function repeatedly, summarizing its per-call wall time in microseconds. """
+    for _ in range(warmup):
+        function()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {
+        "iterations": iterations,
+        "ops_per_second": iterations / (sum(samples) / 1e6),
+        "mean_us": statistics.fmean(samples),
+        "p50_us": samples[len(samples) // 2],
+        "p99_us": samples[min(int(len(samples) * 0.99), len(samples) - 1)],
+    }
+
+
+def _memory(notes: int, messages: int) -> Memory:
+    memory = Memory()
+    for index in range(messages):
+        memory.data.add_message(Message(name="user", content=f"Message {index} asking the agent to echo something."))
+    memory.data.add_message(Message(name="user", content="Echo this message."))
+    for index in range(notes):
+        memory.scratch_pad.set(f"OBSERVE: Observation {index} of the echo tool's output with a few details.")
+    memory.data.set("last_thought", "Echo the message back.")
+    return memory
+
+
+def bench_prompt_building(iterations: int) -> Dict[str, Any]:
+    llm, tools = ZeroLatencyLLM(), [EchoTool()]
+    state = ThoughtState(Generator(service=llm, use_json_model=True), tools=tools)
+    persona = Persona("You're a benchmark agent.")
+    results = {}
+    for size in (0, 10, 100):
+        memory = _memory(notes=size, messages=size)
+        results[f"build_prompt_{size}_notes"] = _timings(lambda: state.build_prompt(persona, memory, tools), iterations)
+        results[f"fit_prompt_{size}_notes"] = _timings(lambda: state._fit_prompt(persona, memory), iterations)
+    return results
+
+
+def bench_context_check(iterations: int) -> Dict[str, Any]:
+    llm, tools = ZeroLatencyLLM(), [EchoTool()]
+    generator = Generator(service=llm, use_json_model=True)
+    state = ThoughtState(generator, tools=tools)
+    prompt = state.build_prompt(Persona("You're a benchmark agent."), _memory(notes=100, messages=100), tools)
+    return {
+        "is_context_limit": _timings(lambda: generator.is_context_limit(prompt), iterations),
+        "tokenize_uncached": _timings(lambda: llm.tokenize(prompt), iterations),
+    }
+
+
+def bench_tools_handler(iterations: int) -> Dict[str, Any]:
+    tools = [EchoTool()]
+    memory = Memory()
+    response = json.dumps({"tool_name": EchoTool.name, "text": "benchmark"})
+    return {
+        "tools_handler": _timings(
+            lambda: tools_handler(response=response, memory=memory, tools=tools, next_state="observe"), iterations),
+    }
+
+
+def bench_steps(queries: int) -> Dict[str, Any]:
+    """ Steps per second through the actor, where per-step time is all framework overhead. """
+    agent = ReActAgentFactory.start(ZeroLatencyLLM(), [EchoTool()], clear_scratch_pad_after_answer=True,
+                                    clear_data_after_answer=True)
+    try:
+        steps = []
+        start = time.perf_counter()
+        for index in range(queries):
+            agent.ask(Query(goal=f"Echo message {index}.", on_step=steps.append)).get()
+        elapsed = time.perf_counter() - start
+    finally:
+        agent.stop()
+    return {
+        "queries": queries,
+        "steps": len(steps),
+        "steps_per_second": len(steps) / elapsed,
+        "step_overhead_us": elapsed / len(steps) * 1e6,
+        "query_latency_ms": elapsed / queries * 1e3,
+    }
+
+
+def bench_memory_growth(queries: int, checkpoints: int = 5) -> Dict[str, Any]:
+    """ Memory and step time as one session's scratch pad and messages grow over a long conversation. """
+    agent = ReActAgentFactory.start(ZeroLatencyLLM(), [EchoTool()], step_limit=50)
+    samples = []
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    try:
+        every = max(queries // checkpoints, 1)
+        start, steps = time.perf_counter(), []
+        for index in range(1, queries + 1):
+            agent.ask(Query(goal=f"Echo message {index}.", on_step=steps.append)).get()
+            if index % every == 0:
+                elapsed = time.perf_counter() - start
+                samples.append({
+                    "queries": index,
+                    "traced_bytes": tracemalloc.get_traced_memory()[0] - baseline,
+                    "step_overhead_us": elapsed / len(steps) * 1e6,
+                })
+                start, steps = time.perf_counter(), []
+    finally:
+        tracemalloc.stop()
+        agent.stop()
+    return {"checkpoints": samples, "bytes_per_query": samples[-1]["traced_bytes"] / queries if samples else 0}
+
+
+def bench_actor_scaling(queries: int, max_agents: int) -> Dict[str, Any]:
+    """ Throughput with 1 to max_agents actors, each answering its share of the queries concurrently. """
+    results = {}
+    agents = 1
+    while agents <= max_agents:
+        refs = [ReActAgentFactory.start(ZeroLatencyLLM(), [EchoTool()], clear_scratch_pad_after_answer=True,
+                                        clear_data_after_answer=True) for _ in range(agents)]
+        try:
+            start = time.perf_counter()
+            # Agents hand back a future for each query's response as soon as it's queued.
+            futures = [refs[index % agents].ask(Query(goal=f"Echo message {index}.")) for index in range(queries)]
+            for future in futures:
+                future.get()
+            elapsed = time.perf_counter() - start
+        finally:
+            for ref in refs:
+                ref.stop()
+        results[str(agents)] = {"queries_per_second": queries / elapsed}
+        agents *= 2
+    return results
+
+
+def bench_async_scaling(queries: int, max_concurrency: int) -> Dict[str, Any]:
+    """ Throughput of the asyncio runtime with 1 to max_concurrency queries in flight. """
+    async def run(concurrency: int) -> float:
+        agent = ReActAgentFactory.create_async(ZeroLatencyLLM(), [EchoTool()], max_concurrency=concurrency)
+        start = time.perf_counter()
+        await asyncio.gather(*[agent.ask(Query(goal=f"Echo message {index}.", session_id=str(index)))
+                               for index in range(queries)])
+        return time.perf_counter() - start
+
+    results = {}
+    concurrency = 1
+    while concurrency <= max_concurrency:
+        results[str(concurrency)] = {"queries_per_second": queries / asyncio.run(run(concurrency))}
+        concurrency *= 2
+    return results
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", default="benchmark-results.json", help="File to write the results to as JSON.")
+    parser.add_argument("--iterations", type=int, default=2000, help="Calls per microbenchmark.")
+    parser.add_argument("--queries", type=int, default=200, help="Queries per end-to-end benchmark.")
+    parser.add_argument("--max-agents", type=int, default=8, help="Most concurrent agents or queries to scale to.")
+    args = parser.parse_args(argv)
+
+    benchmarks = {
+        "prompt_building": lambda: bench_prompt_building(args.iterations),
+        "context_check": lambda: bench_context_check(args.iterations),
+        "tools_handler": lambda: bench_tools_handler(args.iterations),
+        "steps": lambda: bench_steps(args.queries),
+        "memory_growth": lambda: bench_memory_growth(args.queries),
+        "actor_scaling": lambda: bench_actor_scaling(args.queries, args.max_agents),
+        "async_scaling": lambda: bench_async_scaling(args.queries, args.max_agents),
+    }
+    results = {}
+    for name, benchmark in benchmarks.items():
+        logger.info(f"Running benchmark {name}.")
+        results[name] = benchmark()
+
+    report = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "arguments": vars(args),
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    main()